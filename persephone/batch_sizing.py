@@ -0,0 +1,184 @@
+""" Choosing batch sizes that fit in memory, and recovering when one doesn't.
+
+`probe_max_batch_size()` finds the largest batch of the longest training
+utterances that a model can compute gradients for within a memory limit, so
+that batch sizes can be chosen for the machine at hand rather than by rule of
+thumb. Since utterance lengths vary, a batch can still run out of memory in
+training, so `compute_gradients_split()` and `decode_split()` retry a batch
+that does in halves, recursively, and combine the results.
+"""
+
+import logging
+from typing import Any, List, Optional, Sequence, Tuple, TypeVar
+
+import numpy as np
+import tensorflow as tf
+
+from .exceptions import PersephoneException
+from .telemetry import peak_rss
+
+logger = logging.getLogger(__name__) # type: ignore
+
+T = TypeVar("T")
+
+def split_batch(batch: Sequence[T]) -> Tuple[Sequence[T], Sequence[T]]:
+    """ Splits a batch into two halves. """
+
+    if len(batch) < 2:
+        raise PersephoneException("Can't split a batch of %d utterances." % len(batch))
+    middle = len(batch) // 2
+    return batch[:middle], batch[middle:]
+
+def _num_frames(feat_path: str) -> int:
+    """ The number of frames in a feature file, read without loading it. """
+
+    return np.load(feat_path, mmap_mode="r").shape[0]
+
+def probe_max_batch_size(model: Any, memory_limit: Optional[int] = None,
+                         max_batch_size: int = 64) -> int:
+    """ Finds the largest batch size for which the model can compute the
+    gradients of a batch of its longest training utterances.
+
+    Batch sizes are doubled from 1 until a step runs out of memory, the peak
+    resident set size of the process exceeds memory_limit, or max_batch_size
+    or the number of training utterances is reached. Gradients are computed
+    in a fresh session and never applied, so the model's variables are left
+    as they were.
+
+    Args:
+        model: The model, whose graph must be the default graph.
+        memory_limit: The most memory in bytes the process may use. If None,
+                      only running out of memory limits the batch size.
+        max_batch_size: The largest batch size to try.
+
+    Returns:
+        The largest batch size that fit, which is at least 1.
+    """
+
+    train_fns = sorted(model.corpus_reader.train_fns,
+                       key=lambda fns: _num_frames(fns[0]), reverse=True)
+    max_batch_size = min(max_batch_size, len(train_fns))
+
+    batch_size = 1
+    config = tf.ConfigProto()
+    config.gpu_options.allow_growth = True #pylint: disable=no-member
+    with tf.Session(config=config) as sess:
+        sess.run(tf.global_variables_initializer())
+        while batch_size * 2 <= max_batch_size:
+            candidate = batch_size * 2
+            batch = model.corpus_reader.load_batch(train_fns[:candidate])
+            try:
+                model.compute_gradients(sess, model.make_feed_dict(*batch))
+            except tf.errors.ResourceExhaustedError:
+                logger.info("Ran out of memory probing batch size %d", candidate)
+                break
+            rss = peak_rss()
+            if memory_limit and rss and rss > memory_limit:
+                logger.info("Batch size %d took peak memory use to %d bytes,"
+                            " over the limit of %d", candidate, rss, memory_limit)
+                break
+            batch_size = candidate
+    logger.info("Largest batch size that fits: %d", batch_size)
+    return batch_size
+
+def compute_gradients_split(model: Any, sess: tf.Session,
+                            fn_batch: Sequence[Tuple[str, str]],
+                            split: bool = False
+                           ) -> Tuple[List[np.ndarray], float]:
+    """ Computes the gradients for a batch of training file paths, splitting
+    it in halves, recursively, if it runs out of memory.
+
+    Args:
+        model: The model to compute gradients for.
+        sess: The session holding the model's variables.
+        fn_batch: The feature and label file paths of the batch.
+        split: If True, the batch is split without first trying it whole,
+               for when it is already known not to fit.
+
+    Returns:
+        A tuple of the gradients and the label error rate of the batch, as
+        returned by `Model.compute_gradients()`.
+    """
+
+    if not split:
+        try:
+            batch = model.corpus_reader.load_batch(fn_batch)
+            return model.compute_gradients(sess, model.make_feed_dict(*batch))
+        except tf.errors.ResourceExhaustedError:
+            if len(fn_batch) < 2:
+                raise
+            logger.warning("Ran out of memory computing gradients for %d utterances,"
+                           " splitting the batch", len(fn_batch))
+
+    # The cost and LER are means over utterances, so the halves are weighted
+    # by their sizes.
+    first, second = split_batch(fn_batch)
+    first_grads, first_ler = compute_gradients_split(model, sess, first)
+    second_grads, second_ler = compute_gradients_split(model, sess, second)
+    first_weight = len(first) / len(fn_batch)
+    second_weight = len(second) / len(fn_batch)
+    grads = [first_weight * first_grad + second_weight * second_grad
+             for first_grad, second_grad in zip(first_grads, second_grads)]
+    return grads, first_weight * first_ler + second_weight * second_ler
+
+def _slice_sparse(sparse: Tuple[np.ndarray, np.ndarray, np.ndarray],
+                  start: int, end: int
+                 ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """ The rows start to end of a sparse tensor value as made by
+    `utils.target_list_to_sparse_tensor()`. """
+
+    indices, vals, _ = sparse
+    mask = (indices[:, 0] >= start) & (indices[:, 0] < end)
+    sub_indices = indices[mask].copy()
+    sub_indices[:, 0] -= start
+    width = sub_indices[:, 1].max() + 1 if len(sub_indices) else 1
+    return sub_indices, vals[mask], np.array([end - start, width])
+
+def _slice_targets(batch_y: Any, start: int, end: int) -> Any:
+    """ The rows start to end of a batch's targets, which are either a sparse
+    tensor value or, for models with several outputs, a tuple of them. """
+
+    if isinstance(batch_y[0], tuple):
+        return tuple(_slice_sparse(targets, start, end) for targets in batch_y)
+    return _slice_sparse(batch_y, start, end)
+
+def decode_split(model: Any, sess: tf.Session, batch_x: np.ndarray,
+                 batch_x_lens: np.ndarray,
+                 batch_y: Any,
+                 split: bool = False
+                ) -> Tuple[float, List[List[str]], List[List[str]]]:
+    """ Decodes a loaded batch, splitting it in halves, recursively, if it
+    runs out of memory. If split is True, the batch is split without first
+    trying it whole.
+
+    Returns:
+        A tuple of the label error rate of the batch and its human readable
+        hypotheses and references.
+    """
+
+    if not split:
+        try:
+            ler, dense_decoded, dense_ref = sess.run(
+                [model.ler, model.dense_decoded, model.dense_ref],
+                feed_dict=model.make_feed_dict(batch_x, batch_x_lens, batch_y))
+            hyps, refs = model.corpus_reader.human_readable_hyp_ref(
+                dense_decoded, dense_ref)
+            return ler, hyps, refs
+        except tf.errors.ResourceExhaustedError:
+            if len(batch_x) < 2:
+                raise
+            logger.warning("Ran out of memory decoding %d utterances,"
+                           " splitting the batch", len(batch_x))
+
+    # Each half is trimmed to the length of its own longest utterance.
+    middle = len(batch_x) // 2
+    first_len = max(batch_x_lens[:middle])
+    second_len = max(batch_x_lens[middle:])
+    first_ler, first_hyps, first_refs = decode_split(
+        model, sess, batch_x[:middle, :first_len], batch_x_lens[:middle],
+        _slice_targets(batch_y, 0, middle))
+    second_ler, second_hyps, second_refs = decode_split(
+        model, sess, batch_x[middle:, :second_len], batch_x_lens[middle:],
+        _slice_targets(batch_y, middle, len(batch_x)))
+    ler = (middle * first_ler + (len(batch_x) - middle) * second_ler) / len(batch_x)
+    return ler, first_hyps + second_hyps, first_refs + second_refs
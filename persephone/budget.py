@@ -0,0 +1,203 @@
+""" Training within a fixed amount of time or data.
+
+A `TrainingBudget` measures what each epoch of training and each validation
+costs, and from that decides whether another epoch fits in what remains of a
+wall-clock budget and/or a budget of training frames. Since validation takes
+time away from training, it also spaces validations out so that they take
+no more than a set fraction of the time, always validating the last epoch
+that fits so that the best checkpoint reflects the end of training.
+"""
+
+import logging
+import math
+import time
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .exceptions import PersephoneException
+
+logger = logging.getLogger(__name__) # type: ignore
+
+def count_frames(fn_pairs: Sequence[Tuple[str, str]]) -> int:
+    """ The total number of frames in the feature files of a sequence of
+    (feature path, label path) pairs, read without loading the features. """
+
+    return sum(np.load(str(feat_fn), mmap_mode="r").shape[0]
+               for feat_fn, _ in fn_pairs)
+
+class TrainingBudget:
+    """ Decides when to validate and when to stop so that training finishes
+    within a budget.
+
+    Args:
+        time_budget: The number of seconds training may take, including
+                     validation and the final evaluation on the test set.
+        frame_budget: The number of training frames, summed over epochs, that
+                      training may use.
+        max_validation_fraction: Validation is done every few epochs so that
+                                 it takes at most about this fraction of the
+                                 time spent training.
+    """
+
+    def __init__(self, time_budget: Optional[float] = None,
+                 frame_budget: Optional[int] = None,
+                 max_validation_fraction: float = 0.2) -> None:
+        if not time_budget and not frame_budget:
+            raise PersephoneException(
+                "A training budget needs a time_budget or a frame_budget.")
+        if max_validation_fraction <= 0:
+            raise PersephoneException(
+                "max_validation_fraction must be positive, got %f." %
+                max_validation_fraction)
+        self.time_budget = time_budget
+        self.frame_budget = frame_budget
+        self.max_validation_fraction = max_validation_fraction
+        self.frames_per_epoch = 0
+        # Totals over the whole run, including any before resuming.
+        self.elapsed_before = 0.0
+        self.frames_used = 0
+        self.train_time = 0.0
+        self.num_epochs = 0
+        self.validation_time = 0.0
+        self.num_validations = 0
+        self.last_validated_epoch = 0
+        self._start_time = None # type: Optional[float]
+
+    def start(self, frames_per_epoch: int) -> None:
+        """ Starts the clock. frames_per_epoch is the number of frames in
+        the training data. """
+
+        self.frames_per_epoch = frames_per_epoch
+        self._start_time = time.monotonic()
+
+    @property
+    def elapsed(self) -> float:
+        """ The seconds of the time budget used so far. """
+        if self._start_time is None:
+            return self.elapsed_before
+        return self.elapsed_before + time.monotonic() - self._start_time
+
+    @property
+    def epoch_time(self) -> Optional[float]:
+        """ The mean seconds an epoch of training takes, if known. """
+        if not self.num_epochs:
+            return None
+        return self.train_time / self.num_epochs
+
+    @property
+    def mean_validation_time(self) -> Optional[float]:
+        """ The mean seconds a validation takes, if known. """
+        if not self.num_validations:
+            return None
+        return self.validation_time / self.num_validations
+
+    def epoch_done(self, train_time: float) -> None:
+        """ Records an epoch of training that took train_time seconds. """
+
+        self.train_time += train_time
+        self.num_epochs += 1
+        self.frames_used += self.frames_per_epoch
+
+    def validation_done(self, epoch: int, validation_time: Optional[float]) -> None:
+        """ Records that epoch was validated, taking validation_time seconds
+        of the training process's time. validation_time is None when
+        validation ran elsewhere. """
+
+        self.last_validated_epoch = epoch
+        if validation_time is not None:
+            self.validation_time += validation_time
+            self.num_validations += 1
+
+    @property
+    def validation_interval(self) -> int:
+        """ The number of epochs between validations. """
+
+        if not self.epoch_time or not self.mean_validation_time:
+            return 1
+        return max(1, math.ceil(self.mean_validation_time /
+                                (self.max_validation_fraction * self.epoch_time)))
+
+    def can_train_epoch(self) -> bool:
+        """ Whether another epoch, followed by its validation and the final
+        evaluation, fits in the remaining budget. """
+
+        if self.frame_budget and self.frames_used + self.frames_per_epoch > self.frame_budget:
+            return False
+        if self.time_budget and self.epoch_time is not None:
+            # Validation of the epoch and evaluation on the test set are
+            # both assumed to take about as long as past validations.
+            needed = self.epoch_time + 2 * (self.mean_validation_time or 0.0)
+            if self.elapsed + needed > self.time_budget:
+                return False
+        return True
+
+    def should_validate(self, epoch: int) -> bool:
+        """ Whether the epoch just trained should be validated. """
+
+        if self.last_validated_epoch == 0:
+            # Validate the first epoch so that there is a checkpoint to keep
+            # and a validation time to plan with.
+            return True
+        if not self.can_train_epoch():
+            # This is the last epoch that fits.
+            return True
+        return epoch - self.last_validated_epoch >= self.validation_interval
+
+    def remaining_epochs(self) -> Optional[int]:
+        """ An estimate of how many more epochs fit in the budget, or None
+        if there is nothing to estimate it from yet. """
+
+        estimates = []
+        if self.frame_budget and self.frames_per_epoch:
+            estimates.append((self.frame_budget - self.frames_used) // self.frames_per_epoch)
+        if self.time_budget and self.epoch_time:
+            validation_time = self.mean_validation_time or 0.0
+            # Time per epoch including its share of validations.
+            cost = self.epoch_time + validation_time / self.validation_interval
+            remaining_time = self.time_budget - self.elapsed - validation_time
+            estimates.append(int(max(0.0, remaining_time) // cost))
+        if not estimates:
+            return None
+        return max(0, min(estimates))
+
+    def projection(self, epoch: int, max_epochs: int) -> str:
+        """ A description of the budget used so far and when training is
+        projected to end. """
+
+        parts = []
+        if self.time_budget:
+            parts.append("%.0fs of %.0fs used" % (self.elapsed, self.time_budget))
+        if self.frame_budget:
+            parts.append("%d of %d frames used" % (self.frames_used, self.frame_budget))
+        remaining = self.remaining_epochs()
+        if remaining is not None:
+            end_epoch = min(max_epochs, epoch + remaining)
+            parts.append("projected to stop by epoch %d" % end_epoch)
+            if self.epoch_time:
+                cost = self.epoch_time + (self.mean_validation_time or 0.0) / self.validation_interval
+                parts.append("in about %.0fs" % ((end_epoch - epoch) * cost))
+        parts.append("validating every %d epochs" % self.validation_interval)
+        return "Budget: " + ", ".join(parts)
+
+    def get_state(self) -> Dict[str, Any]:
+        """ The budget used so far, for saving with `set_state()`. """
+
+        return {"elapsed": self.elapsed,
+                "frames_used": self.frames_used,
+                "train_time": self.train_time,
+                "num_epochs": self.num_epochs,
+                "validation_time": self.validation_time,
+                "num_validations": self.num_validations,
+                "last_validated_epoch": self.last_validated_epoch}
+
+    def set_state(self, state: Dict[str, Any]) -> None:
+        """ Restores the budget used by an earlier, interrupted run. """
+
+        self.elapsed_before = state["elapsed"]
+        self.frames_used = state["frames_used"]
+        self.train_time = state["train_time"]
+        self.num_epochs = state["num_epochs"]
+        self.validation_time = state["validation_time"]
+        self.num_validations = state["num_validations"]
+        self.last_validated_epoch = state["last_validated_epoch"]
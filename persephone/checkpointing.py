@@ -0,0 +1,214 @@
+""" Saving checkpoints and training outputs off the training loop's critical
+path. """
+
+import glob
+import json
+import logging
+import os
+import queue
+import shutil
+import threading
+from typing import Any, Callable, Dict, List, Optional, Set
+
+import tensorflow as tf
+
+from .config import ENCODING
+
+logger = logging.getLogger(__name__) # type: ignore
+
+# The most jobs an AsyncCheckpointWriter queues before save() and submit()
+# block. Each queued checkpoint holds a copy of every variable.
+MAX_QUEUED_JOBS = 2
+
+def _checkpoint_files(path: str) -> List[str]:
+    """ The data and index files of the checkpoint with path prefix path. """
+
+    return [fn for fn in glob.glob(glob.escape(path) + ".*")
+            if fn.endswith(".index") or ".data-" in fn]
+
+def copy_checkpoint(src_path: str, tgt_path: str) -> None:
+    """ Copies the data and index files of the checkpoint with path prefix
+    src_path so that it can be restored from the path prefix tgt_path. """
+
+    for fn in _checkpoint_files(src_path):
+        shutil.copyfile(fn, tgt_path + fn[len(src_path):])
+
+def remove_checkpoint(path: str) -> None:
+    """ Deletes the data and index files of the checkpoint with path prefix
+    path. """
+
+    for fn in _checkpoint_files(path):
+        os.remove(fn)
+
+def save_train_state(path: str, state: Dict[str, Any]) -> None:
+    """ Writes the state of the training loop to path as JSON. The file is
+    replaced atomically so that an interruption can't leave it half
+    written. """
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding=ENCODING) as state_f:
+        json.dump(state, state_f)
+    os.replace(tmp_path, path)
+
+def load_train_state(path: str) -> Optional[Dict[str, Any]]:
+    """ Reads training loop state written by `save_train_state()`, or
+    returns None if there is none. """
+
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding=ENCODING) as state_f:
+        return json.load(state_f)
+
+class CheckpointWriter:
+    """ Writes checkpoints and other training outputs immediately, in the
+    calling thread. Shares its interface with `AsyncCheckpointWriter` so
+    that the training loop doesn't need to know which it is using.
+
+    Args:
+        saver: The `tf.train.Saver` used to save checkpoints.
+    """
+
+    def __init__(self, saver: tf.train.Saver) -> None:
+        self.saver = saver
+
+    def save(self, sess: tf.Session, path: str,
+             write_meta_graph: bool = True, write_state: bool = True) -> None:
+        """ Saves the variables in sess as a checkpoint with the path prefix
+        path, and the meta graph next to it unless write_meta_graph is
+        False. If write_state is False the checkpoint is left out of the
+        saver's record of recent checkpoints, so that it neither replaces
+        them nor is deleted to make room for newer ones. """
+
+        self.saver.save(sess, path, write_meta_graph=write_meta_graph,
+                        write_state=write_state)
+
+    def submit(self, func: Callable[..., Any], *args: Any) -> None:
+        """ Calls func(*args). """
+
+        func(*args)
+
+    def flush(self) -> None:
+        """ Does nothing, since all writes are already done. """
+
+    def close(self) -> None:
+        """ Does nothing, since all writes are already done. """
+
+    def __enter__(self) -> "CheckpointWriter":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+class AsyncCheckpointWriter(CheckpointWriter):
+    """ Writes checkpoints and other training outputs in a background thread.
+
+    Saving a checkpoint takes a snapshot of the variable values in the
+    training session, which is fast, and then hands serialization and disk
+    I/O to a background thread that owns a separate graph holding copies of
+    the variables. Checkpoints are written under the same variable names as
+    the training graph, and the training graph's meta graph is exported next
+    to them, so they can be restored with `tf.train.Saver.restore()` or
+    `model.decode()` as usual.
+
+    Jobs run in the order they are submitted. At most `MAX_QUEUED_JOBS` wait
+    at once; beyond that `save()` and `submit()` block until the background
+    thread catches up, so that snapshots can't pile up in memory when
+    storage is slow. Call `flush()` before reading anything the writer has
+    been asked to write. Errors raised in the
+    background thread are re-raised by `flush()`.
+
+    Args:
+        saver: The `tf.train.Saver` of the training graph, used for the meta
+               graph exported with checkpoints. It should have been
+               constructed with its default list of variables.
+    """
+
+    def __init__(self, saver: tf.train.Saver) -> None:
+        super().__init__(saver)
+        self.graph = tf.get_default_graph()
+        self.saver_def = saver.saver_def
+        self.variables = tf.global_variables()
+        self._jobs = queue.Queue(maxsize=MAX_QUEUED_JOBS) # type: queue.Queue
+        self._error = None # type: Optional[BaseException]
+        self._exported_meta_paths = set() # type: Set[str]
+
+        # The snapshot graph mirrors the training graph's variables, saving
+        # them under the same names.
+        snapshot_graph = tf.Graph()
+        with snapshot_graph.as_default(): #type: ignore
+            snapshot_vars = {} # type: Dict[str, tf.Variable]
+            for var in self.variables:
+                snapshot_vars[var.op.name] = tf.Variable(
+                    tf.zeros(var.shape, dtype=var.dtype.base_dtype))
+            self._snapshot_saver = tf.train.Saver(snapshot_vars)
+        self._snapshot_sess = tf.Session(graph=snapshot_graph)
+        self._snapshot_vars = [snapshot_vars[var.op.name] for var in self.variables]
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        """ Runs jobs in the background thread until a None job is seen. """
+
+        while True:
+            job = self._jobs.get()
+            try:
+                if job is None:
+                    break
+                if self._error is None:
+                    kind, args = job
+                    if kind == "checkpoint":
+                        path, values, write_meta_graph, write_state = args
+                        for var, value in zip(self._snapshot_vars, values):
+                            var.load(value, self._snapshot_sess)
+                        self._snapshot_saver.save(self._snapshot_sess, path,
+                                                  write_meta_graph=False,
+                                                  write_state=write_state)
+                        if write_meta_graph and path not in self._exported_meta_paths:
+                            tf.train.export_meta_graph(
+                                filename=path + ".meta", graph=self.graph,
+                                saver_def=self.saver_def)
+                            self._exported_meta_paths.add(path)
+                    else:
+                        func, func_args = args
+                        func(*func_args)
+            except BaseException as error: # pylint: disable=broad-except
+                logger.exception("Background write failed")
+                self._error = error
+            finally:
+                self._jobs.task_done()
+        self._snapshot_sess.close()
+
+    def save(self, sess: tf.Session, path: str,
+             write_meta_graph: bool = True, write_state: bool = True) -> None:
+        """ Snapshots the variables in sess and queues them to be saved as a
+        checkpoint with the path prefix path, with the meta graph unless
+        write_meta_graph is False and recorded as a recent checkpoint unless
+        write_state is False. """
+
+        values = sess.run(self.variables)
+        self._jobs.put(("checkpoint", (path, values, write_meta_graph, write_state)))
+
+    def submit(self, func: Callable[..., Any], *args: Any) -> None:
+        """ Queues func(*args) to be called in the background thread. """
+
+        self._jobs.put(("call", (func, args)))
+
+    def flush(self) -> None:
+        """ Blocks until all queued jobs are done. """
+
+        self._jobs.join()
+        if self._error is not None:
+            error = self._error
+            self._error = None
+            raise error
+
+    def close(self) -> None:
+        """ Flushes outstanding jobs and stops the background thread. """
+
+        try:
+            self.flush()
+        finally:
+            if self._thread.is_alive():
+                self._jobs.put(None)
+                self._thread.join()
@@ -0,0 +1,199 @@
+""" An acoustic model with a convolutional front-end, a LSTM layer stack and
+a CTC output layer. """
+
+import os
+from typing import Union
+from pathlib import Path
+
+import numpy as np
+import tensorflow as tf
+
+from . import model
+from .exceptions import PersephoneException
+from .rnn_ctc import CELL_TYPES, lstm_cell, fused_bidirectional_rnn
+
+class Model(model.Model):
+    """ An acoustic model that applies strided 2-D convolutions over the
+    time x frequency x channel structure of the input features before a
+    smaller number of bidirectional LSTM layers than `rnn_ctc.Model` uses.
+
+    The convolutions parallelize well across CPU cores, and the time stride
+    shortens the sequences the recurrent layers have to step through, trading
+    a little accuracy for much higher throughput. Input and output tensors are
+    named as in `rnn_ctc.Model`, so `model.decode()` works unchanged on saved
+    models.
+    """
+
+    def __init__(self, exp_dir: Union[str, Path], corpus_reader,
+                 num_conv_layers: int = 2, num_filters: int = 32,
+                 time_stride: int = 2, num_channels: int = 3,
+                 num_layers: int = 1, hidden_size: int = 250,
+                 beam_width: int = 100, decoding_merge_repeated: bool = True,
+                 cell_type: str = "lstm") -> None:
+        """ Construct the convolutional LSTM/CTC graph.
+
+        Args:
+            exp_dir: The experiment directory that descriptions of the model,
+                     checkpoints and hypotheses are written to.
+            corpus_reader: The `CorpusReader` that feeds the model.
+            num_conv_layers: The number of 3x3 convolutional layers. Each
+                             layer halves the frequency resolution.
+            num_filters: The number of filters in each convolutional layer.
+            time_stride: The stride over time of the first convolutional
+                         layer. Label sequences must be no longer than the
+                         number of input frames divided by this.
+            num_channels: The number of channels flat features are made of.
+                          Flat fbank features are the static, delta and
+                          double delta filterbank energies concatenated, so
+                          this is 3 for them. Features stored as 3-D
+                          time x freq x channel arrays (as produced by
+                          `feat_extract.fbank(flat=False)`) are used as is.
+            num_layers: The number of bidirectional LSTM layers.
+            hidden_size: The number of LSTM units in each direction of each
+                         layer.
+            beam_width: The beam width used in CTC beam search decoding.
+            decoding_merge_repeated: Whether repeated labels are merged in
+                                     CTC beam search decoding.
+            cell_type: The LSTM implementation, as in `rnn_ctc.Model`.
+        """
+        super().__init__(exp_dir, corpus_reader)
+
+        if cell_type not in CELL_TYPES:
+            raise PersephoneException(
+                "cell_type %s not implemented. Use one of %s." % (
+                    cell_type, str(CELL_TYPES)))
+
+        if isinstance(exp_dir, Path):
+            exp_dir = str(exp_dir)
+        if not os.path.isdir(exp_dir):
+            os.makedirs(exp_dir)
+
+        # Increase vocab size by 2 since we need an extra for CTC blank labels
+        # and another extra for dynamic padding with zeros.
+        vocab_size = corpus_reader.corpus.vocab_size+2
+
+        # Reset the graph.
+        tf.reset_default_graph()
+
+        self.num_conv_layers = num_conv_layers
+        self.num_filters = num_filters
+        self.time_stride = time_stride
+        self.num_layers = num_layers
+        self.hidden_size = hidden_size
+        self.beam_width = beam_width
+        self.vocab_size = vocab_size
+        self.cell_type = cell_type
+
+        # The placeholder has the same layout as the features on disk so that
+        # they can be fed to a saved model without knowing its architecture.
+        feat_fn = corpus_reader.corpus.get_train_fns()[0][0]
+        feat_shape = np.load(feat_fn).shape[1:]
+        if len(feat_shape) == 2:
+            num_freqs, num_channels = feat_shape
+            self.batch_x = tf.placeholder(
+                    tf.float32, [None, None, num_freqs, num_channels],
+                    name="batch_x")
+            conv_input = self.batch_x
+        elif len(feat_shape) == 1:
+            num_feats = feat_shape[0]
+            if num_feats % num_channels != 0:
+                raise PersephoneException(
+                    "%d features per frame can't be divided into %d channels." % (
+                        num_feats, num_channels))
+            num_freqs = num_feats // num_channels
+            self.batch_x = tf.placeholder(
+                    tf.float32, [None, None, num_feats], name="batch_x")
+            # Flat features are channel major, so split out the channels
+            # before moving them to the last dimension.
+            batch_shape = tf.shape(self.batch_x)
+            conv_input = tf.reshape(
+                    self.batch_x,
+                    [batch_shape[0], batch_shape[1], num_channels, num_freqs])
+            conv_input = tf.transpose(conv_input, (0, 1, 3, 2))
+        else:
+            raise PersephoneException(
+                "Feature matrix of shape %s unexpected" % str(feat_shape))
+        self.num_freqs = num_freqs
+        self.num_channels = num_channels
+
+        self.batch_x_lens = tf.placeholder(tf.int32, [None], name="batch_x_lens")
+        self.batch_y = tf.sparse_placeholder(tf.int32)
+
+        batch_size = tf.shape(self.batch_x)[0]
+
+        layer_input = conv_input
+        for i in range(num_conv_layers):
+            with tf.variable_scope("conv_%d" % i): #type: ignore
+                layer_input = tf.layers.conv2d(
+                        layer_input, filters=num_filters, kernel_size=(3, 3),
+                        strides=(time_stride if i == 0 else 1, 2),
+                        padding="same", activation=tf.nn.relu)
+
+        # With "same" padding each utterance's output length is its input
+        # length divided by the stride, rounded up.
+        if num_conv_layers > 0:
+            self.output_lens = (self.batch_x_lens + time_stride - 1) // time_stride
+        else:
+            self.output_lens = self.batch_x_lens
+
+        # Flatten frequency and filters so that each time step is a vector.
+        conv_shape = tf.shape(layer_input)
+        conv_feats = layer_input.shape[2].value * layer_input.shape[3].value
+        layer_input = tf.reshape(
+                layer_input, [conv_shape[0], conv_shape[1], conv_feats])
+
+        for i in range(num_layers):
+
+            with tf.variable_scope("layer_%d" % i): #type: ignore
+
+                if cell_type == "lstm_block_fused":
+                    self.out_fw, self.out_bw = fused_bidirectional_rnn(
+                            self.hidden_size, layer_input, self.output_lens)
+                else:
+                    cell_fw = lstm_cell(self.hidden_size)
+                    cell_bw = lstm_cell(self.hidden_size)
+
+                    (self.out_fw, self.out_bw), _ = tf.nn.bidirectional_dynamic_rnn(
+                            cell_fw, cell_bw, layer_input, self.output_lens, dtype=tf.float32,
+                            time_major=False)
+
+                # Self outputs now becomes [batch_num, time, hidden_size*2]
+                self.outputs_concat = tf.concat((self.out_fw, self.out_bw), 2) #type: ignore
+
+                # For feeding into the next layer
+                layer_input = self.outputs_concat
+
+        self.outputs = tf.reshape(layer_input, [-1, self.hidden_size*2]) # pylint: disable=no-member
+
+        # Single-variable names are appropriate for weights an biases.
+        # pylint: disable=invalid-name
+        W = tf.Variable(tf.truncated_normal([hidden_size*2, vocab_size],
+                stddev=np.sqrt(2.0 / (2*hidden_size)))) #type: ignore
+        b = tf.Variable(tf.zeros([vocab_size])) #type: ignore
+        self.logits = tf.matmul(self.outputs, W) + b #type: ignore
+        self.logits = tf.reshape(self.logits, [batch_size, -1, vocab_size]) # pylint: disable=no-member
+        # Time major for the sake of ctc_loss.
+        self.logits = tf.transpose(self.logits, (1, 0, 2), name="logits") #type: ignore
+
+        # For lattice construction
+        self.log_softmax = tf.nn.log_softmax(self.logits)
+
+        self.decoded, self.log_prob = tf.nn.ctc_beam_search_decoder(
+                self.logits, self.output_lens, beam_width=beam_width,
+                merge_repeated=decoding_merge_repeated)
+
+        self.dense_decoded = tf.sparse_tensor_to_dense(self.decoded[0], name="hyp_dense_decoded")
+        self.dense_ref = tf.sparse_tensor_to_dense(self.batch_y)
+
+        # ignore_longer_outputs_than_inputs guards against utterances whose
+        # label sequences outgrow the strided time axis.
+        self.loss = tf.nn.ctc_loss(self.batch_y, self.logits, self.output_lens,
+                preprocess_collapse_repeated=False, ctc_merge_repeated=True,
+                ignore_longer_outputs_than_inputs=True)
+        self.cost = tf.reduce_mean(self.loss)
+        self.build_optimizer(self.cost)
+
+        self.ler = tf.reduce_mean(tf.edit_distance(
+                tf.cast(self.decoded[0], tf.int32), self.batch_y)) #type: ignore
+
+        self.write_desc()
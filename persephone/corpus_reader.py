@@ -6,7 +6,8 @@ import logging.config
 from pathlib import Path
 import pprint
 import random
-from typing import List, Sequence, Iterator
+import time
+from typing import Dict, List, Optional, Sequence, Iterator, Tuple
 
 import numpy as np
 
@@ -25,7 +26,8 @@ class CorpusReader:
 
     rand = True
 
-    def __init__(self, corpus, num_train=None, batch_size=None, max_samples=None, rand_seed=0):
+    def __init__(self, corpus, num_train=None, batch_size=None, max_samples=None, rand_seed=0,
+                 train_prefixes: Optional[Sequence[str]] = None):
         """ Construct a new `CorpusReader` instance.
 
             corpus: The Corpus object that interfaces with a given corpus.
@@ -36,9 +38,13 @@ class CorpusReader:
                          Longer utterances are filtered out.
             rand_seed: The seed for the random number generator. If None, then
                        no randomization is used.
+            train_prefixes: The prefixes of the utterances to train on. If
+                            None, then the corpus's training set is used.
         """
 
         self.corpus = corpus
+        if train_prefixes is None:
+            train_prefixes = corpus.train_prefixes
 
         if max_samples:
             logger.critical("max_samples not yet implemented in CorpusReader")
@@ -50,7 +56,7 @@ class CorpusReader:
         if not num_train:
             if not batch_size:
                 batch_size = 64
-            num_train = len(corpus.get_train_fns()[0])
+            num_train = len(train_prefixes)
             num_batches = int(num_train / batch_size)
             num_train = int(num_batches * batch_size)
         self.num_train = num_train
@@ -91,14 +97,20 @@ class CorpusReader:
         # a subset. Doing random selection of a subset of training now ensures
         # the selection of of training sentences is invariant between calls to
         # train_batch_gen()
-        self.train_fns = list(zip(*corpus.get_train_fns()))
+        train_prefixes = list(train_prefixes)
         if self.rand:
-            random.shuffle(self.train_fns)
-        self.train_fns = self.train_fns[:self.num_train]
+            random.shuffle(train_prefixes)
+        # The prefixes of the utterances actually trained on.
+        self.train_prefixes = train_prefixes[:self.num_train] # type: List[str]
+        self.train_fns = list(zip(*corpus.prefixes_to_fns(self.train_prefixes)))
 
-    def load_batch(self, fn_batch):
+    def load_batch(self, fn_batch, timings: Optional[Dict[str, float]] = None):
         """ Loads a batch with the given prefixes. The prefixes is the full path to the
         training example minus the extension.
+
+        If a timings dictionary is given, the seconds spent reading files are
+        stored under "data_load" and the seconds spent padding the features
+        and building the sparse targets under "feed_prep".
         """
 
         # TODO Assumes targets are available, which is how its distinct from
@@ -109,15 +121,23 @@ class CorpusReader:
         feat_fn_batch = inverse[0]
         target_fn_batch = inverse[1]
 
-        batch_inputs, batch_inputs_lens = utils.load_batch_x(feat_fn_batch,
-                                                             flatten=False)
+        start_time = time.perf_counter()
+        utterances = utils.load_utterances(feat_fn_batch)
         batch_targets_list = []
         for targets_path in target_fn_batch:
             with open(targets_path, encoding=ENCODING) as targets_f:
                 target_indices = self.corpus.labels_to_indices(targets_f.readline().split())
                 batch_targets_list.append(target_indices)
+        load_time = time.perf_counter()
+
+        batch_inputs, batch_inputs_lens = utils.pad_batch(utterances,
+                                                          flatten=False)
         batch_targets = utils.target_list_to_sparse_tensor(batch_targets_list)
 
+        if timings is not None:
+            timings["data_load"] = load_time - start_time
+            timings["feed_prep"] = time.perf_counter() - load_time
+
         return batch_inputs, batch_inputs_lens, batch_targets
 
 
@@ -126,8 +146,10 @@ class CorpusReader:
 
         return utils.make_batches(utterance_fns, self.batch_size)
 
-    def train_batch_gen(self) -> Iterator:
-        """ Returns a generator that outputs batches in the training data."""
+    def train_fn_batches(self) -> List[Sequence[Tuple[str, str]]]:
+        """ Groups the feature and label file paths of the training data into
+        batches, shuffled if `rand` is set. The batches can be loaded with
+        `load_batch()`."""
 
         if len(self.train_fns) == 0:
             raise PersephoneException("""No training data available; cannot
@@ -140,6 +162,13 @@ class CorpusReader:
         if self.rand:
             random.shuffle(fn_batches)
 
+        return fn_batches
+
+    def train_batch_gen(self) -> Iterator:
+        """ Returns a generator that outputs batches in the training data."""
+
+        fn_batches = self.train_fn_batches()
+
         for fn_batch in fn_batches:
             logger.debug("Batch of training filenames: %s",
                           pprint.pformat(fn_batch))
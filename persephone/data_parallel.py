@@ -0,0 +1,202 @@
+""" Synchronous data parallel training across processes on a single
+machine.
+
+A single small BiLSTM training step can't keep a many-core machine busy, so
+`Model.train(num_workers=N)` spreads each step over N batches: the training
+process computes gradients for one batch while N-1 worker processes compute
+gradients for the others. The gradients are averaged and every process
+applies the same averaged update, so all copies of the model stay in
+lockstep. Workers communicate with the training process over local pipes.
+
+The training process keeps sole ownership of batch shuffling, validation,
+checkpointing and early stopping, so those behave as they do when training
+in a single process.
+"""
+
+import logging
+import multiprocessing
+import os
+import traceback
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import tensorflow as tf
+
+from .exceptions import PersephoneException
+
+logger = logging.getLogger(__name__) # type: ignore
+
+def build_copy(model_factory: Callable[[], Any]) -> Any:
+    """ Builds a copy of the model being trained in another process. The
+    copy shares the training model's exp_dir, so it doesn't write a model
+    description there, which would overwrite the training model's own while
+    it trains. """
+
+    # Imported here since the model module imports this one.
+    from .model import Model
+    Model.write_descs = False
+    return model_factory()
+
+def _worker_main(model_factory: Callable[[], Any], conn: Any,
+                 num_threads: int) -> None:
+    """ The loop run by each worker process. Builds its own copy of the
+    model and then serves requests from the training process until told to
+    stop. Every request but "stop" gets a reply, so that a failure is
+    reported to the training process at the step that caused it. """
+
+    model = build_copy(model_factory)
+    config = tf.ConfigProto(intra_op_parallelism_threads=num_threads,
+                            inter_op_parallelism_threads=num_threads)
+    with tf.Session(config=config) as sess:
+        sess.run(tf.global_variables_initializer())
+        variables = tf.global_variables()
+        while True:
+            message, payload = conn.recv()
+            try:
+                if message == "variables":
+                    for var, value in zip(variables, payload):
+                        var.load(value, sess)
+                    conn.send(("ok", None))
+                elif message == "gradients":
+                    batch = model.corpus_reader.load_batch(payload)
+                    conn.send(("gradients",
+                               model.compute_gradients(sess, model.make_feed_dict(*batch))))
+                elif message == "apply":
+                    model.apply_gradients(sess, payload)
+                    conn.send(("ok", None))
+                elif message == "stop":
+                    break
+            except Exception: # pylint: disable=broad-except
+                conn.send(("error", traceback.format_exc()))
+
+class WorkerPool:
+    """ A pool of worker processes that each hold a copy of the model being
+    trained.
+
+    Args:
+        model_factory: A picklable callable that takes no arguments and
+                       returns the model to train, for example a
+                       `functools.partial` of `rnn_ctc.Model` with the same
+                       arguments used to construct the model in the training
+                       process. Each worker calls it to build its own graph,
+                       which must have the same variables as the model in the
+                       training process.
+        num_workers: The number of worker processes to start.
+        threads_per_worker: The number of threads each worker's Tensorflow
+                            session uses. Defaults to sharing the CPU cores
+                            evenly between the workers and the training
+                            process.
+
+    Processes are started with the "spawn" method, so scripts that train in
+    data parallel mode need an `if __name__ == "__main__":` guard.
+    """
+
+    def __init__(self, model_factory: Callable[[], Any], num_workers: int,
+                 threads_per_worker: int = None) -> None:
+        if num_workers < 1:
+            raise PersephoneException(
+                "A WorkerPool needs at least one worker, got %d." % num_workers)
+        if not threads_per_worker:
+            threads_per_worker = max(1, (os.cpu_count() or 1) // (num_workers + 1))
+
+        context = multiprocessing.get_context("spawn")
+        self.conns = [] # type: List[Any]
+        self.processes = [] # type: List[Any]
+        for _ in range(num_workers):
+            parent_conn, child_conn = context.Pipe()
+            process = context.Process(
+                target=_worker_main,
+                args=(model_factory, child_conn, threads_per_worker),
+                daemon=True)
+            process.start()
+            self.conns.append(parent_conn)
+            self.processes.append(process)
+        logger.info("Started %d data parallel workers", num_workers)
+
+    @property
+    def num_workers(self) -> int:
+        """ The number of worker processes in the pool. """
+        return len(self.processes)
+
+    def sync_variables(self, sess: tf.Session) -> None:
+        """ Copies the values of all the variables in the training process's
+        session, including optimizer state, to the workers. """
+
+        values = sess.run(tf.global_variables())
+        for conn in self.conns:
+            conn.send(("variables", values))
+        for conn in self.conns:
+            self._receive(conn)
+
+    def _receive(self, conn: Any) -> Any:
+        try:
+            message, payload = conn.recv()
+        except EOFError:
+            raise PersephoneException("A data parallel worker exited unexpectedly.")
+        if message == "error":
+            raise PersephoneException(
+                "A data parallel worker failed:\n%s" % payload)
+        return payload
+
+    def compute_gradients(self, sess: tf.Session, model: Any,
+                          fn_batches: Sequence[Sequence[Tuple[str, str]]],
+                          timings: Optional[Dict[str, float]] = None
+                         ) -> Tuple[List[np.ndarray], float]:
+        """ Computes gradients for up to `num_workers + 1` batches at once.
+        The first batch is handled by `model` in the training process and the
+        rest are handed to the workers. timings is passed to
+        `CorpusReader.load_batch()` for the first batch.
+
+        Returns:
+            A tuple of the gradients averaged over the batches and the mean
+            label error rate of the batches.
+        """
+
+        if len(fn_batches) > self.num_workers + 1:
+            raise PersephoneException(
+                "Can't compute gradients for %d batches with %d workers." % (
+                    len(fn_batches), self.num_workers))
+
+        busy_conns = self.conns[:len(fn_batches)-1]
+        for conn, fn_batch in zip(busy_conns, fn_batches[1:]):
+            conn.send(("gradients", fn_batch))
+        batch = model.corpus_reader.load_batch(fn_batches[0], timings)
+        results = [model.compute_gradients(sess, model.make_feed_dict(*batch))]
+        results.extend(self._receive(conn) for conn in busy_conns)
+
+        grads = [np.mean(batch_grads, axis=0)
+                 for batch_grads in zip(*[grads for grads, _ in results])]
+        ler = float(np.mean([ler for _, ler in results]))
+        return grads, ler
+
+    def apply_gradients(self, sess: tf.Session, model: Any,
+                        grads: Sequence[np.ndarray]) -> None:
+        """ Applies the same gradients to the model in the training process
+        and in every worker. """
+
+        for conn in self.conns:
+            conn.send(("apply", grads))
+        model.apply_gradients(sess, grads)
+        for conn in self.conns:
+            self._receive(conn)
+
+    def close(self) -> None:
+        """ Stops the worker processes. """
+
+        for conn in self.conns:
+            try:
+                conn.send(("stop", None))
+            except (BrokenPipeError, EOFError):
+                pass
+        for process in self.processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+        self.conns = []
+        self.processes = []
+
+    def __enter__(self) -> "WorkerPool":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
@@ -1,6 +1,8 @@
 """ An interface with the Na data. """
 
+import functools
 import logging
+import multiprocessing
 from pathlib import Path
 import os
 import random
@@ -64,6 +66,163 @@ INDICES_TO_PHONEMES = {index: phn for index, phn in enumerate(PHONEMES)}
 #TONES2INDICES = {tone: index for index, tone in enumerate(TONES)}
 #INDICES2TONES = {index: tone for index, tone in enumerate(TONES)}
 
+# Whether each label type keeps phonemes, tones and tone group markers.
+LABEL_TYPE_FLAGS = {
+    "phonemes_and_tones": (True, True, True),
+    "phonemes_and_tones_no_tgm": (True, True, False),
+    "phonemes": (True, False, False),
+    "tones": (False, True, True),
+    "tones_notgm": (False, True, False),
+}
+
+# Placeholder tokens in the rules of na_rules().
+_MATCHED = object()
+_BRACKET = object()
+# Keys of the actions stored in the nodes of a NaTokenizer's trie.
+_PREFIX = 0
+_END = 1
+
+def na_rules(label_type):
+    """ The rules for taking the next token off a Na sentence, in order of
+    precedence.
+
+    Each rule is a (length, patterns, token) triple. A rule applies when the
+    next length characters of the sentence, or all the rest of it if fewer
+    remain, are one of the patterns. It then consumes them and yields the
+    token, which is None for no token, or _MATCHED for the characters
+    themselves, except that a _BRACKET rule skips past the next closing
+    square bracket.
+    """
+
+    if label_type not in LABEL_TYPE_FLAGS:
+        raise ValueError("Unrecognized label type: %s" % label_type)
+    phonemes, tones, tgm = LABEL_TYPE_FLAGS[label_type]
+    phoneme_token = _MATCHED if phonemes else None
+    tone_token = _MATCHED if tones else None
+
+    rules = []
+    if phonemes:
+        # Treating fillers as single tokens; normalizing to əəə… and mmm…
+        rules.extend([(4, ["əəə…", "mmm…"], _MATCHED),
+                      (2, ["ə…"], "əəə…"),
+                      (2, ["m…"], "mmm…"),
+                      (3, ["mm…"], "mmm…")])
+    rules.extend([
+        # Normalizing some stuff
+        (3, ["wæ̃"], "w̃æ" if phonemes else None),
+        (3, ["ṽ̩"], "ṽ̩" if phonemes else None),
+        (3, TRI_PHNS, phoneme_token),
+        (2, BI_PHNS, phoneme_token),
+        (2, ["˧̩", "˧̍"], "˧"),
+        (1, UNI_PHNS, phoneme_token),
+        (2, BI_TONES, tone_token),
+        (1, UNI_TONES, tone_token),
+        # We assume these symbols cannot be captured.
+        (1, MISC_SYMBOLS, None),
+        (1, BAD_NA_SYMBOLS, None),
+        (1, PUNC_SYMBOLS, None),
+        (1, ["-", "ʰ", "/"], None),
+        # We keep everything literal, thus including what is in <>
+        # brackets; so we just remove these tokens
+        (1, ["<", ">"], None),
+        # Everything from an opening square bracket to the closing one is
+        # ignored.
+        (1, ["["], _BRACKET),
+        # Whitespace would identify words in word segmentation processing,
+        # but isn't kept as a label.
+        (1, [" ", "\t", "\n"], None),
+        # TODO Address extrametrical span symbol ◊ differently. For now,
+        # treating it as a tone group boundary marker for consistency with
+        # previous work.
+        (1, ["|", "ǀ", "◊"], "|" if tgm else None),
+        (1, ["(", ")"], None),
+    ])
+    return rules
+
+class NaTokenizer:
+    """ Tokenizes Na sentences for a label type, in a single scan over each
+    sentence.
+
+    The rules of `na_rules()` are compiled into a trie of their patterns, each
+    of whose nodes holds the highest precedence rule whose pattern is spelt
+    by the path to it. A pattern shorter than its rule's length only applies
+    at the end of a sentence, so these are kept apart. At each position of a
+    sentence, the trie is followed as far as the sentence allows and the
+    highest precedence rule found on the way is applied.
+
+    Args:
+        label_type: The type of labels to tokenize into.
+    """
+
+    def __init__(self, label_type):
+        self.label_type = label_type
+        self._trie = {}
+        for precedence, (length, patterns, token) in enumerate(na_rules(label_type)):
+            for pattern in patterns:
+                if not pattern or len(pattern) > length:
+                    # Such patterns can never be the next length characters.
+                    continue
+                node = self._trie
+                for char in pattern:
+                    node = node.setdefault(char, {})
+                kind = _PREFIX if len(pattern) == length else _END
+                if kind in node:
+                    # An earlier rule takes precedence.
+                    continue
+                if token is _MATCHED:
+                    node[kind] = (precedence, pattern, False)
+                elif token is _BRACKET:
+                    node[kind] = (precedence, None, True)
+                else:
+                    node[kind] = (precedence, token, False)
+
+    def tokenize(self, sent):
+        """ Tokenizes a sentence, returning its tokens separated by spaces. """
+
+        # Filter utterances with certain words
+        if "BEGAIEMENT" in sent:
+            return ""
+
+        tokens = []
+        pos = 0
+        while pos < len(sent):
+            best = None
+            best_end = pos
+            node = self._trie
+            end = pos
+            while end < len(sent):
+                node = node.get(sent[end])
+                if node is None:
+                    break
+                end += 1
+                action = node.get(_PREFIX)
+                if end == len(sent) and _END in node and (
+                        action is None or node[_END][0] < action[0]):
+                    action = node[_END]
+                if action is not None and (best is None or action[0] < best[0]):
+                    best = action
+                    best_end = end
+            if best is None:
+                print("***" + sent[pos:])
+                raise ValueError("Next character not recognized: " + sent[pos:pos+1])
+            _, token, skip_bracket = best
+            if skip_bracket:
+                close = sent.find("]", pos)
+                pos = len(sent) if close == -1 else close + 1
+            else:
+                pos = best_end
+                if token is not None:
+                    tokens.append(token)
+        return " ".join(tokens)
+
+    def __call__(self, sent):
+        return self.tokenize(sent)
+
+@functools.lru_cache(maxsize=None)
+def na_tokenizer(label_type):
+    """ The NaTokenizer for a label type, compiled on first use. """
+    return NaTokenizer(label_type)
+
 def preprocess_na(sent, label_type):
     """Preprocess Na sentences
 
@@ -71,140 +230,8 @@ def preprocess_na(sent, label_type):
         sent: A sentence
         label_type: The type of label provided
     """
-    if label_type == "phonemes_and_tones":
-        phonemes = True
-        tones = True
-        tgm = True
-    elif label_type == "phonemes_and_tones_no_tgm":
-        phonemes = True
-        tones = True
-        tgm = False
-    elif label_type == "phonemes":
-        phonemes = True
-        tones = False
-        tgm = False
-    elif label_type == "tones":
-        phonemes = False
-        tones = True
-        tgm = True
-    elif label_type == "tones_notgm":
-        phonemes = False
-        tones = True
-        tgm = False
-    else:
-        raise ValueError("Unrecognized label type: %s" % label_type)
 
-    def pop_phoneme(sentence):
-        """Pop phonemes off a sentence one at a time"""
-        # TODO desperately needs refactoring
-
-        # Treating fillers as single tokens; normalizing to əəə and mmm
-        if phonemes:
-            if sentence[:4] in ["əəə…", "mmm…"]:
-                return sentence[:4], sentence[4:]
-            if sentence.startswith("ə…"):
-                return "əəə…", sentence[2:]
-            if sentence.startswith("m…"):
-                return "mmm…", sentence[2:]
-            if sentence.startswith("mm…"):
-                return "mmm…", sentence[3:]
-
-        # Normalizing some stuff
-        if sentence[:3] == "wæ̃":
-            if phonemes:
-                return "w̃æ", sentence[3:]
-            else:
-                return None, sentence[3:]
-        if sentence[:3] == "ṽ̩":
-            if phonemes:
-                return "ṽ̩", sentence[3:]
-            else:
-                return None, sentence[3:]
-
-        if sentence[:3] in TRI_PHNS:
-            if phonemes:
-                return sentence[:3], sentence[3:]
-            else:
-                return None, sentence[3:]
-        if sentence[:2] in BI_PHNS:
-            if phonemes:
-                return sentence[:2], sentence[2:]
-            else:
-                return None, sentence[2:]
-        if sentence[:2] == "˧̩":
-            return "˧", sentence[2:]
-        if sentence[:2] == "˧̍":
-            return "˧", sentence[2:]
-        if sentence[0] in UNI_PHNS:
-            if phonemes:
-                return sentence[0], sentence[1:]
-            else:
-                return None, sentence[1:]
-        if sentence[:2] in BI_TONES:
-            if tones:
-                return sentence[:2], sentence[2:]
-            else:
-                return None, sentence[2:]
-        if sentence[0] in UNI_TONES:
-            if tones:
-                return sentence[0], sentence[1:]
-            else:
-                return None, sentence[1:]
-        if sentence[0] in MISC_SYMBOLS:
-            # We assume these symbols cannot be captured.
-            return None, sentence[1:]
-        if sentence[0] in BAD_NA_SYMBOLS:
-            return None, sentence[1:]
-        if sentence[0] in PUNC_SYMBOLS:
-            return None, sentence[1:]
-        if sentence[0] in ["-", "ʰ", "/"]:
-            return None, sentence[1:]
-        if sentence[0] in set(["<", ">"]):
-            # We keep everything literal, thus including what is in <>
-            # brackets; so we just remove these tokens"
-            return None, sentence[1:]
-        if sentence[0] == "[":
-            # It's an opening square bracket, so ignore everything until we
-            # find a closing one.
-            if sentence.find("]") == len(sentence)-1:
-                # If the closing bracket is the last char
-                return None, ""
-            else:
-                return None, sentence[sentence.find("]")+1:]
-        if sentence[0] in set([" ", "\t", "\n"]):
-            # Return a space char so that it can be identified in word segmentation
-            # processing.
-            return " ", sentence[1:]
-        if sentence[0] == "|" or sentence[0] == "ǀ" or sentence[0] == "◊":
-            # TODO Address extrametrical span symbol ◊ differently. For now,
-            # treating it as a tone group boundary marker for consistency with
-            # previous work.
-            if tgm:
-                return "|", sentence[1:]
-            else:
-                return None, sentence[1:]
-        if sentence[0] in "()":
-            return None, sentence[1:]
-        print("***" + sentence)
-        raise ValueError("Next character not recognized: " + sentence[:1])
-
-    def filter_for_phonemes(sentence):
-        """ Returns a sequence of phonemes and pipes (word delimiters). Tones,
-        syllable boundaries, whitespace are all removed."""
-
-        filtered_sentence = []
-        while sentence != "":
-            phoneme, sentence = pop_phoneme(sentence)
-            if phoneme != " ":
-                filtered_sentence.append(phoneme)
-        filtered_sentence = [item for item in filtered_sentence if item != None]
-        return " ".join(filtered_sentence)
-
-    # Filter utterances with certain words
-    if "BEGAIEMENT" in sent:
-        return ""
-    sent = filter_for_phonemes(sent)
-    return sent
+    return na_tokenizer(label_type).tokenize(sent)
 
 def preprocess_french(trans, fr_nlp, remove_brackets_content=True):
     """ Takes a list of sentences in french and preprocesses them."""
@@ -264,29 +291,44 @@ def trim_wavs(org_wav_dir=ORG_WAV_DIR,
                             start_time.to(ureg.milliseconds).magnitude,
                             end_time.to(ureg.milliseconds).magnitude)
 
-def prepare_labels(label_type, org_xml_dir=ORG_XML_DIR, label_dir=LABEL_DIR):
-    """ Prepare the neural network output targets."""
+def _prepare_xml_labels(args):
+    """ Writes the transcriptions of one Pangloss XML file as label files. """
+
+    path, label_type, label_dir = args
+    fn = path.name
+    prefix, _ = os.path.splitext(fn)
+
+    rec_type, sents, _, _ = pangloss.get_sents_times_and_translations(str(path))
+    # Write the sentence transcriptions to file
+    tokenizer = na_tokenizer(label_type)
+    sents = [tokenizer.tokenize(sent) for sent in sents]
+    for i, sent in enumerate(sents):
+        if sent.strip() == "":
+            # Then there's no transcription, so ignore this.
+            continue
+        out_fn = "%s.%d.%s" % (prefix, i, label_type)
+        sent_path = os.path.join(label_dir, rec_type, out_fn)
+        with open(sent_path, "w") as sent_f:
+            print(sent, file=sent_f)
+
+def prepare_labels(label_type, org_xml_dir=ORG_XML_DIR, label_dir=LABEL_DIR,
+                   num_processes=1):
+    """ Prepare the neural network output targets. The XML files can be
+    divided between num_processes processes."""
 
     if not os.path.exists(os.path.join(label_dir, "TEXT")):
         os.makedirs(os.path.join(label_dir, "TEXT"))
     if not os.path.exists(os.path.join(label_dir, "WORDLIST")):
         os.makedirs(os.path.join(label_dir, "WORDLIST"))
 
-    for path in Path(org_xml_dir).glob("*.xml"):
-        fn = path.name
-        prefix, _ = os.path.splitext(fn)
-
-        rec_type, sents, _, _ = pangloss.get_sents_times_and_translations(str(path))
-        # Write the sentence transcriptions to file
-        sents = [preprocess_na(sent, label_type) for sent in sents]
-        for i, sent in enumerate(sents):
-            if sent.strip() == "":
-                # Then there's no transcription, so ignore this.
-                continue
-            out_fn = "%s.%d.%s" % (prefix, i, label_type)
-            sent_path = os.path.join(label_dir, rec_type, out_fn)
-            with open(sent_path, "w") as sent_f:
-                print(sent, file=sent_f)
+    jobs = [(path, label_type, label_dir)
+            for path in Path(org_xml_dir).glob("*.xml")]
+    if num_processes > 1:
+        with multiprocessing.get_context("spawn").Pool(num_processes) as pool:
+            pool.map(_prepare_xml_labels, jobs)
+    else:
+        for job in jobs:
+            _prepare_xml_labels(job)
 
 # TODO Consider factoring out as non-Na specific.
 def prepare_untran(feat_type, tgt_dir, untran_dir):
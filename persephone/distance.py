@@ -1,4 +1,6 @@
-from typing import Any, Callable, List, Sequence, TypeVar, Tuple
+import multiprocessing
+from typing import (Any, Callable, Dict, Hashable, List, Optional, Sequence,
+                    TypeVar, Tuple)
 
 import numpy as np
 
@@ -6,16 +8,133 @@ from persephone.exceptions import EmptyReferenceException
 
 T = TypeVar("T")
 
+def _unit_cost(_x: Any) -> int:
+    return 1
+
+def _levenshtein_sub_cost(x: Any, y: Any) -> int:
+    return 0 if x == y else 1
+
+def encode_sequences(*batches: Sequence[Sequence[Hashable]]
+                    ) -> List[List[np.ndarray]]:
+    """ Encodes batches of sequences as integer arrays, with equal elements
+    across all the batches getting equal integers. """
+
+    codes = {} # type: Dict[Hashable, int]
+    return [[np.array([codes.setdefault(item, len(codes)) for item in seq],
+                      dtype=np.int64)
+             for seq in batch]
+            for batch in batches]
+
+def _pad(seqs: Sequence[np.ndarray], pad_value: int) -> np.ndarray:
+    """ Pads integer arrays to a [batch_size, max_len] array. """
+
+    padded = np.full((len(seqs), max([len(seq) for seq in seqs] + [0])),
+                     pad_value, dtype=np.int64)
+    for i, seq in enumerate(seqs):
+        padded[i, :len(seq)] = seq
+    return padded
+
+def _batch_edit_distance(sources: Sequence[np.ndarray],
+                         targets: Sequence[np.ndarray],
+                         costs: Tuple[int, int, int]) -> np.ndarray:
+    """ The edit distances between encoded source and target sequences.
+
+    The dynamic programming table of every pair is filled a source position
+    (row) at a time for the whole batch at once. Within a row, the cost of
+    reaching each cell from the row above is computed for all columns
+    together, and since deletions all cost the same, the best way of then
+    reaching each cell along the row is a running minimum.
+    """
+
+    ins_cost, del_cost, sub_cost = costs
+    source_lens = np.array([len(seq) for seq in sources])
+    target_lens = np.array([len(seq) for seq in targets])
+    # Different pad values for sources and targets, so that padding never
+    # matches, although padded cells never affect the results anyway.
+    source_arr = _pad(sources, -1)
+    target_arr = _pad(targets, -2)
+    batch_idx = np.arange(len(sources))
+    column_costs = del_cost * np.arange(target_arr.shape[1] + 1)
+
+    # The first row is the cost of making each target prefix from nothing.
+    row = np.tile(column_costs, (len(sources), 1))
+    distances = np.zeros(len(sources), dtype=np.int64)
+    done = source_lens == 0
+    distances[done] = row[done, target_lens[done]]
+    for i in range(1, source_arr.shape[1] + 1):
+        from_above = row + ins_cost
+        from_diagonal = row[:, :-1] + np.where(
+            source_arr[:, i-1:i] == target_arr, 0, sub_cost)
+        from_above[:, 1:] = np.minimum(from_above[:, 1:], from_diagonal)
+        row = np.minimum.accumulate(from_above - column_costs, axis=1) + column_costs
+        done = source_lens == i
+        distances[done] = row[batch_idx[done], target_lens[done]]
+    return distances
+
+def _batch_edit_distance_chunk(args: Tuple[Sequence[np.ndarray],
+                                           Sequence[np.ndarray],
+                                           Tuple[int, int, int]]) -> np.ndarray:
+    return _batch_edit_distance(*args)
+
+def batch_edit_distance(sources: Sequence[Sequence[Hashable]],
+                        targets: Sequence[Sequence[Hashable]], *,
+                        ins_cost: int = 1, del_cost: int = 1, sub_cost: int = 1,
+                        num_processes: int = 1) -> np.ndarray:
+    """ Calculates the minimum edit distances between pairs of sequences,
+    vectorized across the whole batch.
+
+    The costs are those of `min_edit_distance()`, but uniform: the same
+    whatever the elements involved.
+
+    Args:
+        sources: The first sequence of each pair.
+        targets: The second sequence of each pair.
+        ins_cost: The cost of an element of the source that isn't aligned to
+                  one in the target.
+        del_cost: The cost of an element of the target that isn't aligned to
+                  one in the source.
+        sub_cost: The cost of aligning two differing elements.
+        num_processes: The number of processes to divide the batch between.
+                       Worthwhile only for large batches, since the
+                       sequences are sent to each process.
+
+    Returns:
+        An integer array of the edit distance of each pair.
+    """
+
+    if len(sources) != len(targets):
+        raise ValueError("Got %d source sequences but %d target sequences." % (
+            len(sources), len(targets)))
+    if not sources:
+        return np.zeros(0, dtype=np.int64)
+    encoded_sources, encoded_targets = encode_sequences(sources, targets)
+    costs = (ins_cost, del_cost, sub_cost)
+    if num_processes <= 1 or len(sources) < 2 * num_processes:
+        return _batch_edit_distance(encoded_sources, encoded_targets, costs)
+
+    # Sorting by length keeps the padding in each chunk down.
+    order = np.argsort([len(seq) for seq in encoded_sources], kind="stable")
+    chunks = [(
+        [encoded_sources[i] for i in chunk_order],
+        [encoded_targets[i] for i in chunk_order],
+        costs) for chunk_order in np.array_split(order, num_processes)]
+    with multiprocessing.get_context("spawn").Pool(num_processes) as pool:
+        chunk_distances = pool.map(_batch_edit_distance_chunk, chunks)
+    distances = np.zeros(len(sources), dtype=np.int64)
+    distances[order] = np.concatenate(chunk_distances)
+    return distances
+
 def min_edit_distance(
         source: Sequence[T], target: Sequence[T],
-        ins_cost: Callable[..., int] = lambda _x: 1,
-        del_cost: Callable[..., int] = lambda _x: 1,
-        sub_cost: Callable[..., int] = lambda x, y: 0 if x == y else 1) -> int:
+        ins_cost: Callable[..., int] = _unit_cost,
+        del_cost: Callable[..., int] = _unit_cost,
+        sub_cost: Callable[..., int] = _levenshtein_sub_cost) -> int:
     """Calculates the minimum edit distance between two sequences.
 
     Uses the Levenshtein weighting as a default, but offers keyword arguments
     to supply functions to measure the costs for editing with different
-    elements.
+    elements. With the default costs the distance is computed by
+    `batch_edit_distance()`.
 
     Args:
         ins_cost: A function describing the cost of inserting a given char
@@ -27,11 +146,15 @@ def min_edit_distance(
 
     """
 
+    if (ins_cost is _unit_cost and del_cost is _unit_cost
+            and sub_cost is _levenshtein_sub_cost):
+        return int(batch_edit_distance([source], [target])[0])
+
     # Initialize an m+1 by n+1 array. Note that the strings start from index 1,
     # with index 0 being used to denote the empty string.
     n = len(target)
     m = len(source)
-    distance = np.zeros((m+1, n+1), dtype=np.int16)
+    distance = np.zeros((m+1, n+1), dtype=np.int64)
 
     # Initialize the zeroth row and column to be the distance from the empty
     # string.
@@ -50,6 +173,184 @@ def min_edit_distance(
 
     return int(distance[len(source), len(target)])
 
+# The backpointers of alignment tables, naming the neighbouring cell that
+# each cell's minimum came from.
+_DIAGONAL = 0
+_UP = 1
+_LEFT = 2
+# A distance larger than any real one, for cells outside the band.
+_OUT_OF_BAND = 2**40
+# The most backpointer bytes to hold for one chunk of a batch of alignments.
+_MAX_CHUNK_BYTES = 2**24
+
+def _table_size(source_len: int, target_len: int, band: Optional[int]) -> int:
+    """ The number of backpointers stored for a pair of sequences. """
+
+    width = target_len + 1
+    if band is not None:
+        width = min(width, 2 * (band + abs(source_len - target_len)) + 1)
+    return (source_len + 1) * width
+
+def _batch_align_pointers(sources: Sequence[np.ndarray],
+                          targets: Sequence[np.ndarray],
+                          band: Optional[int]) -> Tuple[np.ndarray, np.ndarray]:
+    """ Fills the backpointer tables of unit cost alignments between encoded
+    source and target sequences.
+
+    As in `_batch_edit_distance()`, the tables are filled a source position
+    at a time for the whole batch. Ties are broken as they always have been
+    by `min_edit_distance_align()`: a diagonal step is preferred to an up
+    step, which is preferred to a left step. With a band, only the cells
+    within band + |m - n| of the diagonal of each pair are filled, and only
+    a window of columns around the diagonal is stored for each row.
+
+    Returns:
+        A tuple of the backpointers, an array of shape [batch_size,
+        max_source_len + 1, width] in which the backpointer of cell (i, j) is
+        at index j - starts[i] of row i, and starts.
+    """
+
+    source_lens = np.array([len(seq) for seq in sources])
+    target_lens = np.array([len(seq) for seq in targets])
+    source_arr = _pad(sources, -1)
+    target_arr = _pad(targets, -2)
+    batch_size, max_source_len = source_arr.shape
+    max_target_len = target_arr.shape[1]
+
+    if band is None:
+        bands = np.full(batch_size, max(max_source_len, max_target_len))
+    else:
+        bands = band + np.abs(source_lens - target_lens)
+    max_band = int(bands.max())
+    width = min(max_target_len + 1, 2 * max_band + 1)
+    starts = np.clip(np.arange(max_source_len + 1) - max_band,
+                     0, max_target_len + 1 - width)
+    columns = np.arange(max_target_len + 1)
+
+    pointers = np.full((batch_size, max_source_len + 1, width), _LEFT,
+                       dtype=np.uint8)
+    row = np.full((batch_size, max_target_len + 1), _OUT_OF_BAND, dtype=np.int64)
+    row[:, :width] = columns[:width]
+    row[:, :width][columns[None, :width] > bands[:, None]] = _OUT_OF_BAND
+    for i in range(1, max_source_len + 1):
+        start = starts[i]
+        window = columns[start:start + width]
+        best = row[:, start:start + width] + 1
+        pointer = np.full(best.shape, _UP, dtype=np.uint8)
+        # Column 0 can only be reached from above.
+        first = 1 if start == 0 else 0
+        from_diagonal = row[:, start + first - 1:start + width - 1] + (
+            source_arr[:, i-1:i] != target_arr[:, start + first - 1:start + width - 1])
+        take_diagonal = from_diagonal <= best[:, first:]
+        best[:, first:][take_diagonal] = from_diagonal[take_diagonal]
+        pointer[:, first:][take_diagonal] = _DIAGONAL
+        outside = np.abs(i - window)[None, :] > bands[:, None]
+        best[outside] = _OUT_OF_BAND
+        # Only a strictly better left step displaces the others.
+        row_best = np.minimum.accumulate(best - window, axis=1) + window
+        pointer[row_best < best] = _LEFT
+        row_best[outside] = _OUT_OF_BAND
+        row = np.full((batch_size, max_target_len + 1), _OUT_OF_BAND, dtype=np.int64)
+        row[:, start:start + width] = row_best
+        pointers[:, i] = pointer
+    return pointers, starts
+
+def _trace_alignment(source: Sequence[str], target: Sequence[str],
+                     pointers: np.ndarray, starts: np.ndarray
+                    ) -> List[Tuple[str, str]]:
+    """ Follows a table of backpointers from its last cell to its first,
+    returning the alignment in order. """
+
+    alignment = []
+    i, j = len(source), len(target)
+    while i > 0 or j > 0:
+        pointer = pointers[i, j - starts[i]]
+        if pointer == _DIAGONAL:
+            alignment.append((source[i-1], target[j-1]))
+            i -= 1
+            j -= 1
+        elif pointer == _UP:
+            alignment.append((source[i-1], ""))
+            i -= 1
+        else:
+            alignment.append(("", target[j-1]))
+            j -= 1
+    alignment.reverse()
+    return alignment
+
+def _batch_align_chunk(args: Tuple[Sequence[Sequence[str]],
+                                   Sequence[Sequence[str]],
+                                   Optional[int]]
+                      ) -> List[List[Tuple[str, str]]]:
+    sources, targets, band = args
+    encoded_sources, encoded_targets = encode_sequences(sources, targets)
+    pointers, starts = _batch_align_pointers(encoded_sources, encoded_targets, band)
+    return [_trace_alignment(source, target, pointers[k], starts)
+            for k, (source, target) in enumerate(zip(sources, targets))]
+
+def batch_align(sources: Sequence[Sequence[str]],
+                targets: Sequence[Sequence[str]], *,
+                band: Optional[int] = None,
+                num_processes: int = 1) -> List[List[Tuple[str, str]]]:
+    """ Finds the alignment that `min_edit_distance_align()` finds with its
+    default costs for each pair of sequences, vectorized across the batch.
+
+    Args:
+        sources: The first sequence of each pair.
+        targets: The second sequence of each pair.
+        band: If given, alignments may stray at most this far, plus the
+              difference in length between the two sequences, from the
+              diagonal of the alignment table. This bounds the time and
+              memory taken for long sequences, but an alignment that
+              would stray further is replaced by the best one within the
+              band.
+        num_processes: The number of processes to divide the batch between.
+
+    Returns:
+        A list of the alignment of each pair, in the form returned by
+        `min_edit_distance_align()`.
+    """
+
+    if len(sources) != len(targets):
+        raise ValueError("Got %d source sequences but %d target sequences." % (
+            len(sources), len(targets)))
+    if band is not None and band < 0:
+        raise ValueError("The band can't be negative, got %d." % band)
+    if not sources:
+        return []
+
+    # Sorting by length keeps the padding in each chunk down.
+    order = sorted(range(len(sources)),
+                   key=lambda k: (len(sources[k]), len(targets[k])))
+    sizes = [_table_size(len(sources[k]), len(targets[k]), band) for k in order]
+    max_chunk_size = _MAX_CHUNK_BYTES
+    if num_processes > 1:
+        max_chunk_size = min(max_chunk_size, -(-sum(sizes) // num_processes))
+    chunk_orders = [] # type: List[List[int]]
+    chunk_size = 0
+    for k, size in zip(order, sizes):
+        # Pairs are padded to the largest table in their chunk.
+        chunk_size = max(chunk_size, size)
+        if chunk_orders and (len(chunk_orders[-1]) + 1) * chunk_size <= max_chunk_size:
+            chunk_orders[-1].append(k)
+        else:
+            chunk_orders.append([k])
+            chunk_size = size
+    chunks = [([sources[k] for k in chunk_order],
+               [targets[k] for k in chunk_order],
+               band) for chunk_order in chunk_orders]
+
+    if num_processes > 1 and len(chunks) > 1:
+        with multiprocessing.get_context("spawn").Pool(num_processes) as pool:
+            chunk_alignments = pool.map(_batch_align_chunk, chunks)
+    else:
+        chunk_alignments = [_batch_align_chunk(chunk) for chunk in chunks]
+    alignments = [[]] * len(sources) # type: List[List[Tuple[str, str]]]
+    for chunk_order, alignments_ in zip(chunk_orders, chunk_alignments):
+        for k, alignment in zip(chunk_order, alignments_):
+            alignments[k] = alignment
+    return alignments
+
 def min_edit_distance_align(
         # TODO Wrangle the typing errors in this function.
         # TODO This could work on generic sequences but for now it relies on
@@ -60,25 +361,35 @@ def min_edit_distance_align(
         #sub_cost: Callable[..., int] = lambda x, y: 0 if x == y else 1
         #) -> List[Tuple[str, str]]:
         source, target,
-        ins_cost = lambda _x: 1,
-        del_cost = lambda _x: 1,
-        sub_cost = lambda x, y: 0 if x == y else 1):
+        ins_cost = _unit_cost,
+        del_cost = _unit_cost,
+        sub_cost = _levenshtein_sub_cost,
+        band = None):
     """Finds a minimum cost alignment between two strings.
 
     Uses the Levenshtein weighting as a default, but offers keyword arguments
     to supply functions to measure the costs for editing with different
-    characters. Note that the alignment may not be unique.
+    characters. Note that the alignment may not be unique. With the default
+    costs the alignment is found by `batch_align()`.
 
     Args:
         ins_cost: A function describing the cost of inserting a given char
         del_cost: A function describing the cost of deleting a given char
         sub_cost: A function describing the cost of substituting one char for
+        band: Limits how far the alignment may stray from the diagonal, as
+              for `batch_align()`. Only supported with the default costs.
 
     Returns:
         A sequence of tuples representing character level alignments between
         the source and target strings.
     """
 
+    if (ins_cost is _unit_cost and del_cost is _unit_cost
+            and sub_cost is _levenshtein_sub_cost):
+        return batch_align([source], [target], band=band)[0]
+    if band is not None:
+        raise ValueError("A band is only supported with the default costs.")
+
     # Initialize an m+1 by n+1 array to hold the distances, and an equal sized
     # array to store the backpointers. Note that the strings start from index
     # 1, with index 0 being used to denote the empty string.
@@ -0,0 +1,397 @@
+""" Distilling a trained model into a smaller, faster one.
+
+A large `rnn_ctc.Model` transcribes accurately but slowly on modest
+hardware. Knowledge distillation trains a compact student, such as a
+shallower or narrower `rnn_ctc.Model` or a `conv_ctc.Model`, to match the
+frame level output distributions (posteriors) of the trained teacher. Since
+the teacher's posteriors don't need transcriptions, the student learns from
+the untranscribed recordings of the corpus as well as the transcribed ones.
+
+`distill()` runs the whole pipeline::
+
+    teacher = rnn_ctc.Model("exp/0", corpus_reader)
+    report = distill.distill(
+        teacher, "exp/0/model/model_best.ckpt",
+        lambda: rnn_ctc.Model("exp/1", corpus_reader, num_layers=2, hidden_size=120))
+
+It caches the teacher's posteriors over the training and untranscribed
+utterances, trains the student to match them, evaluates the student on the
+test set and writes a comparison of the two models' label error rates and
+decoding speeds to distillation_report.json in the student's experiment
+directory.
+
+The teacher and student must share a label set. A student whose output is
+strided in time, such as a `conv_ctc.Model`, is trained on the teacher's
+posteriors averaged over the frames of each of its output steps.
+"""
+
+import json
+import logging
+import os
+import random
+import sys
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import tensorflow as tf
+
+from . import model
+from . import utils
+from .config import ENCODING
+from .exceptions import PersephoneException
+
+logger = logging.getLogger(__name__) # type: ignore
+
+# The features are assumed to have a 10ms frame shift, as elsewhere.
+FRAME_SECONDS = 0.01
+
+def frame_stride(model_: model.Model) -> int:
+    """ The number of input frames per output frame of a model. """
+
+    if getattr(model_, "num_conv_layers", 0):
+        return model_.time_stride
+    return 1
+
+def _output_lens(model_: model.Model) -> tf.Tensor:
+    """ The tensor of the number of output frames of each utterance. """
+    return getattr(model_, "output_lens", model_.batch_x_lens)
+
+def _posteriors_path(cache_dir: Union[str, Path], prefix: str) -> Path:
+    """ Where the posteriors of an utterance are cached. """
+    return Path(cache_dir) / ("%s.posteriors.npy" % prefix)
+
+def cache_posteriors(teacher: model.Model, checkpoint_path: str,
+                     cache_dir: Union[str, Path], *,
+                     batch_size: Optional[int] = None,
+                     overwrite: bool = False) -> List[str]:
+    """ Computes and saves the teacher's log posteriors for every training
+    and untranscribed utterance of its corpus.
+
+    The log posteriors of each utterance are saved as a
+    [num_output_frames, vocab_size] array to <prefix>.posteriors.npy in
+    cache_dir, along with a description of the teacher in
+    posteriors.json.
+
+    Args:
+        teacher: The teacher model, whose graph must be the default graph.
+        checkpoint_path: The teacher checkpoint to restore.
+        cache_dir: The directory to save the posteriors to.
+        batch_size: The number of utterances to run the teacher on at once.
+                    Defaults to the teacher's training batch size.
+        overwrite: If False, utterances whose posteriors are already cached
+                   are skipped.
+
+    Returns:
+        The prefixes of the utterances with cached posteriors.
+    """
+
+    corpus = teacher.corpus_reader.corpus
+    prefixes = (list(teacher.corpus_reader.train_prefixes)
+                + list(corpus.untranscribed_prefixes))
+    feat_fns = (corpus.prefixes_to_fns(teacher.corpus_reader.train_prefixes)[0]
+                + corpus.get_untranscribed_fns())
+    if not batch_size:
+        batch_size = teacher.corpus_reader.batch_size
+
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    with (cache_dir / "posteriors.json").open("w", encoding=ENCODING) as desc_f:
+        json.dump({"teacher_checkpoint": str(checkpoint_path),
+                   "frame_stride": frame_stride(teacher),
+                   "vocab_size": teacher.vocab_size}, desc_f)
+
+    todo = [(prefix, feat_fn) for prefix, feat_fn in zip(prefixes, feat_fns)
+            if overwrite or not _posteriors_path(cache_dir, prefix).exists()]
+    logger.info("Caching teacher posteriors for %d of %d utterances",
+                len(todo), len(prefixes))
+    saver = tf.train.Saver()
+    with tf.Session(config=model.allow_growth_config) as sess:
+        saver.restore(sess, checkpoint_path)
+        for batch in utils.make_batches(todo, batch_size):
+            batch_x, batch_x_lens = utils.load_batch_x(
+                [feat_fn for _, feat_fn in batch], flatten=False)
+            # Time major, [num_frames, batch_size, vocab_size]
+            log_softmax, output_lens = sess.run(
+                [teacher.log_softmax, _output_lens(teacher)],
+                feed_dict=teacher.make_feed_dict(batch_x, batch_x_lens))
+            for i, (prefix, _) in enumerate(batch):
+                path = _posteriors_path(cache_dir, prefix)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                np.save(str(path), log_softmax[:output_lens[i], i].astype(np.float32))
+    return prefixes
+
+def pool_posteriors(log_posteriors: np.ndarray, factor: int) -> np.ndarray:
+    """ Averages the posteriors of each run of factor frames, for a student
+    whose output is that many times more strided than the teacher's.
+
+    Args:
+        log_posteriors: A [num_frames, vocab_size] array of log posteriors.
+        factor: The number of teacher frames per student frame.
+
+    Returns:
+        A [ceil(num_frames / factor), vocab_size] array of log posteriors.
+    """
+
+    if factor == 1:
+        return log_posteriors
+    starts = np.arange(0, len(log_posteriors), factor)
+    sums = np.add.reduceat(np.exp(log_posteriors), starts, axis=0)
+    counts = np.diff(np.append(starts, len(log_posteriors)))
+    return np.log(sums / counts[:, np.newaxis])
+
+def _load_posteriors(cache_dir: Union[str, Path], prefixes: Sequence[str],
+                     factor: int, num_frames: int) -> np.ndarray:
+    """ Loads the cached posteriors of a batch as a time major
+    [num_frames, batch_size, vocab_size] array, zero padded. """
+
+    utterances = [pool_posteriors(np.load(str(_posteriors_path(cache_dir, prefix))), factor)
+                  for prefix in prefixes]
+    batch = np.zeros((num_frames, len(utterances), utterances[0].shape[1]),
+                     dtype=np.float32)
+    for i, utterance in enumerate(utterances):
+        batch[:len(utterance), i] = utterance[:num_frames]
+    return batch
+
+def _build_distillation_ops(student: model.Model, vocab_size: int,
+                            temperature: float, ctc_weight: float
+                           ) -> Tuple[tf.Tensor, tf.Tensor, tf.Operation, tf.Operation]:
+    """ Adds the distillation loss and training ops to the student's graph.
+
+    Returns:
+        A tuple of the placeholder for the teacher's log posteriors, the
+        distillation loss, the op that trains on the distillation loss alone
+        and the op that trains on it mixed with the CTC loss.
+    """
+
+    teacher_log_probs = tf.placeholder(
+            tf.float32, [None, None, vocab_size], name="teacher_log_probs")
+    num_frames = tf.shape(student.logits)[0]
+    # [num_frames, batch_size]
+    mask = tf.transpose(tf.sequence_mask(
+            _output_lens(student), num_frames, dtype=tf.float32))
+    teacher_probs = tf.nn.softmax(teacher_log_probs / temperature)
+    student_log_probs = tf.nn.log_softmax(student.logits / temperature)
+    # Cross entropy differs from the KL divergence only by the teacher's
+    # entropy, which the student can't change. Scaling by the squared
+    # temperature keeps gradient magnitudes comparable across temperatures.
+    cross_entropy = -tf.reduce_sum(teacher_probs * student_log_probs, axis=2)
+    distill_loss = (tf.reduce_sum(cross_entropy * mask) / tf.reduce_sum(mask)
+                    * temperature ** 2)
+    optimizer = tf.train.AdamOptimizer(name="DistillAdam")
+    distill_op = optimizer.minimize(distill_loss)
+    mixed_loss = (1.0 - ctc_weight) * distill_loss + ctc_weight * student.cost
+    mixed_op = optimizer.minimize(mixed_loss)
+    return teacher_log_probs, distill_loss, distill_op, mixed_op
+
+def train_student(student: model.Model, cache_dir: Union[str, Path],
+                  prefixes: Sequence[str], *,
+                  temperature: float = 1.0,
+                  ctc_weight: float = 0.0,
+                  early_stopping_steps: int = 10,
+                  min_epochs: int = 10,
+                  max_epochs: int = 100) -> None:
+    """ Trains a student to match cached teacher posteriors, keeping the
+    checkpoint with the best validation LER as model/model_best.ckpt in the
+    student's experiment directory.
+
+    Args:
+        student: The student model, whose graph must be the default graph.
+        cache_dir: The directory `cache_posteriors()` saved posteriors to.
+        prefixes: The utterances to train on, all with cached posteriors.
+                  Those in the student's training set are transcribed.
+        temperature: The softmax temperature applied to both the teacher's
+                     and the student's outputs in the distillation loss.
+        ctc_weight: The weight of the CTC loss on transcriptions, for the
+                    transcribed utterances, against the distillation loss.
+        early_stopping_steps: As for `Model.train()`.
+        min_epochs: As for `Model.train()`.
+        max_epochs: As for `Model.train()`.
+    """
+
+    with (Path(cache_dir) / "posteriors.json").open(encoding=ENCODING) as desc_f:
+        teacher_desc = json.load(desc_f)
+    if teacher_desc["vocab_size"] != student.vocab_size:
+        raise PersephoneException(
+            "The teacher's vocabulary size of %d doesn't match the student's %d." % (
+                teacher_desc["vocab_size"], student.vocab_size))
+    if frame_stride(student) % teacher_desc["frame_stride"] != 0:
+        raise PersephoneException(
+            "The student's frame stride of %d isn't a multiple of the teacher's %d." % (
+                frame_stride(student), teacher_desc["frame_stride"]))
+    factor = frame_stride(student) // teacher_desc["frame_stride"]
+
+    corpus_reader = student.corpus_reader
+    corpus = corpus_reader.corpus
+    transcribed = set(corpus_reader.train_prefixes)
+    feat_fns = dict(zip(prefixes, corpus.prefixes_to_fns(list(prefixes))[0]))
+    # Transcribed and untranscribed utterances are batched separately, since
+    # only batches of transcribed utterances have a CTC loss.
+    prefix_groups = [[prefix for prefix in prefixes if prefix in transcribed],
+                     [prefix for prefix in prefixes if prefix not in transcribed]]
+
+    teacher_log_probs, distill_loss, distill_op, mixed_op = _build_distillation_ops(
+            student, student.vocab_size, temperature, ctc_weight)
+    stopping = model.EarlyStopping(early_stopping_steps=early_stopping_steps,
+                                   min_epochs=min_epochs, max_epochs=max_epochs,
+                                   max_valid_ler=1.0, max_train_ler=1.0)
+    valid_x, valid_x_lens, valid_y = corpus_reader.valid_batch()
+    model_dir = os.path.join(student.exp_dir, "model")
+    if not os.path.isdir(model_dir):
+        os.makedirs(model_dir)
+    best_path = os.path.join(model_dir, "model_best.ckpt")
+
+    saver = tf.train.Saver()
+    with tf.Session(config=model.allow_growth_config) as sess, \
+            open(os.path.join(student.exp_dir, "distill_log.txt"), "w",
+                 encoding=ENCODING) as out_file:
+        sess.run(tf.global_variables_initializer())
+        epoch = 0
+        while not stopping.stopped and epoch < max_epochs:
+            epoch += 1
+            print("\nexp_dir %s, distillation epoch %d" % (student.exp_dir, epoch))
+            batches = [(group_i, batch)
+                       for group_i, group in enumerate(prefix_groups)
+                       for batch in utils.make_batches(group, corpus_reader.batch_size)]
+            if corpus_reader.rand:
+                random.shuffle(batches)
+
+            loss_total = 0.0
+            train_lers = []
+            print("\tBatch...", end="")
+            for step_i, (group_i, batch) in enumerate(batches):
+                print("%d..." % step_i, end="")
+                sys.stdout.flush()
+                if group_i == 0:
+                    batch_x, batch_x_lens, batch_y = corpus_reader.load_batch(
+                        [(feat_fns[prefix], label_fn) for prefix, label_fn in
+                         zip(batch, corpus.prefixes_to_fns(batch)[1])])
+                    feed_dict = student.make_feed_dict(batch_x, batch_x_lens, batch_y)
+                    train_op = mixed_op if ctc_weight else distill_op
+                    fetches = [train_op, distill_loss, student.ler]
+                else:
+                    batch_x, batch_x_lens = utils.load_batch_x(
+                        [feat_fns[prefix] for prefix in batch], flatten=False)
+                    feed_dict = student.make_feed_dict(batch_x, batch_x_lens)
+                    fetches = [distill_op, distill_loss]
+                num_frames = -(-max(batch_x_lens) // frame_stride(student))
+                feed_dict[teacher_log_probs] = _load_posteriors(
+                    cache_dir, batch, factor, num_frames)
+                results = sess.run(fetches, feed_dict=feed_dict)
+                loss_total += results[1]
+                if group_i == 0:
+                    train_lers.append(results[2])
+            train_ler = float(np.mean(train_lers)) if train_lers else 0.0
+
+            valid_ler = sess.run(student.ler, feed_dict=student.make_feed_dict(
+                valid_x, valid_x_lens, valid_y))
+            epoch_str = ("Epoch %d. Distillation loss: %f, training LER: %f,"
+                         " validation LER: %f" % (
+                             epoch, loss_total / len(batches), train_ler, valid_ler))
+            print(epoch_str, flush=True, file=out_file)
+            if stopping.update(epoch, epoch_str, valid_ler, train_ler, out_file):
+                saver.save(sess, best_path)
+                student.saved_model_path = best_path
+        student.output_best_scores(stopping.best_epoch_str)
+
+def benchmark(model_: model.Model, checkpoint_path: str,
+              repeats: int = 3) -> Dict[str, Any]:
+    """ Measures a model's label error rate and decoding speed on its test
+    set.
+
+    Args:
+        model_: The model, whose graph must be the default graph.
+        checkpoint_path: The checkpoint to restore.
+        repeats: Decoding is timed over this many runs after a first,
+                 untimed one.
+
+    Returns:
+        A dictionary with the test set "ler", the mean "decode_seconds", the
+        "audio_seconds" decoded, the "real_time_factor" (decoding time over
+        audio duration) and the "num_parameters" of the model.
+    """
+
+    test_x, test_x_lens, test_y = model_.corpus_reader.test_batch()
+    saver = tf.train.Saver()
+    with tf.Session(config=model.allow_growth_config) as sess:
+        saver.restore(sess, checkpoint_path)
+        ler = sess.run(model_.ler,
+                       feed_dict=model_.make_feed_dict(test_x, test_x_lens, test_y))
+        feed_dict = model_.make_feed_dict(test_x, test_x_lens)
+        start_time = time.perf_counter()
+        for _ in range(repeats):
+            sess.run(model_.dense_decoded, feed_dict=feed_dict)
+        decode_seconds = (time.perf_counter() - start_time) / repeats
+    audio_seconds = float(sum(test_x_lens)) * FRAME_SECONDS
+    num_parameters = sum(int(np.prod(var.shape.as_list()))
+                         for var in tf.trainable_variables())
+    return {"ler": float(ler),
+            "decode_seconds": decode_seconds,
+            "audio_seconds": audio_seconds,
+            "real_time_factor": decode_seconds / audio_seconds,
+            "num_parameters": num_parameters}
+
+def distill(teacher: model.Model, teacher_checkpoint: str,
+            student_factory: Callable[[], model.Model], *,
+            cache_dir: Optional[Union[str, Path]] = None,
+            temperature: float = 1.0,
+            ctc_weight: float = 0.0,
+            early_stopping_steps: int = 10,
+            min_epochs: int = 10,
+            max_epochs: int = 100) -> Dict[str, Any]:
+    """ Trains a student model on a teacher's posteriors and compares the
+    two.
+
+    Args:
+        teacher: The trained teacher model, whose graph must be the default
+                 graph.
+        teacher_checkpoint: The teacher checkpoint to distill.
+        student_factory: Builds the student model. It's only called once the
+                         teacher is done with, since building a model resets
+                         the default graph.
+        cache_dir: Where the teacher's posteriors are cached. Defaults to the
+                   "posteriors" directory of the teacher's experiment
+                   directory.
+        temperature: As for `train_student()`.
+        ctc_weight: As for `train_student()`.
+        early_stopping_steps: As for `Model.train()`.
+        min_epochs: As for `Model.train()`.
+        max_epochs: As for `Model.train()`.
+
+    Returns:
+        The comparison of the teacher and student, as written to
+        distillation_report.json in the student's experiment directory:
+        `benchmark()` results for each, the student's "speedup" in decoding
+        and its "ler_increase" over the teacher.
+    """
+
+    if cache_dir is None:
+        cache_dir = os.path.join(teacher.exp_dir, "posteriors")
+    teacher_results = benchmark(teacher, teacher_checkpoint)
+    prefixes = cache_posteriors(teacher, teacher_checkpoint, cache_dir)
+
+    student = student_factory()
+    train_student(student, cache_dir, prefixes, temperature=temperature,
+                  ctc_weight=ctc_weight,
+                  early_stopping_steps=early_stopping_steps,
+                  min_epochs=min_epochs, max_epochs=max_epochs)
+    if not student.saved_model_path:
+        raise PersephoneException("No student checkpoint was saved.")
+    student_results = benchmark(student, student.saved_model_path)
+    student.eval(restore_model_path=student.saved_model_path)
+
+    report = {"teacher": teacher_results,
+              "student": student_results,
+              "speedup": teacher_results["decode_seconds"] / student_results["decode_seconds"],
+              "ler_increase": student_results["ler"] - teacher_results["ler"]}
+    with open(os.path.join(student.exp_dir, "distillation_report.json"), "w",
+              encoding=ENCODING) as report_f:
+        json.dump(report, report_f, indent=4)
+    for name in ("teacher", "student"):
+        logger.info("%s: LER %f, real time factor %f, %d parameters", name,
+                    report[name]["ler"], report[name]["real_time_factor"],
+                    report[name]["num_parameters"])
+    logger.info("Student decodes %.1fx as fast with %+f LER",
+                report["speedup"], report["ler_increase"])
+    return report
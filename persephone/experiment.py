@@ -1,16 +1,20 @@
 """ Miscellaneous functions for experiment management. """
 
+import logging
 import os
 
 from typing import Optional
 
 import persephone
+from . import batch_sizing
 from . import config
 from . import rnn_ctc
 from .corpus_reader import CorpusReader
 
 EXP_DIR = config.EXP_DIR # type: str
 
+logger = logging.getLogger(__name__) # type: ignore
+
 def get_exp_dir_num(parent_dir: str) -> int:
     """ Gets the number of the current experiment directory."""
     return max([int(fn.split(".")[0])
@@ -22,12 +26,18 @@ def _prepare_directory(directory_path: str) -> str:
     Prepare the directory structure required for the experiment
     :returns: returns the name of the newly created directory
     """
-    exp_num = get_exp_dir_num(directory_path)
-    exp_num = exp_num + 1
-    exp_dir = os.path.join(directory_path, str(exp_num))
-    if not os.path.isdir(exp_dir):
-        os.makedirs(exp_dir)
-    return exp_dir
+    if not os.path.isdir(directory_path):
+        os.makedirs(directory_path, exist_ok=True)
+    # Creating the directory is what claims its number, so that concurrent
+    # runs can't end up sharing one.
+    while True:
+        exp_num = get_exp_dir_num(directory_path) + 1
+        exp_dir = os.path.join(directory_path, str(exp_num))
+        try:
+            os.mkdir(exp_dir)
+        except FileExistsError:
+            continue
+        return exp_dir
 
 def prep_sub_exp_dir(parent_dir: str) -> str:
     """ Prepares an experiment subdirectory
@@ -54,7 +64,13 @@ def prep_exp_dir(directory=EXP_DIR):
 
     return exp_dir
 
-def get_simple_model(exp_dir, corpus):
+def get_simple_model(exp_dir, corpus, memory_limit: Optional[int] = None):
+    """ Builds an `rnn_ctc.Model` with settings that work well for most
+    corpora, choosing the batch size from the number of training utterances.
+
+    If memory_limit is given, in bytes, the batch size is also capped at the
+    largest that `batch_sizing.probe_max_batch_size()` finds fits within it.
+    """
     num_layers = 2
     hidden_size= 250
 
@@ -80,6 +96,16 @@ def get_simple_model(exp_dir, corpus):
                           hidden_size=hidden_size,
                           decoding_merge_repeated=True)
 
+    if memory_limit:
+        max_batch_size = batch_sizing.probe_max_batch_size(
+            model, memory_limit=memory_limit, max_batch_size=batch_size)
+        if max_batch_size < batch_size:
+            logger.info("Reducing batch size from %d to %d to fit in %d bytes",
+                        batch_size, max_batch_size, memory_limit)
+            # The graph doesn't depend on the batch size, so only the reader
+            # needs replacing.
+            model.corpus_reader = CorpusReader(corpus, batch_size=max_batch_size)
+
     return model
 
 def train_ready(corpus, directory=EXP_DIR):
@@ -0,0 +1,165 @@
+""" Updating a trained model when new transcriptions are added to its
+corpus, rather than training a new one from scratch.
+
+`Model.train` records the prefixes of the utterances it trained on in
+`train_prefixes.txt` in its experiment directory. When more utterances have
+been transcribed and the `Corpus` has been prepared again (with the new
+prefixes added to the corpus's own `train_prefixes.txt`, if it has one),
+`fine_tune()`
+compares the corpus's training set with that record to find the new
+utterances. It then carries on training the previous model's best checkpoint
+on the new utterances mixed with a random replay sample of the old ones, so
+that the model doesn't forget what it learnt from them, under a short early
+stopping schedule. The fine-tuned experiment directory records all the
+utterances seen so far, so that updates can be chained.
+"""
+
+import inspect
+import json
+import logging
+import math
+import os
+import random
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Union
+
+from . import conv_ctc
+from . import experiment
+from . import rnn_ctc
+from .config import ENCODING
+from .corpus import Corpus
+from .corpus_reader import CorpusReader
+from .exceptions import PersephoneException
+
+logger = logging.getLogger(__name__) # type: ignore
+
+MODEL_TYPES = {
+    str(rnn_ctc.Model): rnn_ctc.Model,
+    str(conv_ctc.Model): conv_ctc.Model,
+}
+
+def read_train_prefixes(exp_dir: Union[str, Path]) -> List[str]:
+    """ Reads the prefixes of the utterances a model in exp_dir was trained
+    on. """
+
+    prefixes_path = Path(exp_dir) / "train_prefixes.txt"
+    if not prefixes_path.is_file():
+        raise PersephoneException(
+            "No record of training utterances at %s. Was the model trained"
+            " with this version of persephone?" % prefixes_path)
+    with prefixes_path.open(encoding=ENCODING) as prefixes_f:
+        return [line.strip() for line in prefixes_f if line.strip()]
+
+def new_train_prefixes(corpus: Corpus, exp_dir: Union[str, Path]) -> List[str]:
+    """ The prefixes of utterances in the corpus's training set that the
+    model in exp_dir wasn't trained on. """
+
+    seen = set(read_train_prefixes(exp_dir))
+    return [prefix for prefix in corpus.train_prefixes if prefix not in seen]
+
+def _model_kwargs(model_class: Any, desc: Dict[str, Any]) -> Dict[str, Any]:
+    """ The constructor arguments of model_class recorded in a model
+    description. """
+
+    params = inspect.signature(model_class.__init__).parameters
+    return {key: desc[key] for key in params
+            if key not in ("self", "exp_dir", "corpus_reader") and key in desc}
+
+def fine_tune(corpus: Corpus, prev_exp_dir: Union[str, Path],
+              exp_dir: Optional[Union[str, Path]] = None, *,
+              replay_ratio: float = 1.0,
+              batch_size: Optional[int] = None,
+              early_stopping_steps: int = 3,
+              min_epochs: int = 1,
+              max_epochs: int = 20,
+              rand_seed: int = 0,
+              **train_kwargs: Any) -> Any:
+    """ Trains the best model in prev_exp_dir further on the utterances
+    added to the corpus since it was trained.
+
+    Args:
+        corpus: The corpus with the new transcriptions. Its label set, and
+                validation and test sets, should be those the previous model
+                was trained with.
+        prev_exp_dir: The experiment directory of the model to update.
+        exp_dir: The experiment directory for the updated model. Defaults to
+                 a new numbered directory next to prev_exp_dir.
+        replay_ratio: The number of previously seen utterances to train on,
+                      as a multiple of the number of new ones.
+        batch_size: The batch size. Defaults to the previous model's, capped
+                    at the number of utterances to train on.
+        early_stopping_steps: As for `Model.train()`, but shorter by default
+                              since the model starts out trained.
+        min_epochs: As for `Model.train()`.
+        max_epochs: As for `Model.train()`.
+        rand_seed: Seeds the replay sample and the batch shuffling.
+        train_kwargs: Other arguments to `Model.train()`.
+
+    Returns:
+        The updated model.
+    """
+
+    prev_exp_dir = str(prev_exp_dir)
+    prev_checkpoint = os.path.join(prev_exp_dir, "model", "model_best.ckpt")
+    if not os.path.exists(prev_checkpoint + ".index"):
+        raise PersephoneException("No trained model found at %s" % prev_checkpoint)
+
+    new_prefixes = new_train_prefixes(corpus, prev_exp_dir)
+    if not new_prefixes:
+        raise PersephoneException(
+            "The corpus has no training utterances that the model in %s"
+            " wasn't trained on." % prev_exp_dir)
+    seen_prefixes = read_train_prefixes(prev_exp_dir)
+    old_prefixes = sorted(set(corpus.train_prefixes) & set(seen_prefixes))
+    num_replay = min(len(old_prefixes), int(math.ceil(replay_ratio * len(new_prefixes))))
+    replay_prefixes = random.Random(rand_seed).sample(old_prefixes, num_replay)
+    logger.info("Fine tuning on %d new and %d replayed utterances",
+                len(new_prefixes), len(replay_prefixes))
+
+    with open(os.path.join(prev_exp_dir, "model_description.json"),
+              encoding=ENCODING) as desc_f:
+        desc = json.load(desc_f)
+    model_class = MODEL_TYPES.get(desc["model_type"])
+    if not model_class:
+        raise PersephoneException(
+            "Can't fine tune models of type %s" % desc["model_type"])
+    if desc.get("vocab_size") != corpus.vocab_size + 2:
+        raise PersephoneException(
+            "The corpus's label set isn't the one the model in %s was"
+            " trained with." % prev_exp_dir)
+
+    train_prefixes = new_prefixes + replay_prefixes
+    if not batch_size:
+        batch_size = _previous_batch_size(prev_exp_dir)
+    batch_size = min(batch_size, len(train_prefixes))
+    corpus_reader = CorpusReader(corpus, batch_size=batch_size,
+                                 rand_seed=rand_seed,
+                                 train_prefixes=train_prefixes)
+
+    if exp_dir is None:
+        exp_dir = experiment.prep_sub_exp_dir(os.path.dirname(os.path.abspath(prev_exp_dir)))
+    model = model_class(exp_dir, corpus_reader, **_model_kwargs(model_class, desc))
+    model.train(early_stopping_steps=early_stopping_steps,
+                min_epochs=min_epochs, max_epochs=max_epochs,
+                restore_model_path=prev_checkpoint, **train_kwargs)
+
+    # The updated model has seen everything the previous one had, plus the
+    # new utterances, whether or not they were in this run's batches.
+    with open(os.path.join(str(exp_dir), "train_prefixes.txt"), "w",
+              encoding=ENCODING) as prefixes_f:
+        for prefix in sorted(set(seen_prefixes) | set(new_prefixes)):
+            print(prefix, file=prefixes_f)
+
+    return model
+
+def _previous_batch_size(prev_exp_dir: str) -> int:
+    """ The batch size recorded in a previous run's train_description.txt,
+    or 16 if there isn't one. """
+
+    desc_path = os.path.join(prev_exp_dir, "train_description.txt")
+    if os.path.exists(desc_path):
+        with open(desc_path, encoding=ENCODING) as desc_f:
+            for line in desc_f:
+                if line.startswith("batch_size="):
+                    return int(line.strip().split("=", 1)[1])
+    return 16
@@ -1,23 +1,33 @@
 """ Generic model for automatic speech recognition. """
 
+import contextlib
 import inspect
-import itertools
+import json
 import logging
 import math
 import os
 from pathlib import Path
+import random
 import sys
-from typing import Callable, Optional, Union, Sequence, Set, List, Dict
+import time
+from typing import Any, Callable, Optional, Union, Sequence, Set, List, Dict, Tuple
 
 import tensorflow as tf
 
 from .preprocess import labels, feat_extract
 from . import utils
+from . import batch_sizing
+from . import budget
+from . import checkpointing
 from . import config
+from . import data_parallel
+from . import profiling
+from . import validation
 from .config import ENCODING
 from .corpus import Corpus
 from .exceptions import PersephoneException
 from .corpus_reader import CorpusReader
+from .telemetry import Telemetry, frame_stats, process_rss
 
 allow_growth_config = tf.ConfigProto(log_device_placement=False)
 allow_growth_config.gpu_options.allow_growth = True #pylint: disable=no-member
@@ -66,40 +76,21 @@ def decode_corpus(model_path_prefix: Union[str, Path],
            batch_x_lens_name=batch_x_lens_name,
            output_name=output_name)
 
-def decode(model_path_prefix: Union[str, Path],
-           input_paths: Sequence[Path],
-           label_set: Set[str],
-           *,
-           feature_type: str = "fbank", #TODO Make this None and infer feature_type from dimension of NN input layer.
-           batch_size: int = 64,
-           feat_dir: Optional[Path]=None,
-           batch_x_name: str="batch_x:0",
-           batch_x_lens_name: str="batch_x_lens:0",
-           output_name: str="hyp_dense_decoded:0") -> List[List[str]]:
-    """Use an existing tensorflow model that exists on disk to decode
-    WAV files.
+def prepare_input_feats(input_paths: Sequence[Path], feature_type: str,
+                        feat_dir: Optional[Path]=None) -> List[Path]:
+    """ Finds or extracts the features of WAV files to be decoded.
 
-    Args:
-        model_path_prefix: The path to the saved tensorflow model.
-                           This is the full prefix to the ".ckpt" file.
-        input_paths: A sequence of `pathlib.Path`s to WAV files to put through
-                     the model provided.
-        label_set: The set of all the labels this model uses.
-        feature_type: The type of features this model uses.
-                      Note that this MUST match the type of features that the
-                      model was trained on initially.
-        feat_dir: Any files that require preprocessing will be
-                                  saved to the path specified by this.
-        batch_x_name: The name of the tensorflow input for batch_x
-        batch_x_lens_name: The name of the tensorflow input for batch_x_lens
-        output_name: The name of the tensorflow output
+    Features are looked for in the "feat" directory next to each WAV's
+    directory, as per the filesystem conventions of a `Corpus`. WAVs without
+    them are converted and have their features extracted into feat_dir.
+
+    Returns:
+        The paths to the feature files, in the order of input_paths.
     """
 
     if not input_paths:
         raise PersephoneException("No untranscribed WAVs to transcribe.")
 
-    model_path_prefix = str(model_path_prefix)
-
     for p in input_paths:
         if not p.exists():
             raise PersephoneException(
@@ -130,22 +121,68 @@ def decode(model_path_prefix: Union[str, Path],
     if feat_dir:
         feat_extract.from_dir(feat_dir, feature_type)
 
+    return preprocessed_file_paths
+
+def decode(model_path_prefix: Union[str, Path],
+           input_paths: Sequence[Path],
+           label_set: Set[str],
+           *,
+           feature_type: str = "fbank", #TODO Make this None and infer feature_type from dimension of NN input layer.
+           batch_size: int = 64,
+           feat_dir: Optional[Path]=None,
+           batch_x_name: str="batch_x:0",
+           batch_x_lens_name: str="batch_x_lens:0",
+           output_name: str="hyp_dense_decoded:0",
+           profile_every: int = 0,
+           profile_dir: Optional[Path]=None) -> List[List[str]]:
+    """Use an existing tensorflow model that exists on disk to decode
+    WAV files.
+
+    Args:
+        model_path_prefix: The path to the saved tensorflow model.
+                           This is the full prefix to the ".ckpt" file.
+        input_paths: A sequence of `pathlib.Path`s to WAV files to put through
+                     the model provided.
+        label_set: The set of all the labels this model uses.
+        feature_type: The type of features this model uses.
+                      Note that this MUST match the type of features that the
+                      model was trained on initially.
+        feat_dir: Any files that require preprocessing will be
+                                  saved to the path specified by this.
+        batch_x_name: The name of the tensorflow input for batch_x
+        batch_x_lens_name: The name of the tensorflow input for batch_x_lens
+        output_name: The name of the tensorflow output
+        profile_every: Trace every this many decoding batches, starting with
+                       the first. If 0, nothing is traced. See
+                       `persephone.profiling`.
+        profile_dir: The directory traces are written to. Defaults to the
+                     "profile" directory of the experiment directory the
+                     model was saved in.
+    """
+
+    model_path_prefix = str(model_path_prefix)
+    preprocessed_file_paths = prepare_input_feats(input_paths, feature_type, feat_dir)
+
     fn_batches = utils.make_batches(preprocessed_file_paths, batch_size)
     # Load the model and perform decoding.
     metagraph = load_metagraph(model_path_prefix)
+    if not profile_dir:
+        profile_dir = Path(model_path_prefix).parent.parent / "profile"
+    profiler = profiling.StepProfiler(profile_dir, "decode", profile_every)
+    dense_decoded = [] # type: List[Sequence[int]]
     with tf.Session() as sess:
         metagraph.restore(sess, model_path_prefix)
 
         for fn_batch in fn_batches:
             batch_x, batch_x_lens = utils.load_batch_x(fn_batch)
 
-        # TODO These placeholder names should be a backup if names from a newer
-        # naming scheme aren't present. Otherwise this won't generalize to
-        # different architectures.
-        feed_dict = {batch_x_name: batch_x,
-                     batch_x_lens_name: batch_x_lens}
+            # TODO These placeholder names should be a backup if names from a newer
+            # naming scheme aren't present. Otherwise this won't generalize to
+            # different architectures.
+            feed_dict = {batch_x_name: batch_x,
+                         batch_x_lens_name: batch_x_lens}
 
-        dense_decoded = sess.run(output_name, feed_dict=feed_dict)
+            dense_decoded.extend(profiler.run(sess, output_name, feed_dict=feed_dict))
 
     # Create a human-readable representation of the decoded.
     indices_to_labels = labels.make_indices_to_labels(label_set)
@@ -153,6 +190,106 @@ def decode(model_path_prefix: Union[str, Path],
 
     return human_readable
 
+def write_transcripts(path: Union[str, Path], transcripts: Sequence[Sequence[str]]) -> None:
+    """ Writes transcriptions to a file, one per line, with labels separated
+    by spaces. """
+
+    with open(str(path), "w", encoding=ENCODING) as out_f:
+        for transcript in transcripts:
+            print(" ".join(transcript), file=out_f)
+
+class EarlyStopping:
+    """ Tracks the best validation label error rate seen during training and
+    decides when training should stop.
+
+    Args:
+        early_stopping_steps: Stop training after this number of epochs
+                              without an improvement in validation LER.
+        min_epochs: The minimum number of epochs to train for.
+        max_epochs: The maximum number of epochs to train for.
+        max_valid_ler: Training doesn't stop early until the validation LER
+                       is at most this.
+        max_train_ler: Training doesn't stop early until the training LER is
+                       at most this.
+
+    Attributes:
+        best_valid_ler: The lowest validation LER seen so far.
+        best_epoch_str: The log line describing the epoch with the best
+                        validation LER.
+        steps_since_last_record: The number of epochs since the validation
+                                 LER last improved.
+        stopped: Whether a stopping condition has been met.
+    """
+
+    def __init__(self, *, early_stopping_steps: int, min_epochs: int,
+                 max_epochs: int, max_valid_ler: float,
+                 max_train_ler: float) -> None:
+        self.early_stopping_steps = early_stopping_steps
+        self.min_epochs = min_epochs
+        self.max_epochs = max_epochs
+        self.max_valid_ler = max_valid_ler
+        self.max_train_ler = max_train_ler
+        self.best_valid_ler = 2.0
+        self.best_epoch_str = None # type: Optional[str]
+        self.steps_since_last_record = 0
+        self.stopped = False
+
+    def update(self, epoch: int, epoch_str: str, valid_ler: float,
+               train_ler: float, out_file: Any) -> bool:
+        """ Records the validation and training LER of an epoch, logging
+        progress to out_file.
+
+        Returns:
+            True if valid_ler is the best validation LER so far.
+        """
+
+        if self.best_epoch_str is None:
+            self.best_epoch_str = epoch_str
+
+        if valid_ler < self.best_valid_ler:
+            print("New best valid_ler", file=out_file)
+            self.best_valid_ler = valid_ler
+            self.best_epoch_str = epoch_str
+            self.steps_since_last_record = 0
+            return True
+
+        print("Steps since last best valid_ler: %d" % (self.steps_since_last_record), file=out_file)
+        self.steps_since_last_record += 1
+        if epoch >= self.max_epochs:
+            self.stopped = True
+        elif (self.steps_since_last_record >= self.early_stopping_steps
+              # Then we've done the minimum number of epochs.
+              and epoch >= self.min_epochs
+              # Then training error has moved sufficiently towards
+              # convergence.
+              and valid_ler <= self.max_valid_ler
+              and train_ler <= self.max_train_ler):
+            print("Stopping since best validation score hasn't been"
+                " beaten in %d epochs and at least %d have been"
+                " done. The valid ler (%d) is below %d and"
+                " the train ler (%d) is below %d." %
+                (self.early_stopping_steps, self.min_epochs, valid_ler,
+                self.max_valid_ler, train_ler, self.max_train_ler),
+                file=out_file, flush=True)
+            self.stopped = True
+        return False
+
+    def get_state(self) -> Dict[str, Any]:
+        """ The early stopping state, for saving with `set_state()`. """
+
+        return {"best_valid_ler": self.best_valid_ler,
+                "best_epoch_str": self.best_epoch_str,
+                "steps_since_last_record": self.steps_since_last_record,
+                "stopped": self.stopped}
+
+    def set_state(self, state: Dict[str, Any]) -> None:
+        """ Restores early stopping state returned by `get_state()`. """
+
+        self.best_valid_ler = state["best_valid_ler"]
+        self.best_epoch_str = state["best_epoch_str"]
+        self.steps_since_last_record = state["steps_since_last_record"]
+        self.stopped = state["stopped"]
+
 class Model:
     """ Generic model for our ASR tasks.
 
@@ -171,12 +308,24 @@ class Model:
         optimizer: The gradient descent method being used. (Typically we use Adam
                    because it has provided good results but any stochastic gradient
                    descent method could be substituted here)
+        gradients: The gradients of the cost with respect to each trainable
+                   variable, for when gradients are combined across batches
+                   before an update.
+        gradient_placeholders: Placeholders to feed combined gradients to
+                               apply_gradients_op.
+        apply_gradients_op: Applies the gradients fed to gradient_placeholders
+                            using the same optimizer state as optimizer.
         ler: Label error rate.
         dense_decoded: Dense representation of the model transcription output.
         dense_ref: Dense representation of the reference transcription.
         saved_model_path: Path to where the Tensorflow model is being saved on disk.
     """
 
+    # Whether building a model writes its description to the exp_dir. Worker
+    # and evaluator processes turn this off, since their copies of the model
+    # share the exp_dir of the model being trained.
+    write_descs = True
+
     def __init__(self, exp_dir: Union[Path, str], corpus_reader: CorpusReader) -> None:
         self.exp_dir = str(exp_dir) if isinstance(exp_dir, Path) else exp_dir # type: str
         self.corpus_reader = corpus_reader
@@ -189,6 +338,99 @@ class Model:
         self.dense_decoded = None
         self.dense_ref = None
         self.saved_model_path = "" # type: str
+        self.gradients = [] # type: List[tf.Tensor]
+        self.gradient_placeholders = [] # type: List[tf.Tensor]
+        self.apply_gradients_op = None
+
+    def build_optimizer(self, cost: tf.Tensor) -> None:
+        """ Creates the Adam training op that minimizes cost, as well as ops
+        to compute gradients and apply supplied gradients as separate steps.
+        Subclasses should call this once the cost is defined.
+        """
+
+        adam = tf.train.AdamOptimizer()
+        grads_and_vars = [(grad, var) for grad, var in adam.compute_gradients(cost)
+                          if grad is not None]
+        self.optimizer = adam.apply_gradients(grads_and_vars)
+        self.gradients = [grad for grad, _ in grads_and_vars]
+        self.gradient_placeholders = [
+            tf.placeholder(var.dtype.base_dtype, var.shape)
+            for _, var in grads_and_vars]
+        # Reusing the same AdamOptimizer means its slot variables are shared
+        # with the training op rather than duplicated.
+        self.apply_gradients_op = adam.apply_gradients(
+            zip(self.gradient_placeholders, [var for _, var in grads_and_vars]))
+
+    def make_feed_dict(self, batch_x, batch_x_lens, batch_y=None) -> Dict:
+        """ Makes a feed dict for the model's input placeholders from a batch
+        as loaded by the `CorpusReader`. The reference labels are optional
+        since they aren't needed for transcription."""
+
+        feed_dict = {self.batch_x: batch_x,
+                     self.batch_x_lens: batch_x_lens}
+        if batch_y is not None:
+            feed_dict[self.batch_y] = batch_y
+        return feed_dict
+
+    def compute_gradients(self, sess: tf.Session, feed_dict: Dict) -> Tuple[List, float]:
+        """ Computes the gradients for a batch without updating the model.
+
+        Returns:
+            A tuple of the gradients of each trainable variable and the label
+            error rate of the batch.
+        """
+
+        *grads, ler = sess.run(self.gradients + [self.ler], feed_dict=feed_dict)
+        return grads, ler
+
+    def apply_gradients(self, sess: tf.Session, grads: Sequence) -> None:
+        """ Updates the model with the supplied gradients, such as those
+        returned by `compute_gradients()`."""
+
+        sess.run(self.apply_gradients_op,
+                 feed_dict=dict(zip(self.gradient_placeholders, grads)))
+
+    def write_desc(self) -> None:
+        """ Writes a description of the model to the exp_dir. The topology
+        section of model_description.json names the input and output tensors
+        that `decode()` needs to run a saved model."""
+
+        if not self.write_descs:
+            return
+        path = os.path.join(self.exp_dir, "model_description.txt")
+        with open(path, "w") as desc_f:
+            for key, val in self.__dict__.items():
+                print("%s=%s" % (key, val), file=desc_f)
+
+        json_path = os.path.join(self.exp_dir, "model_description.json")
+        desc = { } #type: Dict[str, Any]
+        # For use in decoding from a saved model
+        desc["topology"] = {
+            "batch_x_name" : self.batch_x.name, #type: ignore
+            "batch_x_lens_name" : self.batch_x_lens.name, #type: ignore
+            "dense_decoded_name" : self.dense_decoded.name #type: ignore
+        }
+        desc["model_type"] = str(self.__class__)
+        for key, val in self.__dict__.items():
+            if isinstance(val, int):
+                desc[str(key)] = val
+            elif isinstance(val, tf.Tensor):
+                desc[key] = {
+                    "type": "tf.Tensor",
+                    "name": val.name, #type: ignore
+                    "shape": str(val.shape), #type: ignore
+                    "dtype" : str(val.dtype), #type: ignore
+                    "value" : str(val),
+                }
+            elif isinstance(val, tf.SparseTensor): #type: ignore
+                desc[key] = {
+                    "type": "tf.SparseTensor",
+                    "value": str(val), #type: ignore
+                }
+            else:
+                desc[str(key)] = str(val)
+        with open(json_path, "w") as json_desc_f:
+            json.dump(desc, json_desc_f, skipkeys=True)
 
     def transcribe(self, restore_model_path: Optional[str]=None) -> None:
         """ Transcribes an untranscribed dataset. Similar to eval() except
@@ -212,8 +454,7 @@ class Model:
 
                 batch_x, batch_x_lens, feat_fn_batch = batch
 
-                feed_dict = {self.batch_x: batch_x,
-                             self.batch_x_lens: batch_x_lens}
+                feed_dict = self.make_feed_dict(batch_x, batch_x_lens)
 
                 [dense_decoded] = sess.run([self.dense_decoded], feed_dict=feed_dict)
                 hyps = self.corpus_reader.human_readable(dense_decoded)
@@ -253,8 +494,17 @@ class Model:
                batch_x_lens_name=batch_x_lens_name,
                output_name=output_name)
  
-    def eval(self, restore_model_path: Optional[str]=None) -> None:
-        """ Evaluates the model on a test set."""
+    def eval(self, restore_model_path: Optional[str]=None,
+             profile_every: int = 0) -> None:
+        """ Evaluates the model on a test set.
+
+        Args:
+            restore_model_path: The checkpoint to evaluate. Defaults to the
+                                one saved by the last call to train().
+            profile_every: If greater than 0, the test set decoding step is
+                           traced and written to the "profile" directory of
+                           exp_dir. See `persephone.profiling`.
+        """
 
         saver = tf.train.Saver()
         with tf.Session(config=allow_growth_config) as sess:
@@ -268,12 +518,12 @@ class Model:
 
             test_x, test_x_lens, test_y = self.corpus_reader.test_batch()
 
-            feed_dict = {self.batch_x: test_x,
-                         self.batch_x_lens: test_x_lens,
-                         self.batch_y: test_y}
+            feed_dict = self.make_feed_dict(test_x, test_x_lens, test_y)
 
-            test_ler, dense_decoded, dense_ref = sess.run(
-                [self.ler, self.dense_decoded, self.dense_ref],
+            profiler = profiling.StepProfiler(
+                os.path.join(self.exp_dir, "profile"), "eval", profile_every)
+            test_ler, dense_decoded, dense_ref = profiler.run(
+                sess, [self.ler, self.dense_decoded, self.dense_ref],
                 feed_dict=feed_dict)
             hyps, refs = self.corpus_reader.human_readable_hyp_ref(
                 dense_decoded, dense_ref)
@@ -281,14 +531,8 @@ class Model:
             hyps_dir = os.path.join(self.exp_dir, "test")
             if not os.path.isdir(hyps_dir):
                 os.mkdir(hyps_dir)
-            with open(os.path.join(hyps_dir, "hyps"), "w",
-                      encoding=ENCODING) as hyps_f:
-                for hyp in hyps:
-                    print(" ".join(hyp), file=hyps_f)
-            with open(os.path.join(hyps_dir, "refs"), "w",
-                      encoding=ENCODING) as refs_f:
-                for ref in refs:
-                    print(" ".join(ref), file=refs_f)
+            write_transcripts(os.path.join(hyps_dir, "hyps"), hyps)
+            write_transcripts(os.path.join(hyps_dir, "refs"), refs)
 
             test_per = utils.batch_per(hyps, refs)
             if not math.isclose(test_per, test_ler, rel_tol=1e-07):
@@ -306,10 +550,233 @@ class Model:
                   "w", encoding=ENCODING) as best_f:
             print(best_epoch_str, file=best_f, flush=True)
 
+    def _group_gradients(self, sess: tf.Session,
+                         fn_batches: Sequence[Sequence[Tuple[str, str]]],
+                         pool: Optional[data_parallel.WorkerPool] = None,
+                         timings: Optional[Dict[str, float]] = None
+                        ) -> Tuple[List, float]:
+        """ Computes the gradients of a group of batches, averaged over them,
+        working through the group a batch per process at a time so that
+        only that many batches are in memory at once. timings is passed to
+        `CorpusReader.load_batch()` for the first batch.
+
+        Returns:
+            A tuple of the mean gradients and the mean label error rate of
+            the batches.
+        """
+
+        per_call = pool.num_workers + 1 if pool else 1
+        total_grads = None # type: Optional[List]
+        total_ler = 0.0
+        for start in range(0, len(fn_batches), per_call):
+            call_batches = fn_batches[start:start+per_call]
+            call_timings = timings if start == 0 else None
+            if pool:
+                grads, ler = pool.compute_gradients(sess, self, call_batches, call_timings)
+            else:
+                try:
+                    batch = self.corpus_reader.load_batch(call_batches[0], call_timings)
+                    grads, ler = self.compute_gradients(sess, self.make_feed_dict(*batch))
+                except tf.errors.ResourceExhaustedError:
+                    if len(call_batches[0]) < 2:
+                        raise
+                    logger.warning("Ran out of memory computing gradients for a batch"
+                                   " of %d utterances, splitting it", len(call_batches[0]))
+                    grads, ler = batch_sizing.compute_gradients_split(
+                        self, sess, call_batches[0], split=True)
+            # Gradients from the pool are already averaged over its batches.
+            weight = len(call_batches)
+            if total_grads is None:
+                total_grads = [weight * grad for grad in grads]
+            else:
+                for grad_i, grad in enumerate(grads):
+                    total_grads[grad_i] += weight * grad
+            total_ler += weight * ler
+        return ([grad / len(fn_batches) for grad in total_grads], # type: ignore
+                total_ler / len(fn_batches))
+
+    def _train_epoch(self, sess: tf.Session,
+                     pool: Optional[data_parallel.WorkerPool] = None,
+                     telemetry: Optional[Telemetry] = None,
+                     epoch: int = 0,
+                     profiler: Optional[profiling.StepProfiler] = None,
+                     accumulate_steps: int = 1
+                    ) -> Tuple[float, float]:
+        """ Makes one pass over the training data, updating the model.
+
+        Args:
+            sess: The training session.
+            pool: If given, each step averages the gradients of a batch per
+                  process in the pool.
+            telemetry: If given, a record of each step and of the epoch as a
+                       whole is written to it.
+            epoch: The epoch number used in telemetry records.
+            profiler: If given, runs the training steps, tracing those that
+                      are due. Steps in data parallel training aren't traced.
+            accumulate_steps: The number of batches (or, with a pool, rounds
+                              of a batch per process) whose gradients are
+                              averaged for each update.
+
+        Returns:
+            A tuple of the mean label error rate over the epoch's steps and
+            the label error rate of the last step.
+        """
+
+        print("\tBatch...", end="")
+        epoch_start = time.perf_counter()
+        train_ler_total = 0.0
+        ler = 0.0
+        num_steps = 0
+        num_frames = 0
+        fn_batches = self.corpus_reader.train_fn_batches()
+        # Each step consumes a batch for the training process and one for
+        # each worker, accumulate_steps times over.
+        group_size = (pool.num_workers + 1 if pool else 1) * accumulate_steps
+        accumulate = pool is not None or accumulate_steps > 1
+        for step_i, start in enumerate(range(0, len(fn_batches), group_size)):
+            print("%d..." % step_i, end="")
+            sys.stdout.flush()
+
+            timings = {} # type: Dict[str, float]
+            step_stats = {} # type: Dict[str, Any]
+            if accumulate:
+                run_start = time.perf_counter()
+                grads, ler = self._group_gradients(
+                    sess, fn_batches[start:start+group_size], pool, timings)
+                if pool:
+                    pool.apply_gradients(sess, self, grads)
+                else:
+                    self.apply_gradients(sess, grads)
+                loss = None
+            else:
+                batch = self.corpus_reader.load_batch(fn_batches[start], timings)
+                feed_dict = self.make_feed_dict(*batch)
+                run_start = time.perf_counter()
+                fetches = [self.optimizer, self.ler, self.cost]
+                try:
+                    if profiler:
+                        _, ler, loss = profiler.run(sess, fetches, feed_dict=feed_dict)
+                    else:
+                        _, ler, loss = sess.run(fetches, feed_dict=feed_dict)
+                    loss = float(loss)
+                except tf.errors.ResourceExhaustedError:
+                    if len(fn_batches[start]) < 2:
+                        raise
+                    # Rather than abandon training, update the model with
+                    # gradients computed over parts of the batch.
+                    logger.warning("Ran out of memory training on a batch of %d"
+                                   " utterances, splitting it", len(fn_batches[start]))
+                    grads, ler = batch_sizing.compute_gradients_split(
+                        self, sess, fn_batches[start], split=True)
+                    self.apply_gradients(sess, grads)
+                    loss = None
+                step_stats = frame_stats(batch[1])
+                num_frames += step_stats["frames"]
+            run_time = time.perf_counter() - run_start
+
+            train_ler_total += ler
+            num_steps += 1
+
+            if telemetry:
+                frames = step_stats.get("frames")
+                telemetry.record(
+                    "step", epoch=epoch, step=step_i,
+                    num_batches=len(fn_batches[start:start+group_size]),
+                    data_load=timings.get("data_load"),
+                    feed_prep=timings.get("feed_prep"),
+                    run=run_time,
+                    frames=frames,
+                    frames_per_sec=frames / run_time if frames else None,
+                    padded_ratio=step_stats.get("padded_ratio"),
+                    loss=loss, ler=float(ler),
+                    rss=process_rss())
+        #else:
+        #    raise PersephoneException("No training data was provided."
+        #                              " Check your batch generation.")
+
+        if telemetry:
+            epoch_time = time.perf_counter() - epoch_start
+            telemetry.record(
+                "epoch", epoch=epoch, steps=num_steps,
+                train_time=epoch_time,
+                frames=num_frames if not accumulate else None,
+                frames_per_sec=num_frames / epoch_time if not accumulate else None,
+                train_ler=train_ler_total / num_steps,
+                rss=process_rss())
+            telemetry.flush()
+
+        return train_ler_total / num_steps, ler
+
+    def _record_validation(self, stopping: EarlyStopping, epoch: int,
+                           train_ler: float, ler: float, valid_ler: float,
+                           hyps: List[List[str]], refs: List[List[str]], *,
+                           hyps_dir: str, writer: checkpointing.CheckpointWriter,
+                           out_file: Any,
+                           epoch_callback: Optional[Callable[[Dict], None]]
+                          ) -> bool:
+        """ Logs the validation results of an epoch and updates the early
+        stopping state with them.
+
+        Args:
+            stopping: The early stopping state of the training run.
+            epoch: The epoch that was validated.
+            train_ler: The mean training LER of the epoch.
+            ler: The training LER of the last batch of the epoch.
+            valid_ler: The validation LER at the end of the epoch.
+            hyps: The validation hypotheses at the end of the epoch.
+            refs: The validation references.
+            hyps_dir: The directory hypotheses are written to.
+            writer: Writes the hypotheses.
+            out_file: The training log.
+            epoch_callback: Called with the epoch's results, if given.
+
+        Returns:
+            True if this epoch has the best validation LER so far.
+        """
+
+        # Log hypotheses
+        writer.submit(write_transcripts,
+                      os.path.join(hyps_dir, "epoch%d_hyps" % epoch), hyps)
+        if epoch == 1:
+            writer.submit(write_transcripts,
+                          os.path.join(hyps_dir, "refs"), refs)
+
+        epoch_str = "Epoch %d. Training LER: %f, validation LER: %f" % (
+            epoch, train_ler, valid_ler)
+        print(epoch_str, flush=True, file=out_file)
+
+        # Call the callback here if it was defined
+        if epoch_callback:
+            epoch_callback({
+                "epoch": epoch,
+                "training_ler": train_ler, # current training LER
+                "valid_ler": valid_ler, # Current validation LER
+            })
+
+        # Implement early stopping.
+        improved = stopping.update(epoch, epoch_str, valid_ler, ler, out_file)
+        if improved:
+            # Output best hyps
+            writer.submit(write_transcripts,
+                          os.path.join(hyps_dir, "best_hyps"), hyps)
+        return improved
+
     def train(self, *, early_stopping_steps: int = 10, min_epochs: int = 30,
               max_valid_ler: float = 1.0, max_train_ler: float = 0.3,
               max_epochs: int = 100, restore_model_path: Optional[str]=None,
-              epoch_callback: Optional[Callable[[Dict], None]]=None) -> None:
+              epoch_callback: Optional[Callable[[Dict], None]]=None,
+              num_workers: int = 1,
+              model_factory: Optional[Callable[[], "Model"]]=None,
+              async_checkpoint: bool = False,
+              async_validation: bool = False,
+              max_validation_lag: int = 2,
+              telemetry_callback: Optional[Callable[[Dict], None]]=None,
+              profile_every: int = 0,
+              resume: bool = False,
+              time_budget: Optional[float]=None,
+              frame_budget: Optional[int]=None,
+              max_validation_fraction: float = 0.2,
+              accumulate_steps: int = 1) -> None:
         """ Train the model.
 
             min_epochs: minimum number of epochs to run training for.
@@ -327,10 +794,65 @@ class Model:
                             The parameters passed to the callable will be the epoch number,
                             the current training LER and the current validation LER.
                             This can be useful for progress reporting.
+            num_workers: The number of processes to train with. If greater
+                         than 1, each update averages the gradients of
+                         num_workers batches, each computed in a separate
+                         process. See `persephone.data_parallel`.
+            model_factory: A picklable callable that builds this model. Used
+                           by data parallel worker processes to build their
+                           own copies of the model.
+            async_checkpoint: If True, checkpoints and hypotheses are written
+                              by a background thread so that training
+                              doesn't wait on storage. See
+                              `checkpointing.AsyncCheckpointWriter`.
+            async_validation: If True, the validation set is decoded by a
+                              separate evaluator process, built with
+                              model_factory, while training continues. See
+                              `persephone.validation`.
+            max_validation_lag: With async_validation, the number of epochs
+                                training may run ahead of the early stopping
+                                decisions before it waits for the evaluator.
+            telemetry_callback: A callback that is called with each record
+                                written to telemetry.jsonl in exp_dir: one
+                                per training step, one per epoch and one per
+                                validation. See `persephone.telemetry`.
+            profile_every: Trace every this many training steps and
+                           validation steps, starting with the first, and the
+                           final evaluation on the test set, writing traces
+                           and op tables to the "profile" directory of
+                           exp_dir. If 0, nothing is traced. See
+                           `persephone.profiling`.
+            resume: If True and an earlier call to train() in exp_dir was
+                    interrupted, carry on from the end of the last epoch it
+                    finished instead of starting afresh. At the end of each
+                    epoch the model, optimizer state, early stopping state
+                    and the random state used to shuffle batches are saved
+                    to model/model_latest_epoch<N>.ckpt and
+                    model/train_state.json, which names the checkpoint.
+            time_budget: If given, the number of seconds training may take.
+                         Training stops before starting an epoch that isn't
+                         projected to finish, with its validation and the
+                         test set evaluation, in time. See
+                         `persephone.budget`.
+            frame_budget: If given, the total number of training frames,
+                          summed over epochs, training may use.
+            max_validation_fraction: When training to a budget, epochs are
+                                     only validated often enough to keep
+                                     validation to about this fraction of
+                                     the training time. Early stopping then
+                                     counts validations rather than epochs.
+            accumulate_steps: The number of batches whose gradients are
+                              averaged for each update, so that the effective
+                              batch size is this many times the corpus
+                              reader's while only one batch at a time (per
+                              process, in data parallel training) is held in
+                              memory.
         """
         logger.info("Training model")
-        best_valid_ler = 2.0
-        steps_since_last_record = 0
+        stopping = EarlyStopping(early_stopping_steps=early_stopping_steps,
+                                 min_epochs=min_epochs, max_epochs=max_epochs,
+                                 max_valid_ler=max_valid_ler,
+                                 max_train_ler=max_train_ler)
 
         #Get information about training for the names of output files.
         frame = inspect.currentframe()
@@ -341,162 +863,272 @@ class Model:
             with open(os.path.join(self.exp_dir, "train_description.txt"), 
                       "w", encoding=ENCODING) as desc_f:
                 for arg in args:
-                    if type(values[arg]) in [str, int, float] or isinstance(
+                    if type(values[arg]) in [str, int, float, bool] or isinstance(
                             values[arg], type(None)):
                         print("%s=%s" % (arg, values[arg]), file=desc_f)
                     else:
-                        print("%s=%s" % (arg, values[arg].__dict__), file=desc_f)
+                        print("%s=%s" % (arg, getattr(values[arg], "__dict__", values[arg])),
+                              file=desc_f)
                 print("num_train=%s" % (self.corpus_reader.num_train), file=desc_f)
                 print("batch_size=%s" % (self.corpus_reader.batch_size), file=desc_f)
+                corpus = self.corpus_reader.corpus
+                print("feat_type=%s" % (getattr(corpus, "feat_type", None)), file=desc_f)
+                print("label_type=%s" % (getattr(corpus, "label_type", None)), file=desc_f)
         else:
             logger.error("Couldn't find frame information, failed to write train_description.txt")
 
+        # Record which utterances are trained on, so that incremental
+        # training can tell which have been added since.
+        with open(os.path.join(self.exp_dir, "train_prefixes.txt"), "w",
+                  encoding=ENCODING) as prefixes_f:
+            for prefix in sorted(self.corpus_reader.train_prefixes):
+                print(prefix, file=prefixes_f)
+
 
         # Load the validation set
         valid_x, valid_x_lens, valid_y = self.corpus_reader.valid_batch()
 
         saver = tf.train.Saver()
 
-        with tf.Session(config=allow_growth_config) as sess:
-
-            if restore_model_path:
+        if num_workers > 1 and not model_factory:
+            raise PersephoneException(
+                "Data parallel training requires a model_factory to build"
+                " the model in each worker process.")
+        if accumulate_steps < 1:
+            raise PersephoneException(
+                "accumulate_steps must be at least 1, got %d." % accumulate_steps)
+        if async_validation and not model_factory:
+            raise PersephoneException(
+                "Asynchronous validation requires a model_factory to build"
+                " the model in the evaluator process.")
+        if async_validation:
+            # Epoch checkpoints are deleted once validated, so they are kept
+            # out of the default saver's record of recent checkpoints.
+            epoch_saver = tf.train.Saver(max_to_keep=None)
+
+        training_budget = None
+        if time_budget or frame_budget:
+            training_budget = budget.TrainingBudget(
+                time_budget=time_budget, frame_budget=frame_budget,
+                max_validation_fraction=max_validation_fraction)
+
+        model_dir = os.path.join(self.exp_dir, "model")
+        # The checkpoint named by the last training state saved, if any.
+        latest_path = None # type: Optional[str]
+        train_state_path = os.path.join(model_dir, "train_state.json")
+        train_state = None
+        if resume:
+            train_state = checkpointing.load_train_state(train_state_path)
+            if not train_state:
+                logger.info("No training state found at %s, starting afresh",
+                            train_state_path)
+
+        with contextlib.ExitStack() as stack, \
+                tf.Session(config=allow_growth_config) as sess:
+            pool = None
+            if num_workers > 1:
+                pool = stack.enter_context(
+                    data_parallel.WorkerPool(model_factory, num_workers - 1))
+            if async_checkpoint:
+                writer = stack.enter_context(
+                    checkpointing.AsyncCheckpointWriter(saver)) # type: checkpointing.CheckpointWriter
+            else:
+                writer = checkpointing.CheckpointWriter(saver)
+            telemetry = stack.enter_context(Telemetry(
+                os.path.join(self.exp_dir, "telemetry.jsonl"), telemetry_callback,
+                append=bool(train_state)))
+            profile_dir = os.path.join(self.exp_dir, "profile")
+            train_profiler = profiling.StepProfiler(profile_dir, "train", profile_every)
+            valid_profiler = profiling.StepProfiler(profile_dir, "valid", profile_every)
+            evaluator = None
+            if async_validation:
+                evaluator = stack.enter_context(
+                    validation.ValidationEvaluator(model_factory))
+
+            # Checkpoints awaiting validation, mapped to their training LERs.
+            unvalidated = {} # type: Dict[int, Tuple[float, float]]
+            epoch = 0
+
+            if train_state:
+                epoch = train_state["epoch"]
+                logger.info("Resuming training from the end of epoch %d", epoch)
+                latest_path = train_state["latest_path"]
+                saver.restore(sess, latest_path)
+                stopping.set_state(train_state["early_stopping"])
+                version, internal_state, gauss_next = train_state["random_state"]
+                random.setstate((version, tuple(internal_state), gauss_next))
+                self.saved_model_path = train_state["saved_model_path"]
+                if training_budget and train_state.get("budget"):
+                    training_budget.set_state(train_state["budget"])
+                for valid_epoch, (epoch_train_ler, epoch_ler) in train_state["unvalidated"]:
+                    valid_epoch_path = os.path.join(model_dir, "epoch%d.ckpt" % valid_epoch)
+                    if evaluator and os.path.exists(valid_epoch_path + ".index"):
+                        evaluator.submit(valid_epoch, valid_epoch_path)
+                        unvalidated[valid_epoch] = (epoch_train_ler, epoch_ler)
+                    else:
+                        logger.warning("Epoch %d won't be validated since its"
+                                       " checkpoint can't be", valid_epoch)
+                        checkpointing.remove_checkpoint(valid_epoch_path)
+            elif restore_model_path:
                 logger.info("Restoring model from path %s", restore_model_path)
                 saver.restore(sess, restore_model_path)
             else:
                 sess.run(tf.global_variables_initializer())
 
-            # Prepare directory to output hypotheses to
+            # Prepare directories to output hypotheses and checkpoints to
             hyps_dir = os.path.join(self.exp_dir, "decoded")
             if not os.path.isdir(hyps_dir):
                 os.mkdir(hyps_dir)
-
-            best_epoch_str = None
+            if not os.path.isdir(model_dir):
+                os.mkdir(model_dir)
+            best_path = os.path.join(model_dir, "model_best.ckpt")
 
             training_log_path = os.path.join(self.exp_dir, "train_log.txt")
-            if os.path.exists(training_log_path):
-                logger.error("Error, overwriting existing log file at path {}".format(training_log_path))
-            with open(training_log_path, "w",
+            if train_state:
+                log_mode = "a"
+            else:
+                log_mode = "w"
+                if os.path.exists(training_log_path):
+                    logger.error("Error, overwriting existing log file at path {}".format(training_log_path))
+            if training_budget:
+                training_budget.start(budget.count_frames(self.corpus_reader.train_fns))
+
+            with open(training_log_path, log_mode,
                       encoding=ENCODING) as out_file:
-                for epoch in itertools.count(start=1):
+                while not stopping.stopped:
+                    epoch += 1
                     print("\nexp_dir %s, epoch %d" % (self.exp_dir, epoch))
-                    batch_gen = self.corpus_reader.train_batch_gen()
-
-                    train_ler_total = 0
-                    print("\tBatch...", end="")
-                    for batch_i, batch in enumerate(batch_gen):
-                        print("%d..." % batch_i, end="")
-                        sys.stdout.flush()
-                        batch_x, batch_x_lens, batch_y = batch
-
-                        feed_dict = {self.batch_x: batch_x,
-                                    self.batch_x_lens: batch_x_lens,
-                                    self.batch_y: batch_y}
-
-                        _, ler, = sess.run([self.optimizer, self.ler],
-                                        feed_dict=feed_dict)
-
-                        train_ler_total += ler
-                    #else:
-                    #    raise PersephoneException("No training data was provided."
-                    #                              " Check your batch generation.")
-
-                    feed_dict = {self.batch_x: valid_x,
-                                self.batch_x_lens: valid_x_lens,
-                                self.batch_y: valid_y}
-
-                    try:
-                        valid_ler, dense_decoded, dense_ref = sess.run(
-                            [self.ler, self.dense_decoded, self.dense_ref],
-                            feed_dict=feed_dict)
-                    except tf.errors.ResourceExhaustedError:
-                        import pprint
-                        print("Ran out of memory allocating a batch:")
-                        pprint.pprint(feed_dict)
-                        logger.critical("Ran out of memory allocating a batch: %s", pprint.pformat(feed_dict))
-                        raise
-                    hyps, refs = self.corpus_reader.human_readable_hyp_ref(
-                        dense_decoded, dense_ref)
-                    # Log hypotheses
-                    with open(os.path.join(hyps_dir, "epoch%d_hyps" % epoch),
-                              "w", encoding=ENCODING) as hyps_f:
-                        for hyp in hyps:
-                            print(" ".join(hyp), file=hyps_f)
-                    if epoch == 1:
-                        with open(os.path.join(hyps_dir, "refs"), "w", 
-                                  encoding=ENCODING) as refs_f:
-                            for ref in refs:
-                                print(" ".join(ref), file=refs_f)
-
-                    valid_per = utils.batch_per(hyps, refs)
-
-                    epoch_str = "Epoch %d. Training LER: %f, validation LER: %f" % (
-                        epoch, (train_ler_total / (batch_i + 1)), valid_ler)
-                    print(epoch_str, flush=True, file=out_file)
-                    if best_epoch_str is None:
-                        best_epoch_str = epoch_str
-
-                    # Call the callback here if it was defined
-                    if epoch_callback:
-                        epoch_callback({
-                            "epoch": epoch,
-                            "training_ler": (train_ler_total / (batch_i + 1)), # current training LER
-                            "valid_ler": valid_ler, # Current validation LER
-                        })
-
-                    # Implement early stopping.
-                    if valid_ler < best_valid_ler:
-                        print("New best valid_ler", file=out_file)
-                        best_valid_ler = valid_ler
-                        best_epoch_str = epoch_str
-                        steps_since_last_record = 0
-
-                        # Save the model.
-                        checkpoint_path = os.path.join(self.exp_dir, "model", "model_best.ckpt")
-                        if not os.path.exists(os.path.dirname(checkpoint_path)):
-                            os.mkdir(os.path.dirname(checkpoint_path))
-                        saver.save(sess, checkpoint_path)
-                        self.saved_model_path = checkpoint_path
-
-                        # Output best hyps
-                        with open(os.path.join(hyps_dir, "best_hyps"),
-                                  "w", encoding=ENCODING) as hyps_f:
-                            for hyp in hyps:
-                                print(" ".join(hyp), file=hyps_f)
-
+                    if pool:
+                        # Resynchronize the workers once per epoch so that
+                        # they can't drift from the training process.
+                        pool.sync_variables(sess)
+                    train_start = time.perf_counter()
+                    train_ler, ler = self._train_epoch(
+                        sess, pool=pool, telemetry=telemetry, epoch=epoch,
+                        profiler=train_profiler, accumulate_steps=accumulate_steps)
+
+                    last_epoch = epoch >= max_epochs
+                    validate = True
+                    if training_budget:
+                        training_budget.epoch_done(time.perf_counter() - train_start)
+                        last_epoch = last_epoch or not training_budget.can_train_epoch()
+                        validate = last_epoch or training_budget.should_validate(epoch)
+
+                    if not validate:
+                        print("Epoch %d. Training LER: %f, not validated" % (
+                            epoch, train_ler), flush=True, file=out_file)
+                    elif evaluator:
+                        epoch_path = os.path.join(model_dir, "epoch%d.ckpt" % epoch)
+                        epoch_saver.save(sess, epoch_path, write_meta_graph=False,
+                                         latest_filename="validation_checkpoint")
+                        evaluator.submit(epoch, epoch_path)
+                        if training_budget:
+                            training_budget.validation_done(epoch, None)
+                        unvalidated[epoch] = (train_ler, ler)
+                        # No more epochs are trained past the last one unless
+                        # it improves, so wait for every result.
+                        max_pending = 0 if last_epoch else max_validation_lag
+                        for valid_epoch, valid_ler, hyps, refs in evaluator.results(max_pending):
+                            epoch_train_ler, epoch_ler = unvalidated.pop(valid_epoch)
+                            telemetry.record("validation", epoch=valid_epoch,
+                                             valid_ler=valid_ler,
+                                             validation_time=None,
+                                             lag=epoch - valid_epoch,
+                                             rss=process_rss())
+                            valid_epoch_path = os.path.join(
+                                model_dir, "epoch%d.ckpt" % valid_epoch)
+                            if self._record_validation(
+                                    stopping, valid_epoch, epoch_train_ler, epoch_ler,
+                                    valid_ler, hyps, refs, hyps_dir=hyps_dir,
+                                    writer=writer, out_file=out_file,
+                                    epoch_callback=epoch_callback):
+                                checkpointing.copy_checkpoint(valid_epoch_path, best_path)
+                                if not os.path.exists(best_path + ".meta"):
+                                    saver.export_meta_graph(best_path + ".meta")
+                                self.saved_model_path = best_path
+                            checkpointing.remove_checkpoint(valid_epoch_path)
+                            if stopping.stopped:
+                                break
                     else:
-                        print("Steps since last best valid_ler: %d" % (steps_since_last_record), file=out_file)
-                        steps_since_last_record += 1
-                        if epoch >= max_epochs:
-                            self.output_best_scores(best_epoch_str)
+                        valid_start = time.perf_counter()
+                        feed_dict = self.make_feed_dict(valid_x, valid_x_lens, valid_y)
+
+                        try:
+                            valid_ler, dense_decoded, dense_ref = valid_profiler.run(
+                                sess, [self.ler, self.dense_decoded, self.dense_ref],
+                                feed_dict=feed_dict)
+                            hyps, refs = self.corpus_reader.human_readable_hyp_ref(
+                                dense_decoded, dense_ref)
+                        except tf.errors.ResourceExhaustedError:
+                            logger.warning("Ran out of memory validating %d utterances"
+                                           " at once, validating in parts", len(valid_x))
+                            valid_ler, hyps, refs = batch_sizing.decode_split(
+                                self, sess, valid_x, valid_x_lens, valid_y, split=True)
+                        valid_time = time.perf_counter() - valid_start
+                        if training_budget:
+                            training_budget.validation_done(epoch, valid_time)
+                        telemetry.record("validation", epoch=epoch,
+                                         valid_ler=float(valid_ler),
+                                         validation_time=valid_time,
+                                         lag=0, rss=process_rss())
+
+                        if self._record_validation(
+                                stopping, epoch, train_ler, ler, valid_ler, hyps,
+                                refs, hyps_dir=hyps_dir, writer=writer,
+                                out_file=out_file, epoch_callback=epoch_callback):
+                            # Save the model.
+                            writer.save(sess, best_path)
+                            self.saved_model_path = best_path
+
+                    # Save everything needed to carry on from here. Resuming
+                    # only restores the variables, so no meta graph is needed.
+                    # Each epoch's checkpoint has its own path, named in the
+                    # training state, so that an interruption between the two
+                    # writes can't pair the state of one epoch with the
+                    # weights of another.
+                    prev_latest_path = latest_path
+                    latest_path = os.path.join(
+                        model_dir, "model_latest_epoch%d.ckpt" % epoch)
+                    writer.save(sess, latest_path, write_meta_graph=False,
+                                write_state=False)
+                    writer.submit(checkpointing.save_train_state, train_state_path, {
+                        "epoch": epoch,
+                        "latest_path": latest_path,
+                        "early_stopping": stopping.get_state(),
+                        "random_state": random.getstate(),
+                        "saved_model_path": self.saved_model_path,
+                        "unvalidated": sorted(unvalidated.items()),
+                        "budget": training_budget.get_state() if training_budget else None,
+                    })
+                    if prev_latest_path and prev_latest_path != latest_path:
+                        writer.submit(checkpointing.remove_checkpoint, prev_latest_path)
+
+                    if stopping.stopped:
+                        self.output_best_scores(stopping.best_epoch_str)
+                    elif training_budget:
+                        projection = training_budget.projection(epoch, max_epochs)
+                        logger.info(projection)
+                        print(projection, file=out_file, flush=True)
+                        if not training_budget.can_train_epoch():
+                            print("Stopping since another epoch won't fit in the"
+                                  " training budget.", file=out_file, flush=True)
+                            self.output_best_scores(stopping.best_epoch_str)
                             break
-                        if steps_since_last_record >= early_stopping_steps:
-                            if epoch >= min_epochs:
-                                # Then we've done the minimum number of epochs.
-                                if valid_ler <= max_valid_ler and ler <= max_train_ler:
-                                    # Then training error has moved sufficiently
-                                    # towards convergence.
-                                    print("Stopping since best validation score hasn't been"
-                                        " beaten in %d epochs and at least %d have been"
-                                        " done. The valid ler (%d) is below %d and"
-                                        " the train ler (%d) is below %d." %
-                                        (early_stopping_steps, min_epochs, valid_ler,
-                                        max_valid_ler, ler, max_train_ler),
-                                        file=out_file, flush=True)
-                                    self.output_best_scores(best_epoch_str)
-                                    break
-                                else:
-                                    # Keep training because we haven't achieved
-                                    # convergence.
-                                    continue
-                            else:
-                                # Keep training because we haven't done the minimum
-                                # numper of epochs.
-                                continue
 
+                if evaluator:
+                    # Abandon checkpoints that were still being validated
+                    # when training stopped.
+                    evaluator.close()
+                    for valid_epoch in unvalidated:
+                        checkpointing.remove_checkpoint(
+                            os.path.join(model_dir, "epoch%d.ckpt" % valid_epoch))
+                # Make sure the checkpoint and hypotheses are on disk
+                writer.flush()
                 # Check we actually saved a checkpoint
                 if not self.saved_model_path:
                     raise PersephoneException(
                         "No checkpoint was saved so model evaluation cannot be performed. "
                         "This can happen if the validaion LER never converges.")
                 # Finally, run evaluation on the test set.
-                self.eval(restore_model_path=self.saved_model_path)
+                self.eval(restore_model_path=self.saved_model_path,
+                          profile_every=profile_every)
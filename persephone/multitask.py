@@ -0,0 +1,434 @@
+""" An acoustic model that predicts several tiers of labels, such as phonemes
+and tones, from one shared encoder.
+
+Corpora such as Na can be prepared with different label types from the same
+recordings. Rather than train a separate model for each, a
+`multitask.Model` runs one bidirectional LSTM encoder and puts a separate
+CTC output layer ("head") on it for each label type. The heads are trained
+jointly on a weighted sum of their CTC losses, and a single pass of the
+encoder produces a transcription in every tier::
+
+    phonemes = Corpus("fbank", "phonemes", "data/na")
+    tones = Corpus("fbank", "tones", "data/na")
+    corpus_reader = multitask.MultiTaskCorpusReader([phonemes, tones], batch_size=32)
+    model = multitask.Model("exp/0", corpus_reader)
+    model.train()
+
+The first corpus's label type is the primary one: validation, early
+stopping, `dense_decoded` and `ler` are those of its head, so the model can
+be trained and decoded like any other. The other heads' test set results
+are written alongside the primary one's by `eval()`.
+"""
+
+import json
+import os
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Set, Union
+
+import numpy as np
+import tensorflow as tf
+
+from . import model
+from . import profiling
+from . import rnn_ctc
+from . import utils
+from .config import ENCODING
+from .corpus import Corpus
+from .corpus_reader import CorpusReader
+from .exceptions import PersephoneException
+from .preprocess import labels
+
+class MultiTaskCorpusReader(CorpusReader):
+    """ Reads batches whose targets are the labels of each of several
+    corpora prepared from the same utterances with different label types.
+
+    Args:
+        corpora: The corpora, one per label type. They must share their
+                 target directory, feature type and training, validation and
+                 test sets. The first is the primary corpus.
+        kwargs: Arguments to `CorpusReader`, which reads the primary corpus.
+
+    The targets of each batch are a tuple of sparse tensor values, one per
+    corpus, in the order of corpora.
+    """
+
+    def __init__(self, corpora: Sequence[Corpus], **kwargs) -> None:
+        if not corpora:
+            raise PersephoneException("A multi-task corpus reader needs at least one corpus.")
+        primary = corpora[0]
+        label_types = [corpus.label_type for corpus in corpora]
+        if len(set(label_types)) != len(label_types):
+            raise PersephoneException(
+                "Each corpus must have a different label type, got %s." % label_types)
+        for corpus in corpora[1:]:
+            if (Path(corpus.tgt_dir) != Path(primary.tgt_dir)
+                    or corpus.feat_type != primary.feat_type):
+                raise PersephoneException(
+                    "Corpus with label type %s doesn't share the target directory"
+                    " and feature type of the %s corpus." % (
+                        corpus.label_type, primary.label_type))
+            for data_set in ("train_prefixes", "valid_prefixes", "test_prefixes"):
+                if set(getattr(corpus, data_set)) != set(getattr(primary, data_set)):
+                    raise PersephoneException(
+                        "Corpus with label type %s has different %s from the %s"
+                        " corpus." % (corpus.label_type, data_set, primary.label_type))
+        self.corpora = list(corpora)
+        super().__init__(primary, **kwargs)
+
+    @property
+    def label_types(self) -> List[str]:
+        """ The label types of the corpora, primary first. """
+        return [corpus.label_type for corpus in self.corpora]
+
+    def load_batch(self, fn_batch, timings: Optional[Dict[str, float]] = None):
+        """ Loads a batch as `CorpusReader.load_batch()` does, except that the
+        targets are a tuple with one sparse tensor value per corpus. """
+
+        batch_inputs, batch_inputs_lens, primary_targets = super().load_batch(
+            fn_batch, timings)
+
+        start_time = time.perf_counter()
+        primary_suffix = "." + self.corpus.label_type
+        batch_targets = [primary_targets]
+        for corpus in self.corpora[1:]:
+            targets_list = []
+            for _, label_fn in fn_batch:
+                # Every corpus keeps its labels in the same label directory,
+                # differing only in the label type extension.
+                targets_path = label_fn[:-len(primary_suffix)] + "." + corpus.label_type
+                with open(targets_path, encoding=ENCODING) as targets_f:
+                    targets_list.append(
+                        corpus.labels_to_indices(targets_f.readline().split()))
+            batch_targets.append(utils.target_list_to_sparse_tensor(targets_list))
+        if timings is not None:
+            timings["data_load"] = timings.get("data_load", 0.0) + (
+                time.perf_counter() - start_time)
+
+        return batch_inputs, batch_inputs_lens, tuple(batch_targets)
+
+def _human_readable(corpus: Corpus, dense_repr: Sequence[Sequence[int]]) -> List[List[str]]:
+    """ The labels of a dense representation of a batch of transcriptions. """
+
+    return [corpus.indices_to_labels([index for index in dense_r if index != 0])
+            for dense_r in dense_repr]
+
+class Model(model.Model):
+    """ An acoustic model with a shared bidirectional LSTM encoder and a
+    CTC output layer for each label type. """
+
+    def __init__(self, exp_dir: Union[str, Path],
+                 corpus_reader: MultiTaskCorpusReader, num_layers: int = 3,
+                 hidden_size: int = 250, beam_width: int = 100,
+                 decoding_merge_repeated: bool = True,
+                 cell_type: str = "lstm",
+                 task_weights: Optional[Sequence[float]] = None) -> None:
+        """ Construct the multi-task LSTM/CTC graph.
+
+        Args:
+            exp_dir: The experiment directory that descriptions of the model,
+                     checkpoints and hypotheses are written to.
+            corpus_reader: The `MultiTaskCorpusReader` that feeds the model.
+            num_layers: The number of bidirectional LSTM layers in the
+                        encoder.
+            hidden_size: The number of LSTM units in each direction of each
+                         layer.
+            beam_width: The beam width used in CTC beam search decoding.
+            decoding_merge_repeated: Whether repeated labels are merged in
+                                     CTC beam search decoding.
+            cell_type: "lstm" or "lstm_block_fused", as for `rnn_ctc.Model`.
+            task_weights: The weight of each label type's CTC loss in the
+                          training cost, in the order of the corpus reader's
+                          corpora. Defaults to weighting them equally.
+        """
+        super().__init__(exp_dir, corpus_reader)
+
+        if cell_type not in rnn_ctc.CELL_TYPES:
+            raise PersephoneException(
+                "cell_type %s not implemented. Use one of %s." % (
+                    cell_type, str(rnn_ctc.CELL_TYPES)))
+        corpora = corpus_reader.corpora
+        if task_weights is None:
+            task_weights = [1.0] * len(corpora)
+        if len(task_weights) != len(corpora):
+            raise PersephoneException(
+                "Got %d task weights for %d label types." % (
+                    len(task_weights), len(corpora)))
+
+        if isinstance(exp_dir, Path):
+            exp_dir = str(exp_dir)
+        if not os.path.isdir(exp_dir):
+            os.makedirs(exp_dir)
+
+        # Reset the graph.
+        tf.reset_default_graph()
+
+        self.num_layers = num_layers
+        self.hidden_size = hidden_size
+        self.beam_width = beam_width
+        self.cell_type = cell_type
+        self.label_types = corpus_reader.label_types
+        self.task_weights = list(task_weights)
+        # Increase vocab sizes by 2 since we need an extra for CTC blank
+        # labels and another extra for dynamic padding with zeros.
+        self.vocab_sizes = {corpus.label_type: corpus.vocab_size + 2
+                            for corpus in corpora}
+        self.vocab_size = self.vocab_sizes[self.label_types[0]]
+
+        # Initialize placeholders for feeding data to model.
+        self.batch_x = tf.placeholder(
+                tf.float32, [None, None, corpus_reader.corpus.num_feats],
+                name="batch_x")
+        self.batch_x_lens = tf.placeholder(tf.int32, [None], name="batch_x_lens")
+        self.batch_ys = [tf.sparse_placeholder(tf.int32, name="batch_y_%s" % label_type)
+                         for label_type in self.label_types]
+        self.batch_y = self.batch_ys[0]
+
+        batch_size = tf.shape(self.batch_x)[0]
+
+        # The shared encoder.
+        layer_input = self.batch_x
+        for i in range(num_layers):
+            with tf.variable_scope("layer_%d" % i): #type: ignore
+                if cell_type == "lstm_block_fused":
+                    out_fw, out_bw = rnn_ctc.fused_bidirectional_rnn(
+                            hidden_size, layer_input, self.batch_x_lens)
+                else:
+                    (out_fw, out_bw), _ = tf.nn.bidirectional_dynamic_rnn(
+                            rnn_ctc.lstm_cell(hidden_size), rnn_ctc.lstm_cell(hidden_size),
+                            layer_input, self.batch_x_lens, dtype=tf.float32,
+                            time_major=False)
+                # [batch_num, time, hidden_size*2], fed into the next layer
+                layer_input = tf.concat((out_fw, out_bw), 2) #type: ignore
+        self.outputs = tf.reshape(layer_input, [-1, hidden_size*2]) # pylint: disable=no-member
+
+        # A CTC head for each label type.
+        self.logits_by_label_type = {} # type: Dict[str, tf.Tensor]
+        self.dense_decoded_by_label_type = {} # type: Dict[str, tf.Tensor]
+        self.dense_ref_by_label_type = {} # type: Dict[str, tf.Tensor]
+        self.ler_by_label_type = {} # type: Dict[str, tf.Tensor]
+        weighted_costs = []
+        for label_type, batch_y, weight in zip(
+                self.label_types, self.batch_ys, self.task_weights):
+            vocab_size = self.vocab_sizes[label_type]
+            with tf.variable_scope("head_%s" % label_type): #type: ignore
+                # Single-variable names are appropriate for weights an biases.
+                # pylint: disable=invalid-name
+                W = tf.Variable(tf.truncated_normal([hidden_size*2, vocab_size],
+                        stddev=np.sqrt(2.0 / (2*hidden_size)))) #type: ignore
+                b = tf.Variable(tf.zeros([vocab_size])) #type: ignore
+                logits = tf.matmul(self.outputs, W) + b #type: ignore
+                logits = tf.reshape(logits, [batch_size, -1, vocab_size]) # pylint: disable=no-member
+                # Time major, because of an optimization in ctc_loss.
+                logits = tf.transpose(logits, (1, 0, 2), name="logits") #type: ignore
+                decoded, _ = tf.nn.ctc_beam_search_decoder(
+                        logits, self.batch_x_lens, beam_width=beam_width,
+                        merge_repeated=decoding_merge_repeated)
+                loss = tf.nn.ctc_loss(batch_y, logits, self.batch_x_lens,
+                        preprocess_collapse_repeated=False, ctc_merge_repeated=True)
+                self.ler_by_label_type[label_type] = tf.reduce_mean(tf.edit_distance(
+                        tf.cast(decoded[0], tf.int32), batch_y)) #type: ignore
+                self.dense_ref_by_label_type[label_type] = tf.sparse_tensor_to_dense(batch_y)
+            self.logits_by_label_type[label_type] = logits
+            # Named outside the head's scope so that decode() can find it.
+            self.dense_decoded_by_label_type[label_type] = tf.sparse_tensor_to_dense(
+                    decoded[0], name="hyp_dense_decoded_%s" % label_type)
+            weighted_costs.append(weight * tf.reduce_mean(loss))
+
+        primary = self.label_types[0]
+        self.logits = self.logits_by_label_type[primary]
+        # For lattice construction
+        self.log_softmax = tf.nn.log_softmax(self.logits)
+        self.dense_decoded = tf.identity(self.dense_decoded_by_label_type[primary],
+                                         name="hyp_dense_decoded")
+        self.dense_ref = self.dense_ref_by_label_type[primary]
+        self.ler = self.ler_by_label_type[primary]
+
+        self.cost = tf.add_n(weighted_costs) / sum(self.task_weights)
+        self.build_optimizer(self.cost)
+
+        self.write_desc()
+
+    def make_feed_dict(self, batch_x, batch_x_lens, batch_y=None) -> Dict:
+        """ Makes a feed dict from a batch as loaded by the
+        `MultiTaskCorpusReader`, whose targets have one sparse tensor value
+        per label type. """
+
+        feed_dict = super().make_feed_dict(batch_x, batch_x_lens)
+        if batch_y is not None:
+            for placeholder, targets in zip(self.batch_ys, batch_y):
+                feed_dict[placeholder] = targets
+        return feed_dict
+
+    def write_desc(self) -> None:
+        """ Writes a description of the model to the exp_dir, naming the
+        decoded output of each label type's head in the topology section of
+        model_description.json. """
+
+        if not self.write_descs:
+            return
+        super().write_desc()
+        json_path = os.path.join(self.exp_dir, "model_description.json")
+        with open(json_path) as json_desc_f:
+            desc = json.load(json_desc_f)
+        desc["topology"]["dense_decoded_names"] = {
+            label_type: dense_decoded.name
+            for label_type, dense_decoded in self.dense_decoded_by_label_type.items()}
+        with open(json_path, "w") as json_desc_f:
+            json.dump(desc, json_desc_f, skipkeys=True)
+
+    def transcribe(self, restore_model_path: Optional[str]=None) -> None:
+        """ Transcribes an untranscribed dataset in every tier at once.
+
+        The primary label type's transcriptions are written to
+        transcriptions/hyps.txt as by `Model.transcribe()`, and each label
+        type's to transcriptions/hyps.<label_type>.txt.
+        """
+
+        saver = tf.train.Saver()
+        with tf.Session(config=model.allow_growth_config) as sess:
+            if restore_model_path:
+                saver.restore(sess, restore_model_path)
+            elif self.saved_model_path:
+                saver.restore(sess, self.saved_model_path)
+            else:
+                raise PersephoneException("No model to use for transcription.")
+
+            hyps_by_label_type = {label_type: [] for label_type in self.label_types} # type: Dict[str, List]
+            feat_fns = [] # type: List[str]
+            fetches = [self.dense_decoded_by_label_type[label_type]
+                       for label_type in self.label_types]
+            for batch_x, batch_x_lens, feat_fn_batch in self.corpus_reader.untranscribed_batch_gen():
+                feed_dict = self.make_feed_dict(batch_x, batch_x_lens)
+                dense_decoded_tiers = sess.run(fetches, feed_dict=feed_dict)
+                for corpus, dense_decoded in zip(self.corpus_reader.corpora,
+                                                 dense_decoded_tiers):
+                    hyps_by_label_type[corpus.label_type].extend(
+                        _human_readable(corpus, dense_decoded))
+                feat_fns.extend(feat_fn_batch)
+
+        hyps_dir = os.path.join(self.exp_dir, "transcriptions")
+        if not os.path.isdir(hyps_dir):
+            os.mkdir(hyps_dir)
+        paths = [(self.label_types[0], os.path.join(hyps_dir, "hyps.txt"))]
+        paths.extend((label_type, os.path.join(hyps_dir, "hyps.%s.txt" % label_type))
+                     for label_type in self.label_types)
+        for label_type, path in paths:
+            with open(path, "w", encoding=ENCODING) as hyps_f:
+                for hyp, fn in zip(hyps_by_label_type[label_type], feat_fns):
+                    print(fn, file=hyps_f)
+                    print(" ".join(hyp), file=hyps_f)
+                    print("", file=hyps_f)
+
+    def eval(self, restore_model_path: Optional[str]=None,
+             profile_every: int = 0) -> None:
+        """ Evaluates the model on the test set in every tier.
+
+        As well as the primary label type's results in test/hyps, test/refs
+        and test/test_per, as written by `Model.eval()`, each label type's
+        hypotheses and references are written to test/hyps.<label_type> and
+        test/refs.<label_type>, and its LER is added to test/test_per.
+        """
+
+        saver = tf.train.Saver()
+        with tf.Session(config=model.allow_growth_config) as sess:
+            if not restore_model_path:
+                assert self.saved_model_path, "{}".format(self.saved_model_path)
+                restore_model_path = self.saved_model_path
+            saver.restore(sess, restore_model_path)
+
+            test_x, test_x_lens, test_y = self.corpus_reader.test_batch()
+            feed_dict = self.make_feed_dict(test_x, test_x_lens, test_y)
+
+            fetches = []
+            for label_type in self.label_types:
+                fetches.extend([self.ler_by_label_type[label_type],
+                                self.dense_decoded_by_label_type[label_type],
+                                self.dense_ref_by_label_type[label_type]])
+            profiler = profiling.StepProfiler(
+                os.path.join(self.exp_dir, "profile"), "eval", profile_every)
+            results = profiler.run(sess, fetches, feed_dict=feed_dict)
+
+        hyps_dir = os.path.join(self.exp_dir, "test")
+        if not os.path.isdir(hyps_dir):
+            os.mkdir(hyps_dir)
+        test_lers = []
+        for i, corpus in enumerate(self.corpus_reader.corpora):
+            test_ler, dense_decoded, dense_ref = results[3*i:3*i+3]
+            hyps = _human_readable(corpus, dense_decoded)
+            refs = _human_readable(corpus, dense_ref)
+            if i == 0:
+                model.write_transcripts(os.path.join(hyps_dir, "hyps"), hyps)
+                model.write_transcripts(os.path.join(hyps_dir, "refs"), refs)
+            model.write_transcripts(
+                os.path.join(hyps_dir, "hyps.%s" % corpus.label_type), hyps)
+            model.write_transcripts(
+                os.path.join(hyps_dir, "refs.%s" % corpus.label_type), refs)
+            test_lers.append((corpus.label_type, test_ler))
+
+        with open(os.path.join(hyps_dir, "test_per"), "w",
+                  encoding=ENCODING) as per_f:
+            print("LER: %f" % (test_lers[0][1]), file=per_f)
+            for label_type, test_ler in test_lers:
+                print("%s LER: %f" % (label_type, test_ler), file=per_f)
+
+def decode(model_path_prefix: Union[str, Path],
+           input_paths: Sequence[Path],
+           label_sets: Dict[str, Set[str]],
+           *,
+           feature_type: str = "fbank",
+           batch_size: int = 64,
+           feat_dir: Optional[Path]=None,
+           batch_x_name: str="batch_x:0",
+           batch_x_lens_name: str="batch_x_lens:0",
+           output_names: Optional[Dict[str, str]]=None
+          ) -> Dict[str, List[List[str]]]:
+    """ Uses a saved multi-task model to transcribe WAV files in every tier
+    in one pass.
+
+    Args:
+        model_path_prefix: The path to the saved tensorflow model.
+                           This is the full prefix to the ".ckpt" file.
+        input_paths: A sequence of `pathlib.Path`s to WAV files to put through
+                     the model provided.
+        label_sets: Maps each label type to decode to the set of all the
+                    labels of that type the model uses.
+        feature_type: The type of features the model was trained on.
+        batch_size: The number of utterances decoded at once.
+        feat_dir: Any files that require preprocessing will be saved to the
+                  path specified by this.
+        batch_x_name: The name of the tensorflow input for batch_x
+        batch_x_lens_name: The name of the tensorflow input for batch_x_lens
+        output_names: Maps each label type to the name of the tensorflow
+                      output for it. Defaults to the names `Model` gives them.
+
+    Returns:
+        A dictionary mapping each label type to the transcriptions of the
+        WAV files in that tier.
+    """
+
+    model_path_prefix = str(model_path_prefix)
+    label_types = sorted(label_sets)
+    if output_names is None:
+        output_names = {label_type: "hyp_dense_decoded_%s:0" % label_type
+                        for label_type in label_types}
+    fetches = [output_names[label_type] for label_type in label_types]
+
+    feat_paths = model.prepare_input_feats(input_paths, feature_type, feat_dir)
+    fn_batches = utils.make_batches(feat_paths, batch_size)
+    metagraph = model.load_metagraph(model_path_prefix)
+    dense_decoded = {label_type: [] for label_type in label_types} # type: Dict[str, List]
+    with tf.Session() as sess:
+        metagraph.restore(sess, model_path_prefix)
+        for fn_batch in fn_batches:
+            batch_x, batch_x_lens = utils.load_batch_x(fn_batch)
+            feed_dict = {batch_x_name: batch_x,
+                         batch_x_lens_name: batch_x_lens}
+            for label_type, tier in zip(label_types,
+                                        sess.run(fetches, feed_dict=feed_dict)):
+                dense_decoded[label_type].extend(tier)
+
+    return {label_type: model.dense_to_human_readable(
+                dense_decoded[label_type],
+                labels.make_indices_to_labels(label_sets[label_type]))
+            for label_type in label_types}
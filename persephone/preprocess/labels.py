@@ -3,7 +3,9 @@ Offers functions for tokenizing utterances into phonemes, characters or
 other symbols.
 """
 
-from typing import Callable, Iterable, NamedTuple, Set, Dict
+import functools
+import multiprocessing
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Set
 
 from ..utterance import Utterance
 
@@ -65,6 +67,78 @@ def segment_into_chars(utterance: str) -> str:
         utterance = utterance.replace(char, "")
     return " ".join(utterance)
 
+class Tokenizer:
+    """
+    Segments utterances into tokens from an inventory, exactly as
+    segment_into_tokens() does, but with the inventory compiled into a trie
+    once, so that segmenting takes time linear in the length of the
+    utterance.
+
+    Args:
+        token_inventory: The tokens to segment into.
+    """
+
+    def __init__(self, token_inventory: Iterable[str]) -> None:
+        self.token_inventory = frozenset(token_inventory)
+        # Each node maps the next character to a child node, and None to
+        # True if the characters leading to it spell a token.
+        self._trie = {} # type: Dict[Any, Any]
+        for token in self.token_inventory:
+            node = self._trie
+            for char in token:
+                node = node.setdefault(char, {})
+            node[None] = True
+
+    def tokens(self, utterance: str) -> List[str]:
+        """ The tokens of an utterance, taking the longest token in the
+        inventory that the rest of the utterance starts with each time, and
+        skipping characters that start no token. """
+
+        tokens = []
+        start = 0
+        while start < len(utterance):
+            node = self._trie
+            end = start
+            for pos in range(start, len(utterance)):
+                node = node.get(utterance[pos])
+                if node is None:
+                    break
+                if None in node:
+                    end = pos + 1
+            if end > start:
+                tokens.append(utterance[start:end])
+                start = end
+            else:
+                # If the next character is preventing segmentation, move on.
+                start += 1
+        return tokens
+
+    def segment(self, utterance: str) -> str:
+        """ Segments an utterance into space delimited tokens. """
+
+        if not isinstance(utterance, str):
+            raise TypeError("Input type must be a string. Got {}.".format(type(utterance)))
+        return " ".join(self.tokens(utterance))
+
+    def __call__(self, utterance: str) -> str:
+        return self.segment(utterance)
+
+    def segment_all(self, utterances: Iterable[str],
+                    num_processes: int = 1) -> List[str]:
+        """ Segments each of a number of utterances, optionally dividing them
+        between a pool of processes. """
+
+        utterances = list(utterances)
+        if num_processes <= 1 or len(utterances) < 2 * num_processes:
+            return [self.segment(utterance) for utterance in utterances]
+        chunksize = -(-len(utterances) // (4 * num_processes))
+        with multiprocessing.get_context("spawn").Pool(num_processes) as pool:
+            return pool.map(self.segment, utterances, chunksize=chunksize)
+
+@functools.lru_cache(maxsize=32)
+def _inventory_tokenizer(token_inventory: frozenset) -> Tokenizer:
+    return Tokenizer(token_inventory)
+
 def segment_into_tokens(utterance: str, token_inventory: Iterable[str]):
     """
     Segments an utterance (a string) into tokens based on an inventory of
@@ -72,7 +146,9 @@ def segment_into_tokens(utterance: str, token_inventory: Iterable[str]):
 
     The approach: Given the rest of the utterance, find the largest token (in
     character length) that is found in the token_inventory, and treat that as a
-    token before segmenting the rest of the string.
+    token before segmenting the rest of the string. The Tokenizer for each
+    inventory is built once and reused; to segment many utterances, use a
+    Tokenizer directly.
 
     Note: Your orthography may open the door to ambiguities in the
     segmentation. Hopefully not, but another alternative it to simply segment
@@ -82,31 +158,7 @@ def segment_into_tokens(utterance: str, token_inventory: Iterable[str]):
     if not isinstance(utterance, str):
         raise TypeError("Input type must be a string. Got {}.".format(type(utterance)))
 
-    # Token inventory needs to be hashable for speed
-    token_inventory = set(token_inventory)
-    # Get the size of the longest token in the inventory
-    max_len = len(sorted(list(token_inventory), key=lambda x: len(x))[-1])
-
-    def segment_token(utterance):
-        if utterance == "":
-            return "", ""
-
-        for i in range(max_len, 0, -1):
-            if utterance[:i] in token_inventory:
-                return utterance[:i], utterance[i:]
-        # If the next character is preventing segmentation, move on.
-        # TODO This needs to be logged with a warning on the first occurrence.
-        return "", utterance[1:]
-
-    tokens = []
-    head, tail = segment_token(utterance)
-    tokens.append(head)
-    while tail != "":
-        head, tail = segment_token(tail)
-        tokens.append(head)
-    tokens = [tok for tok in tokens if tok != ""]
-
-    return " ".join(tokens)
+    return _inventory_tokenizer(frozenset(token_inventory)).segment(utterance)
 
 def make_indices_to_labels(labels: Set[str]) -> Dict[int, str]:
     """ Creates a mapping from indices to labels. """
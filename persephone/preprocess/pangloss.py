@@ -41,7 +41,7 @@ def get_sents_times_and_translations(xml_fn):
     assert False, root.tag
 
 def remove_content_in_brackets(sentence, brackets="[]"):
-    out_sentence = ''
+    out_chars = []
     skip_c = 0
     for c in sentence:
         if c == brackets[0]:
@@ -49,5 +49,5 @@ def remove_content_in_brackets(sentence, brackets="[]"):
         elif c == brackets[1] and skip_c > 0:
             skip_c -= 1
         elif skip_c == 0:
-            out_sentence += c
-    return out_sentence
+            out_chars.append(c)
+    return "".join(out_chars)
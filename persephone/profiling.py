@@ -0,0 +1,111 @@
+""" Tracing sampled Tensorflow steps to see which graph ops take the time.
+
+A `StepProfiler` wraps `tf.Session.run()`. Every Nth call it asks Tensorflow
+for a full trace of the step and writes it to the profile directory as a
+Chrome trace (open it at chrome://tracing), and adds the time each op took to
+a table of per-op-type totals that is rewritten after every traced step. All
+other calls, and every call when profiling is disabled, go straight to
+`tf.Session.run()`.
+"""
+
+import collections
+import logging
+import os
+from pathlib import Path
+from typing import Any, Dict, Optional, Union
+
+import tensorflow as tf
+from tensorflow.python.client import timeline
+
+from .config import ENCODING
+
+logger = logging.getLogger(__name__) # type: ignore
+
+def _op_type(node_stats: Any) -> str:
+    """ The op type of a traced node. Timeline labels look like
+    "name = OpType(inputs)". """
+
+    label = node_stats.timeline_label
+    if " = " in label:
+        return label.split(" = ", 1)[1].split("(", 1)[0]
+    return node_stats.node_name
+
+class StepProfiler:
+    """ Traces every Nth step run through it.
+
+    Args:
+        profile_dir: The directory traces and op tables are written to.
+        name: Prefixes the names of files written, so that profilers for
+              different kinds of step can share a directory.
+        every: Trace the first step and every `every` steps after it. If 0,
+               nothing is traced.
+    """
+
+    def __init__(self, profile_dir: Union[str, Path], name: str,
+                 every: int = 0) -> None:
+        self.profile_dir = str(profile_dir)
+        self.name = name
+        self.every = every
+        self.step = 0
+        self.num_traced = 0
+        # Total microseconds and number of executions by op type.
+        self.op_micros = collections.Counter() # type: Dict[str, int]
+        self.op_counts = collections.Counter() # type: Dict[str, int]
+
+    @property
+    def enabled(self) -> bool:
+        """ Whether any steps are traced. """
+        return self.every > 0
+
+    def run(self, sess: tf.Session, fetches: Any,
+            feed_dict: Optional[Dict] = None) -> Any:
+        """ Runs fetches in sess like `tf.Session.run()`, tracing the step if
+        it is due. """
+
+        step = self.step
+        self.step += 1
+        if not self.every or step % self.every != 0:
+            return sess.run(fetches, feed_dict=feed_dict)
+
+        run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+        run_metadata = tf.RunMetadata()
+        result = sess.run(fetches, feed_dict=feed_dict, options=run_options,
+                          run_metadata=run_metadata)
+        self._record(step, run_metadata)
+        return result
+
+    def _record(self, step: int, run_metadata: Any) -> None:
+        """ Writes the trace of a step and updates the op table. """
+
+        if not os.path.isdir(self.profile_dir):
+            os.makedirs(self.profile_dir)
+
+        trace = timeline.Timeline(run_metadata.step_stats)
+        trace_path = os.path.join(
+            self.profile_dir, "%s_step%d.timeline.json" % (self.name, step))
+        with open(trace_path, "w", encoding=ENCODING) as trace_f:
+            trace_f.write(trace.generate_chrome_trace_format())
+
+        for dev_stats in run_metadata.step_stats.dev_stats:
+            for node_stats in dev_stats.node_stats:
+                op_type = _op_type(node_stats)
+                self.op_micros[op_type] += node_stats.all_end_rel_micros
+                self.op_counts[op_type] += 1
+        self.num_traced += 1
+        self.write_op_table()
+        logger.info("Wrote trace of %s step %d to %s", self.name, step, trace_path)
+
+    def write_op_table(self) -> None:
+        """ Writes the time spent in each op type over all traced steps,
+        most expensive first, as tab separated values. """
+
+        total_micros = sum(self.op_micros.values())
+        table_path = os.path.join(self.profile_dir, "%s_ops.tsv" % self.name)
+        with open(table_path, "w", encoding=ENCODING) as table_f:
+            print("op_type\ttotal_ms\tms_per_step\tcount\tfraction", file=table_f)
+            for op_type, micros in self.op_micros.most_common():
+                print("%s\t%.3f\t%.3f\t%d\t%.4f" % (
+                    op_type, micros / 1000, micros / 1000 / self.num_traced,
+                    self.op_counts[op_type],
+                    micros / total_micros if total_micros else 0.0),
+                      file=table_f)
@@ -0,0 +1,236 @@
+""" Shrinking a trained `rnn_ctc.Model` by removing its least important LSTM
+units.
+
+The cost of running a bidirectional LSTM layer grows with the square of its
+hidden size, so removing units from a trained model can speed up
+transcription considerably for a small loss in accuracy, which a few epochs
+of fine-tuning mostly recover. `prune()` scores every unit of every layer and
+direction by the magnitude of its weights, keeping the same number of the
+highest scoring units in each, and slices the trained variables down to
+them: each kept unit keeps its columns in all four gates of its cell, its
+recurrent and peephole weights and its rows in the input weights of the
+layer above or of the output layer. The pruned variables are loaded into a
+new `rnn_ctc.Model` with the smaller hidden size, which is fine-tuned and
+compared with the original on the test set::
+
+    pruned, report = pruning.prune(model, "exp/0/model/model_best.ckpt",
+                                   "exp/1", keep_fraction=0.5)
+
+The report is also written to pruning_report.json in the new experiment
+directory, alongside the new model's model_description.json.
+"""
+
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Any, Dict, Tuple, Union
+
+import numpy as np
+import tensorflow as tf
+
+from . import distill
+from . import model
+from . import rnn_ctc
+from .config import ENCODING
+from .exceptions import PersephoneException
+
+logger = logging.getLogger(__name__) # type: ignore
+
+DIRECTIONS = ("fw", "bw")
+# The blocks of an LSTM cell's kernel and bias columns, in order: the input
+# gate, the cell input, the forget gate and the output gate.
+NUM_GATES = 4
+PEEPHOLES = ("w_i_diag", "w_f_diag", "w_o_diag")
+# The output layer's variables, which rnn_ctc.Model creates unnamed.
+OUTPUT_WEIGHTS = "Variable"
+OUTPUT_BIAS = "Variable_1"
+
+def _cell_scope(layer: int, direction: str) -> str:
+    """ The variable scope of the LSTM cell of a layer and direction. """
+    return "layer_%d/bidirectional_rnn/%s/lstm_cell" % (layer, direction)
+
+def _gate_columns(units: np.ndarray, hidden_size: int) -> np.ndarray:
+    """ The kernel and bias columns of the given units in every gate. """
+    return np.concatenate([gate * hidden_size + units for gate in range(NUM_GATES)])
+
+def _layer_output_rows(keep: Dict[Tuple[int, str], np.ndarray], layer: int,
+                       hidden_size: int) -> np.ndarray:
+    """ The rows, in the input weights of whatever follows a layer, that
+    come from its kept units. The forward outputs precede the backward. """
+    return np.concatenate([keep[(layer, "fw")], hidden_size + keep[(layer, "bw")]])
+
+def unit_scores(values: Dict[str, np.ndarray], num_layers: int,
+                hidden_size: int) -> Dict[Tuple[int, str], np.ndarray]:
+    """ Scores the importance of each LSTM unit as the product of the norms
+    of its incoming weights (its gate columns) and its outgoing weights (its
+    recurrent rows and its rows in the next layer's input weights).
+
+    Args:
+        values: The values of the model's variables, keyed by name.
+        num_layers: The number of bidirectional layers.
+        hidden_size: The number of units in each direction of each layer.
+
+    Returns:
+        A dictionary mapping each (layer, direction) pair to an array of the
+        scores of its units.
+    """
+
+    scores = {}
+    for layer in range(num_layers):
+        if layer + 1 < num_layers:
+            next_inputs = [
+                values[_cell_scope(layer + 1, direction) + "/kernel"][:2*hidden_size]
+                for direction in DIRECTIONS]
+        else:
+            next_inputs = [values[OUTPUT_WEIGHTS]]
+        next_input_norms = np.sqrt(sum(np.sum(weights ** 2, axis=1)
+                                       for weights in next_inputs))
+        for direction_i, direction in enumerate(DIRECTIONS):
+            kernel = values[_cell_scope(layer, direction) + "/kernel"]
+            input_size = kernel.shape[0] - hidden_size
+            gates = kernel.reshape(kernel.shape[0], NUM_GATES, hidden_size)
+            incoming = np.sqrt(np.sum(gates ** 2, axis=(0, 1)))
+            recurrent = np.sum(kernel[input_size:] ** 2, axis=1)
+            outgoing_next = next_input_norms[direction_i*hidden_size:(direction_i+1)*hidden_size]
+            outgoing = np.sqrt(recurrent + outgoing_next ** 2)
+            scores[(layer, direction)] = incoming * outgoing
+    return scores
+
+def select_units(scores: Dict[Tuple[int, str], np.ndarray],
+                 new_hidden_size: int) -> Dict[Tuple[int, str], np.ndarray]:
+    """ The indices, in ascending order, of the new_hidden_size highest
+    scoring units of each layer and direction. """
+
+    return {key: np.sort(np.argsort(-unit_score, kind="stable")[:new_hidden_size])
+            for key, unit_score in scores.items()}
+
+def prune_values(values: Dict[str, np.ndarray], num_layers: int,
+                 hidden_size: int, keep: Dict[Tuple[int, str], np.ndarray]
+                ) -> Dict[str, np.ndarray]:
+    """ Slices the variables of a bidirectional LSTM/CTC model down to the
+    kept units.
+
+    Args:
+        values: The values of the model's variables, keyed by name.
+        num_layers: The number of bidirectional layers.
+        hidden_size: The number of units in each direction of each layer.
+        keep: The units to keep in each layer and direction, as returned by
+              `select_units()`. Every layer and direction must keep the same
+              number of units.
+
+    Returns:
+        The pruned values of the LSTM and output layer variables, keyed by
+        name.
+    """
+
+    pruned = {}
+    for layer in range(num_layers):
+        for direction in DIRECTIONS:
+            scope = _cell_scope(layer, direction)
+            units = keep[(layer, direction)]
+            kernel = values[scope + "/kernel"]
+            input_size = kernel.shape[0] - hidden_size
+            if layer == 0:
+                input_rows = np.arange(input_size)
+            else:
+                input_rows = _layer_output_rows(keep, layer - 1, hidden_size)
+            rows = np.concatenate([input_rows, input_size + units])
+            columns = _gate_columns(units, hidden_size)
+            pruned[scope + "/kernel"] = kernel[rows][:, columns]
+            pruned[scope + "/bias"] = values[scope + "/bias"][columns]
+            for peephole in PEEPHOLES:
+                if scope + "/" + peephole in values:
+                    pruned[scope + "/" + peephole] = values[scope + "/" + peephole][units]
+    output_rows = _layer_output_rows(keep, num_layers - 1, hidden_size)
+    pruned[OUTPUT_WEIGHTS] = values[OUTPUT_WEIGHTS][output_rows]
+    pruned[OUTPUT_BIAS] = values[OUTPUT_BIAS]
+    return pruned
+
+def prune(model_: rnn_ctc.Model, checkpoint_path: str,
+          exp_dir: Union[str, Path], *,
+          keep_fraction: float = 0.5,
+          early_stopping_steps: int = 3,
+          min_epochs: int = 1,
+          max_epochs: int = 10,
+          **train_kwargs: Any) -> Tuple[rnn_ctc.Model, Dict[str, Any]]:
+    """ Prunes the LSTM units of a trained model, fine-tunes the result and
+    compares the two on the test set.
+
+    Args:
+        model_: The trained model, whose graph must be the default graph.
+        checkpoint_path: The checkpoint of the model to prune.
+        exp_dir: The experiment directory for the pruned model.
+        keep_fraction: The fraction of the units in each layer and direction
+                       to keep.
+        early_stopping_steps: As for `Model.train()`, for fine-tuning.
+        min_epochs: As for `Model.train()`, for fine-tuning.
+        max_epochs: The most epochs to fine-tune for. If 0, the pruned model
+                    isn't fine-tuned.
+        train_kwargs: Other arguments to `Model.train()` for fine-tuning.
+
+    Returns:
+        A tuple of the pruned model and a report with `distill.benchmark()`
+        results "before" and "after" pruning, the "speedup" in decoding and
+        the "ler_increase".
+    """
+
+    if not isinstance(model_, rnn_ctc.Model):
+        raise PersephoneException("Only rnn_ctc.Model can be pruned, not %s." %
+                                  type(model_).__name__)
+    if not 0 < keep_fraction <= 1:
+        raise PersephoneException(
+            "keep_fraction must be in (0, 1], got %f." % keep_fraction)
+    num_layers = model_.num_layers
+    hidden_size = model_.hidden_size
+    new_hidden_size = max(1, int(round(hidden_size * keep_fraction)))
+
+    before = distill.benchmark(model_, checkpoint_path)
+    reader = tf.train.load_checkpoint(checkpoint_path)
+    values = {name: reader.get_tensor(name)
+              for name in reader.get_variable_to_shape_map()}
+    keep = select_units(unit_scores(values, num_layers, hidden_size), new_hidden_size)
+    pruned_values = prune_values(values, num_layers, hidden_size, keep)
+    logger.info("Pruning from %d to %d units per layer and direction",
+                hidden_size, new_hidden_size)
+
+    # Building the new model resets the default graph.
+    pruned = rnn_ctc.Model(exp_dir, model_.corpus_reader, num_layers=num_layers,
+                           hidden_size=new_hidden_size,
+                           beam_width=model_.beam_width,
+                           cell_type=model_.cell_type)
+    model_dir = os.path.join(pruned.exp_dir, "model")
+    if not os.path.isdir(model_dir):
+        os.makedirs(model_dir)
+    init_path = os.path.join(model_dir, "model_pruned.ckpt")
+    saver = tf.train.Saver()
+    with tf.Session(config=model.allow_growth_config) as sess:
+        # Optimizer state starts afresh.
+        sess.run(tf.global_variables_initializer())
+        for var in tf.global_variables():
+            if var.op.name in pruned_values:
+                var.load(pruned_values[var.op.name], sess)
+        saver.save(sess, init_path)
+
+    if max_epochs > 0:
+        pruned.train(restore_model_path=init_path,
+                     early_stopping_steps=early_stopping_steps,
+                     min_epochs=min_epochs, max_epochs=max_epochs, **train_kwargs)
+    else:
+        pruned.saved_model_path = init_path
+        pruned.eval(restore_model_path=init_path)
+    after = distill.benchmark(pruned, pruned.saved_model_path)
+
+    report = {"before": before,
+              "after": after,
+              "hidden_size": [hidden_size, new_hidden_size],
+              "speedup": before["decode_seconds"] / after["decode_seconds"],
+              "ler_increase": after["ler"] - before["ler"],
+              "kept_units": {"layer_%d/%s" % key: units.tolist()
+                             for key, units in sorted(keep.items())}}
+    with open(os.path.join(pruned.exp_dir, "pruning_report.json"), "w",
+              encoding=ENCODING) as report_f:
+        json.dump(report, report_f, indent=4)
+    logger.info("Pruned model decodes %.1fx as fast with %+f LER",
+                report["speedup"], report["ler_increase"])
+    return pruned, report
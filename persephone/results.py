@@ -1,12 +1,15 @@
 """ Miscellaneous functions relating to reporting experimental results."""
 
+import csv
+import json
 from pathlib import Path
-from typing import Set, Dict, Tuple, Sequence, List, Union
+from typing import Set, Dict, Iterable, Tuple, Sequence, List, Optional, Union
 
-from collections import Counter
-from . import utils
+import numpy as np
 
-from .distance import min_edit_distance_align
+from .config import ENCODING
+from .distance import batch_align, batch_edit_distance
+from .exceptions import PersephoneException
 
 def filter_labels(sent: Sequence[str], labels: Set[str] = None) -> List[str]:
     """ Returns only the tokens present in the sentence that are in labels."""
@@ -15,31 +18,161 @@ def filter_labels(sent: Sequence[str], labels: Set[str] = None) -> List[str]:
         return [tok for tok in sent if tok in labels]
     return list(sent)
 
+def _read_transcriptions(path: Union[str, Path]) -> List[List[str]]:
+    """ Reads a file of space separated transcriptions, one per line. """
+    with open(str(path), encoding=ENCODING) as transcriptions_f:
+        return [line.split() for line in transcriptions_f]
+
 def filtered_error_rate(hyps_path: Union[str, Path], refs_path: Union[str, Path], labels: Set[str]) -> float:
     """ Returns the error rate of hypotheses in hyps_path against references in refs_path after filtering only for labels in labels.
     """
-    if isinstance(hyps_path, Path):
-        hyps_path = str(hyps_path)
-    if isinstance(refs_path, Path):
-        refs_path = str(refs_path)
-
-    with open(hyps_path) as hyps_f:
-        lines = hyps_f.readlines()
-        hyps = [filter_labels(line.split(), labels) for line in lines]
-    with open(refs_path) as refs_f:
-        lines = refs_f.readlines()
-        refs = [filter_labels(line.split(), labels) for line in lines]
-
-    # For the case where there are no tokens left after filtering.
-    only_empty = True
-    for entry in hyps:
-        if entry is not []:
-            only_empty = False
-            break # found something so can move on immediately
-    if only_empty:
-        return -1
-
-    return utils.batch_per(hyps, refs)
+
+    return filtered_error_rates(hyps_path, refs_path, {"labels": labels})["labels"]
+
+def filtered_error_rates(hyps_path: Union[str, Path],
+                         refs_path: Union[str, Path],
+                         label_sets: Dict[str, Optional[Set[str]]], *,
+                         num_processes: int = 1) -> Dict[str, float]:
+    """ Returns the error rates of hypotheses in hyps_path against references
+    in refs_path after filtering for each of several label sets, as
+    `filtered_error_rate()` would for each of them. The files are read once
+    and the edit distances for all the label sets are found in one batch.
+
+    Args:
+        hyps_path: The hypotheses, one per line.
+        refs_path: The references, one per line.
+        label_sets: The labels to keep for each error rate, keyed by a name
+                    for it, such as "phonemes" or "tones". An empty or None
+                    label set keeps all labels.
+        num_processes: The number of processes to divide the edit distance
+                       calculations between, as for
+                       `distance.batch_edit_distance()`.
+
+    Returns:
+        The error rate for each label set, keyed by its name. These are -1
+        if there are no hypotheses.
+    """
+
+    hyps = _read_transcriptions(hyps_path)
+    refs = _read_transcriptions(refs_path)
+    # For the case where there are no hypotheses to score.
+    if not hyps:
+        return {name: -1 for name in label_sets}
+
+    names = list(label_sets)
+    all_hyps = [] # type: List[List[str]]
+    all_refs = [] # type: List[List[str]]
+    for name in names:
+        for hyp, ref in zip(hyps, refs):
+            all_hyps.append(filter_labels(hyp, label_sets[name]))
+            all_refs.append(filter_labels(ref, label_sets[name]))
+    distances = batch_edit_distance(all_refs, all_hyps,
+                                    num_processes=num_processes)
+
+    num_pairs = min(len(hyps), len(refs))
+    error_rates = {}
+    for name_i, name in enumerate(names):
+        pairs = range(name_i * num_pairs, (name_i + 1) * num_pairs)
+        macro_per = sum(int(distances[i]) / len(all_refs[i]) for i in pairs)
+        error_rates[name] = macro_per / len(hyps)
+    return error_rates
+
+class AlignmentSet:
+    """ The alignments of hypotheses with their references, made once and
+    shared by the report formatters, so that formatting several reports
+    aligns the hypotheses only once.
+
+    Args:
+        hyps: The hypotheses.
+        refs: The reference of each hypothesis.
+        num_processes: The number of processes to align with, as for
+                       `distance.batch_align()`.
+        alignments: Previously made alignments of refs with hyps, in the
+                    form `distance.min_edit_distance_align()` returns. If
+                    given, nothing is aligned.
+    """
+
+    def __init__(self, hyps: Sequence[Sequence[str]],
+                 refs: Sequence[Sequence[str]], *,
+                 num_processes: int = 1,
+                 alignments: Optional[List[List[Tuple[str, str]]]] = None
+                ) -> None:
+        if len(hyps) != len(refs):
+            raise PersephoneException(
+                "Got %d hypotheses but %d references." % (len(hyps), len(refs)))
+        self.hyps = [list(hyp) for hyp in hyps]
+        self.refs = [list(ref) for ref in refs]
+        if alignments is None:
+            alignments = batch_align(self.refs, self.hyps,
+                                     num_processes=num_processes)
+        self.alignments = alignments
+
+    def __len__(self) -> int:
+        return len(self.alignments)
+
+    @staticmethod
+    def cache_path(hyps_path: Union[str, Path]) -> Path:
+        """ Where the alignments of the hypotheses in hyps_path are saved. """
+        hyps_path = Path(hyps_path)
+        return hyps_path.with_name(hyps_path.name + ".alignments.json")
+
+    def save(self, path: Union[str, Path]) -> None:
+        """ Saves the hypotheses, references and alignments as JSON. """
+
+        with Path(path).open("w", encoding=ENCODING) as align_f:
+            json.dump({"hyps": self.hyps,
+                       "refs": self.refs,
+                       "alignments": self.alignments}, align_f)
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> "AlignmentSet":
+        """ Loads alignments saved by `save()`. """
+
+        with Path(path).open(encoding=ENCODING) as align_f:
+            saved = json.load(align_f)
+        alignments = [[tuple(arrow) for arrow in alignment]
+                      for alignment in saved["alignments"]]
+        return cls(saved["hyps"], saved["refs"], alignments=alignments)
+
+    @classmethod
+    def from_files(cls, hyps_path: Union[str, Path],
+                   refs_path: Union[str, Path], *,
+                   num_processes: int = 1) -> "AlignmentSet":
+        """ Aligns the transcriptions in hyps_path with those in refs_path,
+        such as the test/hyps and test/refs files written by `Model.eval()`.
+
+        The alignments are saved next to hyps_path, in the file named by
+        `cache_path()`, and loaded from there rather than made again for as
+        long as the transcriptions are unchanged.
+        """
+
+        with Path(hyps_path).open(encoding=ENCODING) as hyps_f:
+            hyps = [line.split() for line in hyps_f]
+        with Path(refs_path).open(encoding=ENCODING) as refs_f:
+            refs = [line.split() for line in refs_f]
+
+        cache_path = cls.cache_path(hyps_path)
+        if cache_path.is_file():
+            try:
+                cached = cls.load(cache_path)
+            except (ValueError, KeyError):
+                cached = None
+            if cached is not None and cached.hyps == hyps and cached.refs == refs:
+                return cached
+        alignment_set = cls(hyps, refs, num_processes=num_processes)
+        alignment_set.save(cache_path)
+        return alignment_set
+
+def _align(hyps: Sequence[Sequence[str]],
+           refs: Sequence[Sequence[str]],
+           alignment_set: Optional[AlignmentSet]) -> List[List[Tuple[str, str]]]:
+    """ The alignment of each reference with its hypothesis, taken from
+    alignment_set if there is one. """
+
+    if alignment_set is not None:
+        return alignment_set.alignments
+    pairs = list(zip(refs, hyps))
+    return batch_align([ref for ref, _ in pairs], [hyp for _, hyp in pairs])
 
 def latex_header() -> str:
     """ Produces a LaTeX header for the fmt_latex_*() functions to use. """
@@ -58,13 +191,14 @@ def fmt_latex_output(hyps: Sequence[Sequence[str]],
                      refs: Sequence[Sequence[str]],
                      prefixes: Sequence[str],
                      out_fn: Path,
+                     alignment_set: Optional[AlignmentSet] = None,
                     ) -> None:
     """ Output the hypotheses and references to a LaTeX source file for
-    pretty printing.
+    pretty printing. If alignment_set is given, its alignments of the
+    hypotheses and references are used.
     """
 
-    alignments_ = [min_edit_distance_align(ref, hyp)
-                  for hyp, ref in zip(hyps, refs)]
+    alignments_ = _align(hyps, refs, alignment_set)
 
     with out_fn.open("w") as out_f:
         print(latex_header(), file=out_f)
@@ -95,76 +229,262 @@ def fmt_latex_output(hyps: Sequence[Sequence[str]],
         print(r"\end{longtable}", file=out_f)
         print(r"\end{document}", file=out_f)
 
+class ErrorStats:
+    """ Counts of how often each reference label is aligned with each
+    hypothesis label, or with nothing, in integer matrices that can be
+    merged across shards of a test set and across experiments.
+
+    `counts[i, j]` is the number of times reference label i was aligned
+    with hypothesis label j. Labels are indexed as `Corpus.LABEL_TO_INDEX`
+    indexes them, from 1 in sorted order, and index 0, the padding index
+    there, stands for no label: row 0 counts insertions and column 0
+    deletions.
+
+    `first_refs[i]` and `first_deletions[i]` are the positions, among all
+    the arrows counted, of the first arrow with reference label i and of the
+    first arrow deleting it, or NEVER if there was none. Labels with equal
+    counts are reported in the order they were first seen.
+
+    Args:
+        labels: The labels to count.
+        counts: Initial counts, indexed as described above. Defaults to
+                zeros.
+        first_refs: Initial positions of each label's first occurrence as a
+                    reference label. Defaults to NEVER.
+        first_deletions: Initial positions of each label's first deletion.
+                         Defaults to NEVER.
+    """
+
+    NO_LABEL = "<none>"
+    NEVER = np.iinfo(np.int64).max
+
+    def __init__(self, labels: Iterable[str],
+                 counts: Optional[np.ndarray] = None,
+                 first_refs: Optional[np.ndarray] = None,
+                 first_deletions: Optional[np.ndarray] = None) -> None:
+        self.labels = sorted(set(labels))
+        self.label_to_index = {label: index for index, label
+                               in enumerate(self.labels, 1)}
+        size = len(self.labels) + 1
+        if counts is None:
+            counts = np.zeros((size, size), dtype=np.int64)
+        elif counts.shape != (size, size):
+            raise PersephoneException(
+                "Expected counts of shape %s for %d labels, got %s." % (
+                    (size, size), len(self.labels), counts.shape))
+        self.counts = counts
+        if first_refs is None:
+            first_refs = np.full(size, self.NEVER, dtype=np.int64)
+        if first_deletions is None:
+            first_deletions = np.full(size, self.NEVER, dtype=np.int64)
+        self.first_refs = first_refs
+        self.first_deletions = first_deletions
+
+    @classmethod
+    def from_corpus(cls, corpus) -> "ErrorStats":
+        """ Empty statistics over the labels of a `Corpus`. """
+        return cls(corpus.labels)
+
+    @classmethod
+    def from_alignments(cls, alignments: Iterable[Sequence[Tuple[str, str]]],
+                        labels: Optional[Iterable[str]] = None) -> "ErrorStats":
+        """ Counts the arrows of alignments over labels and whatever other
+        labels the alignments contain. """
+
+        alignments = list(alignments)
+        seen = {label for alignment in alignments
+                for arrow in alignment for label in arrow if label != ""}
+        stats = cls(seen | set(labels or ()))
+        stats.add(alignments)
+        return stats
+
+    def add(self, alignments: Iterable[Sequence[Tuple[str, str]]]) -> None:
+        """ Counts the arrows of alignments in the form returned by
+        `distance.min_edit_distance_align()`. """
+
+        size = len(self.labels) + 1
+        index = dict(self.label_to_index)
+        index[""] = 0
+        try:
+            cells = [index[ref] * size + index[hyp]
+                     for alignment in alignments for ref, hyp in alignment]
+        except KeyError as error:
+            raise PersephoneException(
+                "Label %s isn't one of the labels counted." % error)
+        cells = np.array(cells, dtype=np.int64)
+        # Arrows are numbered on from those already counted.
+        offset = int(self.counts.sum())
+        self.counts += np.bincount(cells, minlength=size * size
+                                  ).reshape(size, size)
+        refs = cells // size
+        deleted = np.where((cells % size == 0) & (refs != 0), refs, 0)
+        for first, seen in [(self.first_refs, refs),
+                            (self.first_deletions, deleted)]:
+            seen_indices, positions = np.unique(seen, return_index=True)
+            np.minimum.at(first, seen_indices, positions + offset)
+
+    def merge(self, other: "ErrorStats") -> "ErrorStats":
+        """ The sum of these and other statistics, over the labels of both. """
+
+        merged = ErrorStats(set(self.labels) | set(other.labels))
+        # The arrows of other are numbered on from those of these.
+        offset = 0
+        for stats in [self, other]:
+            rows = np.array([0] + [merged.label_to_index[label]
+                                   for label in stats.labels])
+            merged.counts[np.ix_(rows, rows)] += stats.counts
+            for merged_first, first in [
+                    (merged.first_refs, stats.first_refs),
+                    (merged.first_deletions, stats.first_deletions)]:
+                positions = np.where(first == self.NEVER, self.NEVER, first + offset)
+                np.minimum.at(merged_first, rows, positions)
+            offset += int(stats.counts.sum())
+        return merged
+
+    def __add__(self, other: "ErrorStats") -> "ErrorStats":
+        return self.merge(other)
+
+    @property
+    def num_correct(self) -> int:
+        """ The number of labels correctly recognized. """
+        return int(np.trace(self.counts[1:, 1:]))
+
+    @property
+    def num_substitutions(self) -> int:
+        """ The number of labels recognized as another label. """
+        return int(self.counts[1:, 1:].sum()) - self.num_correct
+
+    @property
+    def num_deletions(self) -> int:
+        """ The number of reference labels with nothing aligned to them. """
+        return int(self.counts[1:, 0].sum())
+
+    @property
+    def num_insertions(self) -> int:
+        """ The number of hypothesis labels with nothing aligned to them. """
+        return int(self.counts[0, 1:].sum())
+
+    def deletions(self) -> List[Tuple[str, int]]:
+        """ The labels that were deleted with how often they were, most
+        often deleted first. """
+
+        order = np.lexsort((self.first_deletions[1:], -self.counts[1:, 0]))
+        return [(self.labels[i], int(self.counts[i + 1, 0]))
+                for i in order if self.counts[i + 1, 0]]
+
+    def frequent_labels(self, max_width: int) -> List[str]:
+        """ The max_width labels that occur most often in the references. """
+
+        ref_totals = self.counts[1:].sum(axis=1)
+        order = np.lexsort((self.first_refs[1:], -ref_totals))
+        return [self.labels[i] for i in order if ref_totals[i]][:max_width]
+
+    def fmt_error_types(self) -> str:
+        """ Formats the numbers of substitutions, deletions and insertions,
+        and which labels were deleted. """
+
+        fmt_pieces = []
+        fmt = "{:15}{:<4}\n"
+        fmt_pieces.append(fmt.format("Substitutions", self.num_substitutions))
+        fmt_pieces.append(fmt.format("Deletions", self.num_deletions))
+        fmt_pieces.append(fmt.format("Insertions", self.num_insertions))
+        fmt_pieces.append("\n")
+        fmt_pieces.append("Deletions:\n")
+        fmt_pieces.extend(["{:4}{:<4}\n".format(label, count)
+                           for label, count in self.deletions()])
+        return "".join(fmt_pieces)
+
+    def fmt_confusion_matrix(self, max_width: int = 25) -> str:
+        """ Formats the confusion matrix of the max_width most frequent
+        reference labels as text. """
+
+        labels = self.frequent_labels(max_width)
+        indices = [self.label_to_index[label] for label in labels]
+        format_pieces = []
+        fmt = "{:3} "*(len(labels)+1)
+        format_pieces.append(fmt.format(" ", *labels))
+        fmt = "{:3} " + ("{:<3} " * (len(labels)))
+        for ref, ref_index in zip(labels, indices):
+            ref_results = self.counts[ref_index, indices].tolist()
+            format_pieces.append(fmt.format(ref, *ref_results))
+        return "\n".join(format_pieces)
+
+    def fmt_latex_confusion_matrix(self, max_width: int = 25) -> str:
+        """ Formats the confusion matrix of the max_width most frequent
+        reference labels as a LaTeX table, with references as rows. """
+
+        labels = self.frequent_labels(max_width)
+        indices = [self.label_to_index[label] for label in labels]
+        escaped = [label.replace(r"_", r"\_") for label in labels]
+        lines = ["\\begin{tabular}{l%s}" % ("r" * len(labels)),
+                 r"\toprule",
+                 " & ".join([""] + escaped) + r" \\",
+                 r"\midrule"]
+        for label, ref_index in zip(escaped, indices):
+            counts = [str(count) for count in self.counts[ref_index, indices]]
+            lines.append(" & ".join([label] + counts) + r" \\")
+        lines.extend([r"\bottomrule", r"\end{tabular}"])
+        return "\n".join(lines)
+
+    def write_csv(self, path: Union[str, Path]) -> None:
+        """ Writes all the counts as CSV, with reference labels as rows and
+        hypothesis labels as columns, and NO_LABEL first in each. """
+
+        names = [self.NO_LABEL] + self.labels
+        with Path(path).open("w", encoding=ENCODING, newline="") as csv_f:
+            writer = csv.writer(csv_f)
+            writer.writerow(["ref/hyp"] + names)
+            for name, row in zip(names, self.counts.tolist()):
+                writer.writerow([name] + row)
+
+    def save(self, path: Union[str, Path]) -> None:
+        """ Saves the labels, counts and first positions as JSON. """
+
+        with Path(path).open("w", encoding=ENCODING) as stats_f:
+            json.dump({"labels": self.labels,
+                       "counts": self.counts.tolist(),
+                       "first_refs": self.first_refs.tolist(),
+                       "first_deletions": self.first_deletions.tolist()},
+                      stats_f)
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> "ErrorStats":
+        """ Loads statistics saved by `save()`. """
+
+        with Path(path).open(encoding=ENCODING) as stats_f:
+            saved = json.load(stats_f)
+        firsts = [np.array(saved[key], dtype=np.int64) if key in saved else None
+                  for key in ["first_refs", "first_deletions"]]
+        return cls(saved["labels"], np.array(saved["counts"], dtype=np.int64),
+                   *firsts)
+
 def fmt_error_types(hyps: Sequence[Sequence[str]],
-                    refs: Sequence[Sequence[str]]
+                    refs: Sequence[Sequence[str]],
+                    alignment_set: Optional[AlignmentSet] = None
                    ) -> str:
-    """ Format some information about different error types: insertions, deletions and substitutions."""
-
-    alignments = [min_edit_distance_align(ref, hyp)
-                  for hyp, ref in zip(hyps, refs)]
-
-    arrow_counter = Counter() # type: Dict[Tuple[str, str], int]
-    for alignment in alignments:
-        arrow_counter.update(alignment)
-    sub_count = sum([count for arrow, count in arrow_counter.items()
-                if arrow[0] != arrow[1] and arrow[0] != "" and arrow[1] != ""])
-    dels = [(arrow[0], count) for arrow, count in arrow_counter.items()
-            if arrow[0] != arrow[1] and arrow[0] != "" and arrow[1] == ""]
-    del_count = sum([count for arrow, count in dels])
-    ins_count = sum([count for arrow, count in arrow_counter.items()
-                if arrow[0] != arrow[1] and arrow[0] == "" and arrow[1] != ""])
-    total = sum([count for _, count in arrow_counter.items()])
-
-    fmt_pieces = []
-    fmt = "{:15}{:<4}\n"
-    fmt_pieces.append(fmt.format("Substitutions", sub_count))
-    fmt_pieces.append(fmt.format("Deletions", del_count))
-    fmt_pieces.append(fmt.format("Insertions", ins_count))
-    fmt_pieces.append("\n")
-    fmt_pieces.append("Deletions:\n")
-    fmt_pieces.extend(["{:4}{:<4}\n".format(label, count)
-                       for label, count in
-                       sorted(dels, reverse=True, key=lambda x: x[1])])
-
-    return "".join(fmt_pieces)
+    """ Format some information about different error types: insertions, deletions and substitutions.
+    If alignment_set is given, its alignments of the hypotheses and references are used."""
+
+    alignments = _align(hyps, refs, alignment_set)
+    return ErrorStats.from_alignments(alignments).fmt_error_types()
 
 
 def fmt_confusion_matrix(hyps: Sequence[Sequence[str]],
                          refs: Sequence[Sequence[str]],
                          label_set: Set[str] = None,
-                         max_width: int = 25) -> str:
+                         max_width: int = 25,
+                         alignment_set: Optional[AlignmentSet] = None) -> str:
     """ Formats a confusion matrix over substitutions, ignoring insertions
-    and deletions. """
+    and deletions. If alignment_set is given, its alignments of the
+    hypotheses and references are used. """
 
     if not label_set:
         # Then determine the label set by reading
         raise NotImplementedError()
 
-    alignments = [min_edit_distance_align(ref, hyp)
-                  for hyp, ref in zip(hyps, refs)]
-
-    arrow_counter = Counter() # type: Dict[Tuple[str, str], int]
-    for alignment in alignments:
-        arrow_counter.update(alignment)
-
-    ref_total = Counter() # type: Dict[str, int]
-    for alignment in alignments:
-        ref_total.update([arrow[0] for arrow in alignment])
-
-    labels = [label for label, count
-              in sorted(ref_total.items(), key=lambda x: x[1], reverse=True)
-              if label != ""][:max_width]
-
-    format_pieces = []
-    fmt = "{:3} "*(len(labels)+1)
-    format_pieces.append(fmt.format(" ", *labels))
-    fmt = "{:3} " + ("{:<3} " * (len(labels)))
-    for ref in labels:
-        # TODO
-        ref_results = [arrow_counter[(ref, hyp)] for hyp in labels]
-        format_pieces.append(fmt.format(ref, *ref_results))
-
-    return "\n".join(format_pieces)
+    alignments = _align(hyps, refs, alignment_set)
+    stats = ErrorStats.from_alignments(alignments, label_set)
+    return stats.fmt_confusion_matrix(max_width)
 
 def fmt_latex_untranscribed(hyps: Sequence[Sequence[str]],
                             prefixes: Sequence[str],
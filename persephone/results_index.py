@@ -0,0 +1,244 @@
+""" An index of the results of many experiments.
+
+Each numbered experiment directory made by `experiment.prep_exp_dir()` or
+`experiment.prep_sub_exp_dir()` holds a trained model's best_scores.txt,
+test/test_per, train_description.txt and model_description.json. A
+`ResultsIndex` scans every such directory under a root, reading them in
+parallel threads, and keeps one row per experiment in a columnar table::
+
+    index = results_index.ResultsIndex("exp")
+    index.refresh()
+    for feat_type, row in index.best("test_ler", by="feat_type").items():
+        print(feat_type, row["exp_dir"], row["test_ler"])
+
+The table is cached in results_index.json under the root, and refreshing
+only reads the directories whose files have changed since.
+"""
+
+import json
+import logging
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Union
+
+from .config import ENCODING
+
+logger = logging.getLogger(__name__) # type: ignore
+
+CACHE_FILENAME = "results_index.json"
+# The files of an experiment directory that the index reads.
+RESULT_FILES = ["best_scores.txt", os.path.join("test", "test_per"),
+                "train_description.txt", "model_description.json"]
+# Columns the index sets itself. model_description.json records the exp_dir
+# the model was built with, which needn't be the path the index found it at.
+RESERVED_COLUMNS = {"exp_dir", "mtime"}
+
+_BEST_SCORES_RE = re.compile(
+    r"Epoch (\d+)\. Training LER: ([\d.einf-]+), validation LER: ([\d.einf-]+)")
+
+def _parse_value(value: str) -> Any:
+    """ Converts a value written by `Model.train()` to train_description.txt
+    back to an int, float, bool or None where it was one. """
+
+    constants = {"None": None, "True": True, "False": False}
+    if value in constants:
+        return constants[value]
+    for convert in [int, float]:
+        try:
+            return convert(value)
+        except ValueError:
+            pass
+    return value
+
+def _read_lines(path: str) -> List[str]:
+    if not os.path.isfile(path):
+        return []
+    with open(path, encoding=ENCODING) as in_f:
+        return [line.strip() for line in in_f if line.strip()]
+
+def result_mtime(exp_dir: str) -> float:
+    """ The latest modification time of the result files of exp_dir, or 0 if
+    it has none. """
+
+    mtimes = [0.0]
+    for filename in RESULT_FILES:
+        try:
+            mtimes.append(os.stat(os.path.join(exp_dir, filename)).st_mtime)
+        except OSError:
+            pass
+    return max(mtimes)
+
+def parse_exp_dir(exp_dir: str) -> Dict[str, Any]:
+    """ Reads the results and settings of an experiment into a row of the
+    index.
+
+    Args:
+        exp_dir: The experiment directory.
+
+    Returns:
+        A dictionary with the "exp_dir", the "mtime" of its result files, the
+        "best_epoch" and its "best_train_ler" and "best_valid_ler", the
+        "test_ler" (and a "test_ler_<label type>" for each label type of a
+        multi-task model), the scalar values in model_description.json and
+        the values in train_description.txt, other than any exp_dir or mtime
+        they hold. Values whose files are missing are left out.
+    """
+
+    row = {"exp_dir": exp_dir, "mtime": result_mtime(exp_dir)} # type: Dict[str, Any]
+
+    desc_path = os.path.join(exp_dir, "model_description.json")
+    if os.path.isfile(desc_path):
+        try:
+            with open(desc_path, encoding=ENCODING) as desc_f:
+                desc = json.load(desc_f)
+        except ValueError:
+            logger.warning("Couldn't parse %s", desc_path)
+        else:
+            row.update({key: val for key, val in desc.items()
+                        if isinstance(val, (str, int, float, bool))
+                        and key not in RESERVED_COLUMNS})
+
+    for line in _read_lines(os.path.join(exp_dir, "train_description.txt")):
+        key, sep, value = line.partition("=")
+        if sep and key not in RESERVED_COLUMNS:
+            row[key] = _parse_value(value)
+
+    for line in _read_lines(os.path.join(exp_dir, "best_scores.txt")):
+        match = _BEST_SCORES_RE.match(line)
+        if match:
+            row["best_epoch"] = int(match.group(1))
+            row["best_train_ler"] = float(match.group(2))
+            row["best_valid_ler"] = float(match.group(3))
+
+    for line in _read_lines(os.path.join(exp_dir, "test", "test_per")):
+        name, sep, value = line.rpartition("LER: ")
+        if sep:
+            column = "test_ler"
+            if name.strip():
+                column += "_" + name.strip()
+            row[column] = float(value)
+
+    return row
+
+def find_exp_dirs(root: Union[str, Path]) -> List[str]:
+    """ The numbered experiment directories under root, including numbered
+    subdirectories of them, that have any result files. """
+
+    exp_dirs = []
+    pending = [str(root)]
+    while pending:
+        directory = pending.pop()
+        try:
+            entries = os.listdir(directory)
+        except OSError:
+            continue
+        for name in entries:
+            path = os.path.join(directory, name)
+            if name.isdigit() and os.path.isdir(path):
+                if result_mtime(path):
+                    exp_dirs.append(path)
+                pending.append(path)
+    return sorted(exp_dirs)
+
+class ResultsIndex:
+    """ A table of the results of all the experiments under a directory,
+    with a column for each value found in any of them.
+
+    Args:
+        root: The directory holding the numbered experiment directories.
+        cache_path: Where the table is cached. Defaults to
+                    results_index.json in root.
+        num_threads: The number of threads reading experiment directories.
+    """
+
+    def __init__(self, root: Union[str, Path],
+                 cache_path: Optional[Union[str, Path]] = None,
+                 num_threads: int = 8) -> None:
+        self.root = str(root)
+        if cache_path is None:
+            cache_path = os.path.join(self.root, CACHE_FILENAME)
+        self.cache_path = str(cache_path)
+        self.num_threads = num_threads
+        self.columns = {} # type: Dict[str, List[Any]]
+        if os.path.isfile(self.cache_path):
+            try:
+                with open(self.cache_path, encoding=ENCODING) as cache_f:
+                    self.columns = json.load(cache_f)["columns"]
+            except (ValueError, KeyError):
+                logger.warning("Ignoring unreadable results cache %s",
+                               self.cache_path)
+
+    def __len__(self) -> int:
+        return len(self.columns.get("exp_dir", []))
+
+    def rows(self, **equals: Any) -> List[Dict[str, Any]]:
+        """ The rows of the table, leaving out missing values, that have the
+        given values in the given columns. """
+
+        names = list(self.columns)
+        rows = []
+        for values in zip(*[self.columns[name] for name in names]):
+            row = {name: value for name, value in zip(names, values)
+                   if value is not None}
+            if all(row.get(name) == value for name, value in equals.items()):
+                rows.append(row)
+        return rows
+
+    def _set_rows(self, rows: List[Dict[str, Any]]) -> None:
+        names = sorted({name for row in rows for name in row})
+        self.columns = {name: [row.get(name) for row in rows] for name in names}
+
+    def refresh(self) -> int:
+        """ Brings the table up to date with the experiment directories,
+        reading only those that are new or whose result files have changed
+        since they were last read, and saves it to the cache.
+
+        Returns:
+            The number of experiment directories read.
+        """
+
+        cached = {row["exp_dir"]: row for row in self.rows()}
+        exp_dirs = find_exp_dirs(self.root)
+        with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+            mtimes = list(executor.map(result_mtime, exp_dirs))
+            stale = [exp_dir for exp_dir, mtime in zip(exp_dirs, mtimes)
+                     if exp_dir not in cached or cached[exp_dir]["mtime"] != mtime]
+            for row in executor.map(parse_exp_dir, stale):
+                cached[row["exp_dir"]] = row
+        self._set_rows([cached[exp_dir] for exp_dir in exp_dirs])
+
+        with open(self.cache_path, "w", encoding=ENCODING) as cache_f:
+            json.dump({"columns": self.columns}, cache_f)
+        logger.info("Read %d of %d experiment directories under %s",
+                    len(stale), len(exp_dirs), self.root)
+        return len(stale)
+
+    def best(self, metric: str = "test_ler", by: Optional[str] = None,
+             **equals: Any) -> Dict[Any, Dict[str, Any]]:
+        """ The rows with the lowest value of metric.
+
+        Args:
+            metric: The column to minimize, such as "test_ler" or
+                    "best_valid_ler".
+            by: If given, the best row is found for each value of this
+                column, such as "feat_type".
+            equals: Only rows with these values in these columns are
+                    considered.
+
+        Returns:
+            A dictionary mapping each value of the by column to its best
+            row, or None to the best row overall if by isn't given. Rows
+            without the metric, or without a value in the by column, are
+            left out.
+        """
+
+        best = {} # type: Dict[Any, Dict[str, Any]]
+        for row in self.rows(**equals):
+            if metric not in row or (by is not None and by not in row):
+                continue
+            key = row[by] if by is not None else None
+            if key not in best or row[metric] < best[key][metric]:
+                best[key] = row
+        return best
@@ -1,13 +1,16 @@
 """ An acoustic model with a LSTM/CTC architecture. """
 
 import os
-from typing import Union, Dict, Any
+from typing import Union
 from pathlib import Path
 
 import numpy as np
 import tensorflow as tf
 
 from . import model
+from .exceptions import PersephoneException
+
+CELL_TYPES = ("lstm", "lstm_block_fused")
 
 def lstm_cell(hidden_size):
     """ Wrapper function to create an LSTM cell. """
@@ -15,54 +18,84 @@ def lstm_cell(hidden_size):
     return tf.contrib.rnn.LSTMCell(
         hidden_size, use_peepholes=True, state_is_tuple=True)
 
+def fused_lstm_cell(hidden_size):
+    """ Wrapper function to create a fused LSTM cell that runs the whole
+    sequence in a single kernel.
+
+    The cell is named "lstm_cell" so that its variables (kernel, bias and the
+    w_i_diag, w_f_diag and w_o_diag peephole weights) have the same names and
+    shapes as those of `lstm_cell()`. The gate layout of the kernel is also
+    the same, so checkpoints can be restored across the two cell types.
+    """
+
+    return tf.contrib.rnn.LSTMBlockFusedCell(
+        hidden_size, use_peephole=True, name="lstm_cell")
+
+def fused_bidirectional_rnn(hidden_size, layer_input, seq_lens):
+    """ A counterpart to `tf.nn.bidirectional_dynamic_rnn` that uses
+    `fused_lstm_cell()` for both directions.
+
+    The fused cell is time major and has no notion of direction, so the input
+    is transposed and the backward direction is run on input reversed within
+    each utterance's length. Variable scopes mirror those of
+    `bidirectional_dynamic_rnn` for checkpoint compatibility.
+
+    Returns:
+        A tuple of the forward and backward outputs, each of shape
+        [batch_size, time, hidden_size].
+    """
+
+    time_major_input = tf.transpose(layer_input, (1, 0, 2))
+    with tf.variable_scope("bidirectional_rnn"): #type: ignore
+        with tf.variable_scope("fw"): #type: ignore
+            out_fw, _ = fused_lstm_cell(hidden_size)(
+                time_major_input, dtype=tf.float32, sequence_length=seq_lens)
+        with tf.variable_scope("bw"): #type: ignore
+            reversed_input = tf.reverse_sequence(
+                time_major_input, seq_lens, seq_axis=0, batch_axis=1)
+            reversed_out_bw, _ = fused_lstm_cell(hidden_size)(
+                reversed_input, dtype=tf.float32, sequence_length=seq_lens)
+            out_bw = tf.reverse_sequence(
+                reversed_out_bw, seq_lens, seq_axis=0, batch_axis=1)
+    return (tf.transpose(out_fw, (1, 0, 2)), #type: ignore
+            tf.transpose(out_bw, (1, 0, 2))) #type: ignore
+
 class Model(model.Model):
     """ An acoustic model with a LSTM/CTC architecture. """
 
-    def write_desc(self) -> None:
-        """ Writes a description of the model to the exp_dir. """
-
-        path = os.path.join(self.exp_dir, "model_description.txt")
-        with open(path, "w") as desc_f:
-            for key, val in self.__dict__.items():
-                print("%s=%s" % (key, val), file=desc_f)
-
-        import json
-        json_path = os.path.join(self.exp_dir, "model_description.json")
-        desc = { } #type: Dict[str, Any]
-        # For use in decoding from a saved model
-        desc["topology"] = {
-            "batch_x_name" : self.batch_x.name, #type: ignore
-            "batch_x_lens_name" : self.batch_x_lens.name, #type: ignore
-            "dense_decoded_name" : self.dense_decoded.name #type: ignore
-        }
-        desc["model_type"] = str(self.__class__)
-        for key, val in self.__dict__.items():
-            if isinstance(val, int):
-                desc[str(key)] = val
-            elif isinstance(val, tf.Tensor):
-                desc[key] = {
-                    "type": "tf.Tensor",
-                    "name": val.name, #type: ignore
-                    "shape": str(val.shape), #type: ignore
-                    "dtype" : str(val.dtype), #type: ignore
-                    "value" : str(val),
-                }
-            elif isinstance(val, tf.SparseTensor): #type: ignore
-                desc[key] = {
-                    "type": "tf.SparseTensor",
-                    "value": str(val), #type: ignore
-                }
-            else:
-                desc[str(key)] = str(val)
-        with open(json_path, "w") as json_desc_f:
-            json.dump(desc, json_desc_f, skipkeys=True)
-
-
     def __init__(self, exp_dir: Union[str, Path], corpus_reader, num_layers: int = 3,
                  hidden_size: int=250, beam_width: int = 100,
-                 decoding_merge_repeated: bool = True) -> None:
+                 decoding_merge_repeated: bool = True,
+                 cell_type: str = "lstm") -> None:
+        """ Construct the LSTM/CTC graph.
+
+        Args:
+            exp_dir: The experiment directory that descriptions of the model,
+                     checkpoints and hypotheses are written to.
+            corpus_reader: The `CorpusReader` that feeds the model.
+            num_layers: The number of bidirectional LSTM layers.
+            hidden_size: The number of LSTM units in each direction of each
+                         layer.
+            beam_width: The beam width used in CTC beam search decoding.
+            decoding_merge_repeated: Whether repeated labels are merged in
+                                     CTC beam search decoding.
+            cell_type: Either "lstm", which runs `tf.contrib.rnn.LSTMCell`
+                       through `tf.nn.bidirectional_dynamic_rnn` one timestep
+                       at a time, or "lstm_block_fused", which runs
+                       `tf.contrib.rnn.LSTMBlockFusedCell` over the whole
+                       sequence in one kernel and is substantially faster
+                       on CPU. Both use peepholes and a forget bias of 1.0,
+                       and their variables share names, shapes and gate
+                       layout, so a checkpoint saved with one cell type can
+                       be restored into a model using the other.
+        """
         super().__init__(exp_dir, corpus_reader)
 
+        if cell_type not in CELL_TYPES:
+            raise PersephoneException(
+                "cell_type %s not implemented. Use one of %s." % (
+                    cell_type, str(CELL_TYPES)))
+
         if isinstance(exp_dir, Path):
             exp_dir = str(exp_dir)
         if not os.path.isdir(exp_dir):
@@ -79,6 +112,7 @@ class Model(model.Model):
         self.hidden_size = hidden_size
         self.beam_width = beam_width
         self.vocab_size = vocab_size
+        self.cell_type = cell_type
 
         # Initialize placeholders for feeding data to model.
         self.batch_x = tf.placeholder(
@@ -95,12 +129,16 @@ class Model(model.Model):
 
             with tf.variable_scope("layer_%d" % i): #type: ignore
 
-                cell_fw = lstm_cell(self.hidden_size)
-                cell_bw = lstm_cell(self.hidden_size)
+                if cell_type == "lstm_block_fused":
+                    self.out_fw, self.out_bw = fused_bidirectional_rnn(
+                            self.hidden_size, layer_input, self.batch_x_lens)
+                else:
+                    cell_fw = lstm_cell(self.hidden_size)
+                    cell_bw = lstm_cell(self.hidden_size)
 
-                (self.out_fw, self.out_bw), _ = tf.nn.bidirectional_dynamic_rnn(
-                        cell_fw, cell_bw, layer_input, self.batch_x_lens, dtype=tf.float32,
-                        time_major=False)
+                    (self.out_fw, self.out_bw), _ = tf.nn.bidirectional_dynamic_rnn(
+                            cell_fw, cell_bw, layer_input, self.batch_x_lens, dtype=tf.float32,
+                            time_major=False)
 
                 # Self outputs now becomes [batch_num, time, hidden_size*2]
                 self.outputs_concat = tf.concat((self.out_fw, self.out_bw), 2) #type: ignore
@@ -135,7 +173,7 @@ class Model(model.Model):
         self.loss = tf.nn.ctc_loss(self.batch_y, self.logits, self.batch_x_lens,
                 preprocess_collapse_repeated=False, ctc_merge_repeated=True)
         self.cost = tf.reduce_mean(self.loss)
-        self.optimizer = tf.train.AdamOptimizer().minimize(self.cost) #type: ignore
+        self.build_optimizer(self.cost)
 
         self.ler = tf.reduce_mean(tf.edit_distance(
                 tf.cast(self.decoded[0], tf.int32), self.batch_y)) #type: ignore
@@ -0,0 +1,310 @@
+""" Running a grid of `rnn_ctc.Model` configurations in parallel on one
+machine, stopping unpromising ones early.
+
+Each configuration in the grid is trained in its own process, pinned to its
+own set of CPU cores, in its own experiment directory. The processes report
+their validation LER to the scheduler at the end of every epoch.
+Configurations are stopped early by asynchronous successive halving: at
+each rung (after `min_epochs`, `min_epochs * reduction_factor`,
+`min_epochs * reduction_factor**2`, ... epochs) a configuration only keeps
+training if its best validation LER so far is in the top
+`1 / reduction_factor` of those that have reached that rung. Freed cores go
+to the next configuration in the grid.
+
+A sweep looks like::
+
+    def make_corpus(feat_type):
+        return Corpus(feat_type, "phonemes", "data/my_corpus")
+
+    if __name__ == "__main__":
+        trials = scheduler.run_grid(
+            make_corpus,
+            {"num_layers": [2, 3], "hidden_size": [250, 400],
+             "batch_size": [16, 32], "feat_type": ["fbank", "fbank_and_pitch"]},
+            exp_dir="exp/sweep")
+
+The corpus factory must be picklable, such as a module level function,
+since processes are started with the "spawn" method.
+"""
+
+import collections
+import itertools
+import json
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import traceback
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from . import config
+from . import experiment
+from . import model
+from . import rnn_ctc
+from .corpus_reader import CorpusReader
+from .exceptions import PersephoneException
+
+logger = logging.getLogger(__name__) # type: ignore
+
+# Grid keys that configure the data rather than rnn_ctc.Model.
+DATA_KEYS = ("batch_size", "feat_type")
+
+def expand_grid(grid: Dict[str, Sequence[Any]]) -> List[Dict[str, Any]]:
+    """ Lists every combination of the values in grid, which maps argument
+    names to the values to try for them. """
+
+    keys = sorted(grid)
+    return [dict(zip(keys, values))
+            for values in itertools.product(*(grid[key] for key in keys))]
+
+class SuccessiveHalving:
+    """ Decides which trials keep training by asynchronous successive
+    halving.
+
+    Args:
+        min_epochs: The number of epochs at the first rung.
+        reduction_factor: Each rung is this many times as many epochs as the
+                          last, and only the best 1/reduction_factor of trials
+                          that reach a rung continue past it.
+    """
+
+    def __init__(self, min_epochs: int = 5, reduction_factor: int = 3) -> None:
+        if min_epochs < 1 or reduction_factor < 2:
+            raise PersephoneException(
+                "Successive halving needs min_epochs >= 1 and "
+                "reduction_factor >= 2.")
+        self.min_epochs = min_epochs
+        self.reduction_factor = reduction_factor
+        # The best validation LER of each trial that reached each rung,
+        # keyed by the rung's epoch.
+        self.rung_results = collections.defaultdict(list) # type: Dict[int, List[float]]
+        self._best_lers = {} # type: Dict[Any, float]
+
+    def is_rung(self, epoch: int) -> bool:
+        """ Whether trials are compared after this epoch. """
+
+        rung = self.min_epochs
+        while rung < epoch:
+            rung *= self.reduction_factor
+        return rung == epoch
+
+    def report(self, trial_id: Any, epoch: int, valid_ler: float) -> bool:
+        """ Records a trial's validation LER at the end of an epoch.
+
+        Returns:
+            Whether the trial should keep training.
+        """
+
+        best_ler = min(valid_ler, self._best_lers.get(trial_id, valid_ler))
+        self._best_lers[trial_id] = best_ler
+        if not self.is_rung(epoch):
+            return True
+
+        results = self.rung_results[epoch]
+        results.append(best_ler)
+        num_promoted = max(1, len(results) // self.reduction_factor)
+        cutoff = sorted(results)[num_promoted - 1]
+        return best_ler <= cutoff
+
+class Trial:
+    """ A configuration from the grid and how its training went.
+
+    Attributes:
+        trial_id: The index of the configuration in the grid.
+        config: The arguments the configuration was trained with.
+        exp_dir: The configuration's experiment directory.
+        status: "pending", "running", "stopped" (by successive halving),
+                "completed" or "failed".
+        history: A list of (epoch, validation LER) pairs.
+        error: The traceback of the failure, if the trial failed.
+    """
+
+    def __init__(self, trial_id: int, config_: Dict[str, Any]) -> None:
+        self.trial_id = trial_id
+        self.config = config_
+        self.exp_dir = None # type: Optional[str]
+        self.status = "pending"
+        self.history = [] # type: List[Any]
+        self.error = None # type: Optional[str]
+
+    @property
+    def best_valid_ler(self) -> Optional[float]:
+        """ The lowest validation LER the trial reached. """
+        if not self.history:
+            return None
+        return min(ler for _, ler in self.history)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """ A JSON serializable summary of the trial. """
+        return {"trial_id": self.trial_id, "config": self.config,
+                "exp_dir": self.exp_dir, "status": self.status,
+                "history": self.history,
+                "best_valid_ler": self.best_valid_ler}
+
+class _TrialStopped(Exception):
+    """ Raised in a trial's process to end training when the scheduler stops
+    it. """
+
+def _run_trial(corpus_factory: Callable[..., Any], config_: Dict[str, Any],
+               exp_dir: str, cores: Sequence[int],
+               train_kwargs: Dict[str, Any], conn: Any) -> None:
+    """ Trains one configuration. Runs in the trial's own process. """
+
+    try:
+        if cores and hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cores)
+        if cores:
+            model.allow_growth_config.intra_op_parallelism_threads = len(cores)
+            model.allow_growth_config.inter_op_parallelism_threads = len(cores)
+
+        if "feat_type" in config_:
+            corpus = corpus_factory(config_["feat_type"])
+        else:
+            corpus = corpus_factory()
+        corpus_reader = CorpusReader(corpus, batch_size=config_.get("batch_size"))
+        model_kwargs = {key: val for key, val in config_.items()
+                        if key not in DATA_KEYS}
+        trial_model = rnn_ctc.Model(exp_dir, corpus_reader, **model_kwargs)
+
+        def report_epoch(epoch_info: Dict[str, Any]) -> None:
+            conn.send(("epoch", (epoch_info["epoch"], float(epoch_info["valid_ler"]))))
+            if not conn.recv():
+                raise _TrialStopped()
+
+        try:
+            trial_model.train(epoch_callback=report_epoch, **train_kwargs)
+        except _TrialStopped:
+            conn.send(("stopped", None))
+        else:
+            conn.send(("completed", None))
+    except Exception: # pylint: disable=broad-except
+        conn.send(("failed", traceback.format_exc()))
+
+def _core_slots(cores_per_trial: Optional[int],
+                num_parallel: Optional[int]) -> List[List[int]]:
+    """ Divides the cores this process may use between parallel trials. """
+
+    if hasattr(os, "sched_getaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count() or 1))
+    if not cores_per_trial:
+        if num_parallel:
+            cores_per_trial = max(1, len(cores) // num_parallel)
+        else:
+            cores_per_trial = 1
+    slots = [cores[i:i+cores_per_trial]
+             for i in range(0, len(cores) - cores_per_trial + 1, cores_per_trial)]
+    if num_parallel:
+        slots = slots[:num_parallel]
+    return slots or [cores]
+
+def run_grid(corpus_factory: Callable[..., Any],
+             grid: Dict[str, Sequence[Any]], *,
+             exp_dir: str = config.EXP_DIR,
+             num_parallel: Optional[int] = None,
+             cores_per_trial: Optional[int] = None,
+             halving: Optional[SuccessiveHalving] = None,
+             train_kwargs: Optional[Dict[str, Any]] = None) -> List[Trial]:
+    """ Trains every configuration in a grid of `rnn_ctc.Model`
+    hyperparameters, several at a time.
+
+    Args:
+        corpus_factory: A picklable callable that returns the `Corpus` to
+                        train on. If the grid has a "feat_type" key, it is
+                        called with the feature type, otherwise with no
+                        arguments.
+        grid: Maps argument names to the values to try for them. The
+              "batch_size" values go to the `CorpusReader`, "feat_type" values
+              to corpus_factory, and everything else to `rnn_ctc.Model`.
+        exp_dir: The directory under which each configuration gets its own
+                 numbered experiment directory. A summary of the sweep is
+                 written to grid_results.json in it.
+        num_parallel: The most configurations to train at once. Defaults to
+                      as many as there are core slots.
+        cores_per_trial: The number of cores each configuration's process is
+                         pinned to. Defaults to dividing the available cores
+                         evenly between num_parallel processes, or 1 core
+                         each if num_parallel isn't given either.
+        halving: Decides which configurations are stopped early. Defaults to
+                 `SuccessiveHalving()`.
+        train_kwargs: Keyword arguments for each `Model.train()` call.
+
+    Returns:
+        The trials, best validation LER first.
+    """
+
+    if halving is None:
+        halving = SuccessiveHalving()
+    if train_kwargs is None:
+        train_kwargs = {}
+    if "epoch_callback" in train_kwargs:
+        raise PersephoneException(
+            "The scheduler uses the epoch_callback of each training run.")
+
+    if not os.path.isdir(exp_dir):
+        os.makedirs(exp_dir, exist_ok=True)
+    trials = [Trial(trial_id, config_)
+              for trial_id, config_ in enumerate(expand_grid(grid))]
+    free_slots = _core_slots(cores_per_trial, num_parallel)
+    logger.info("Running %d configurations, %d at a time",
+                len(trials), len(free_slots))
+
+    context = multiprocessing.get_context("spawn")
+    pending = collections.deque(trials)
+    # Maps each running trial's connection to the trial, process and cores.
+    running = {} # type: Dict[Any, Any]
+    try:
+        while pending or running:
+            while pending and free_slots:
+                trial = pending.popleft()
+                cores = free_slots.pop()
+                trial.exp_dir = experiment.prep_sub_exp_dir(exp_dir)
+                parent_conn, child_conn = context.Pipe()
+                process = context.Process(
+                    target=_run_trial,
+                    args=(corpus_factory, trial.config, trial.exp_dir, cores,
+                          train_kwargs, child_conn),
+                    daemon=True)
+                process.start()
+                child_conn.close()
+                trial.status = "running"
+                running[parent_conn] = (trial, process, cores)
+                logger.info("Started trial %d in %s on cores %s: %s",
+                            trial.trial_id, trial.exp_dir, cores, trial.config)
+
+            for conn in multiprocessing.connection.wait(list(running)):
+                trial, process, cores = running[conn]
+                try:
+                    message, payload = conn.recv()
+                except EOFError:
+                    message, payload = "failed", "The trial's process exited unexpectedly."
+                if message == "epoch":
+                    epoch, valid_ler = payload
+                    trial.history.append((epoch, valid_ler))
+                    keep_training = halving.report(trial.trial_id, epoch, valid_ler)
+                    if not keep_training:
+                        logger.info("Stopping trial %d after epoch %d with"
+                                    " validation LER %f", trial.trial_id, epoch, valid_ler)
+                    conn.send(keep_training)
+                    continue
+
+                trial.status = message
+                if message == "failed":
+                    trial.error = payload
+                    logger.error("Trial %d failed:\n%s", trial.trial_id, payload)
+                process.join()
+                conn.close()
+                del running[conn]
+                free_slots.append(cores)
+    finally:
+        for conn, (trial, process, _) in running.items():
+            process.terminate()
+            conn.close()
+
+    trials.sort(key=lambda trial: (trial.best_valid_ler is None,
+                                   trial.best_valid_ler or 0.0))
+    with open(os.path.join(exp_dir, "grid_results.json"), "w",
+              encoding=config.ENCODING) as results_f:
+        json.dump([trial.to_dict() for trial in trials], results_f, indent=4)
+    return trials
@@ -0,0 +1,171 @@
+""" Confidence intervals and significance tests for phoneme error rates.
+
+The phoneme error rate of `utils.batch_per()` is the mean over utterances of
+each utterance's edit distance divided by the length of its reference. The
+edit distances are computed once, with `distance.batch_edit_distance()`,
+leaving an array of per-utterance error rates. Bootstrap resamples of the
+test set are then rows of a NumPy index array into it, so thousands of
+resamples take a few vectorized operations rather than thousands of calls to
+`batch_per()`::
+
+    comparison = significance.compare_experiments("exp/0", "exp/1")
+    print(comparison["difference"], comparison["p_value"])
+"""
+
+import os
+from pathlib import Path
+from typing import Any, Dict, List, Sequence, Tuple, Union
+
+import numpy as np
+
+from .config import ENCODING
+from .distance import batch_edit_distance
+from .exceptions import EmptyReferenceException, PersephoneException
+
+# The most resampled utterance indices to hold in memory at once.
+MAX_CHUNK_INDICES = 2**22
+
+def utterance_error_rates(hyps: Sequence[Sequence[str]],
+                          refs: Sequence[Sequence[str]]) -> np.ndarray:
+    """ The error rate of each hypothesis against its reference, whose mean
+    is the `utils.batch_per()` of the batch. """
+
+    if len(hyps) != len(refs):
+        raise PersephoneException(
+            "Got %d hypotheses but %d references." % (len(hyps), len(refs)))
+    ref_lens = np.array([len(ref) for ref in refs])
+    if not np.all(ref_lens):
+        raise EmptyReferenceException(
+            "Cannot calculate error rates against length 0 references.")
+    return batch_edit_distance(refs, hyps) / ref_lens
+
+def _resampled_means(values: np.ndarray, num_samples: int,
+                     rand_seed: int) -> np.ndarray:
+    """ The means of each row of values over num_samples bootstrap resamples
+    of its columns, as an array of shape [num_samples, num_rows]. The rows
+    are resampled together, so that paired values stay paired. """
+
+    rng = np.random.RandomState(rand_seed)
+    num_values = values.shape[1]
+    chunk_size = max(1, MAX_CHUNK_INDICES // num_values)
+    means = []
+    for start in range(0, num_samples, chunk_size):
+        size = min(chunk_size, num_samples - start)
+        indices = rng.randint(0, num_values, size=(size, num_values))
+        means.append(np.stack([row[indices].mean(axis=1) for row in values],
+                              axis=1))
+    return np.concatenate(means)
+
+def _interval(samples: np.ndarray, confidence: float) -> Tuple[float, float]:
+    """ The percentile interval of bootstrap samples at a confidence level. """
+
+    tail = 100 * (1 - confidence) / 2
+    low, high = np.percentile(samples, [tail, 100 - tail])
+    return float(low), float(high)
+
+def bootstrap_ci(error_rates: np.ndarray, *,
+                 num_samples: int = 10000,
+                 confidence: float = 0.95,
+                 rand_seed: int = 0) -> Tuple[float, float, float]:
+    """ A bootstrap confidence interval for the error rate of a test set.
+
+    Args:
+        error_rates: The error rate of each utterance, as returned by
+                     `utterance_error_rates()`.
+        num_samples: The number of bootstrap resamples of the utterances.
+        confidence: The confidence level of the interval.
+        rand_seed: Seeds the resampling.
+
+    Returns:
+        A tuple of the error rate and the low and high ends of the interval.
+    """
+
+    if not len(error_rates):
+        raise PersephoneException("Can't bootstrap an empty test set.")
+    if not 0 < confidence < 1:
+        raise PersephoneException(
+            "confidence must be in (0, 1), got %f." % confidence)
+    samples = _resampled_means(np.asarray(error_rates)[np.newaxis],
+                               num_samples, rand_seed)[:, 0]
+    low, high = _interval(samples, confidence)
+    return float(np.mean(error_rates)), low, high
+
+def paired_bootstrap(error_rates_a: np.ndarray, error_rates_b: np.ndarray, *,
+                     num_samples: int = 10000,
+                     confidence: float = 0.95,
+                     rand_seed: int = 0) -> Dict[str, Any]:
+    """ Compares the error rates of two systems on the same utterances with a
+    paired bootstrap test, resampling the utterances of both together.
+
+    Args:
+        error_rates_a: The error rate of each utterance for the first system.
+        error_rates_b: The error rate of each utterance for the second
+                       system, in the same order.
+        num_samples: The number of bootstrap resamples of the utterances.
+        confidence: The confidence level of the intervals.
+        rand_seed: Seeds the resampling.
+
+    Returns:
+        A dictionary of "per_a" and "per_b", each an (error rate, low, high)
+        tuple as from `bootstrap_ci()`, the "difference" per_b - per_a with its
+        "difference_ci", and the two-sided "p_value" of the difference, the
+        fraction of resampled differences at least as far from the observed
+        one as the observed one is from zero.
+    """
+
+    if len(error_rates_a) != len(error_rates_b):
+        raise PersephoneException(
+            "Paired error rates must be over the same utterances, got %d"
+            " and %d." % (len(error_rates_a), len(error_rates_b)))
+    if not len(error_rates_a):
+        raise PersephoneException("Can't bootstrap an empty test set.")
+    if not 0 < confidence < 1:
+        raise PersephoneException(
+            "confidence must be in (0, 1), got %f." % confidence)
+
+    paired = np.stack([error_rates_a, error_rates_b])
+    samples = _resampled_means(paired, num_samples, rand_seed)
+    means = paired.mean(axis=1)
+    difference = float(means[1] - means[0])
+    differences = samples[:, 1] - samples[:, 0]
+    p_value = float(np.mean(np.abs(differences - difference) >= abs(difference)))
+    return {"per_a": (float(means[0]),) + _interval(samples[:, 0], confidence),
+            "per_b": (float(means[1]),) + _interval(samples[:, 1], confidence),
+            "difference": difference,
+            "difference_ci": _interval(differences, confidence),
+            "p_value": p_value}
+
+def read_test_transcriptions(exp_dir: Union[str, Path]
+                            ) -> Tuple[List[List[str]], List[List[str]]]:
+    """ Reads the test set hypotheses and references that `Model.eval()`
+    wrote to exp_dir. """
+
+    transcriptions = []
+    for name in ["hyps", "refs"]:
+        path = os.path.join(str(exp_dir), "test", name)
+        if not os.path.isfile(path):
+            raise PersephoneException(
+                "No test set %s at %s. Has the model been evaluated?" % (name, path))
+        with open(path, encoding=ENCODING) as transcriptions_f:
+            transcriptions.append([line.split() for line in transcriptions_f])
+    return transcriptions[0], transcriptions[1]
+
+def compare_experiments(exp_dir_a: Union[str, Path],
+                        exp_dir_b: Union[str, Path], *,
+                        num_samples: int = 10000,
+                        confidence: float = 0.95,
+                        rand_seed: int = 0) -> Dict[str, Any]:
+    """ Compares the test set error rates of the models in two experiment
+    directories with `paired_bootstrap()`. Both must have been evaluated on
+    the same test set, in the same order. """
+
+    hyps_a, refs_a = read_test_transcriptions(exp_dir_a)
+    hyps_b, refs_b = read_test_transcriptions(exp_dir_b)
+    if refs_a != refs_b:
+        raise PersephoneException(
+            "%s and %s weren't evaluated on the same test set." % (
+                exp_dir_a, exp_dir_b))
+    return paired_bootstrap(utterance_error_rates(hyps_a, refs_a),
+                            utterance_error_rates(hyps_b, refs_b),
+                            num_samples=num_samples, confidence=confidence,
+                            rand_seed=rand_seed)
@@ -0,0 +1,110 @@
+""" A structured record of where training time goes.
+
+`Model.train` writes one JSON object per line to `telemetry.jsonl` in the
+experiment directory: a "step" record for each training step, an "epoch"
+record at the end of each pass over the training data and a "validation"
+record for each validated epoch. Each record has an "event" field naming its
+kind and a "time" field with its Unix timestamp. Durations are in seconds and
+memory use in bytes. Fields that can't be measured in a given mode, such as
+per-batch loading times in data parallel training, are null.
+
+The same records are passed to the `telemetry_callback` of `Model.train`.
+"""
+
+import json
+import logging
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Sequence, Union
+
+from .config import ENCODING
+
+logger = logging.getLogger(__name__) # type: ignore
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows.
+    resource = None # type: ignore
+
+def peak_rss() -> Optional[int]:
+    """ The peak resident set size of this process in bytes, or None if it
+    can't be determined. """
+
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux but bytes on macOS.
+    if sys.platform == "darwin":
+        return max_rss
+    return max_rss * 1024
+
+def process_rss() -> Optional[int]:
+    """ The resident set size of this process in bytes, or None if it can't
+    be determined. Where /proc isn't available this falls back to the peak
+    resident set size. """
+
+    try:
+        with open("/proc/self/statm", encoding=ENCODING) as statm_f:
+            pages = int(statm_f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return peak_rss()
+
+def frame_stats(batch_x_lens: Sequence[int]) -> Dict[str, Any]:
+    """ The number of frames in a batch and the fraction of the padded batch
+    that is padding. """
+
+    lens = [int(length) for length in batch_x_lens]
+    padded_frames = len(lens) * max(lens)
+    return {"frames": sum(lens),
+            "padded_ratio": 1.0 - sum(lens) / padded_frames}
+
+class Telemetry:
+    """ Writes telemetry records as JSON lines and passes them to a callback.
+
+    Args:
+        path: The file to write records to.
+        callback: If given, called with each record as a dictionary.
+        append: If True, records are added to the end of an existing file
+                rather than overwriting it.
+    """
+
+    def __init__(self, path: Union[str, Path],
+                 callback: Optional[Callable[[Dict], None]] = None,
+                 append: bool = False) -> None:
+        self.path = str(path)
+        self.callback = callback
+        self._out_f = open(self.path, "a" if append else "w", encoding=ENCODING)
+
+    def record(self, event: str, **fields: Any) -> Dict[str, Any]:
+        """ Writes a record of kind event with the given fields.
+
+        Returns:
+            The record that was written.
+        """
+
+        record = {"event": event, "time": time.time()} # type: Dict[str, Any]
+        record.update(fields)
+        print(json.dumps(record, sort_keys=True), file=self._out_f)
+        if self.callback:
+            self.callback(record)
+        return record
+
+    def flush(self) -> None:
+        """ Flushes written records to disk. """
+
+        self._out_f.flush()
+
+    def close(self) -> None:
+        """ Closes the telemetry file. """
+
+        self._out_f.close()
+
+    def __enter__(self) -> "Telemetry":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
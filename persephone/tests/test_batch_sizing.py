@@ -0,0 +1,50 @@
+"""Tests for choosing batch sizes and splitting batches that don't fit."""
+
+import numpy as np
+import pytest
+
+def test_split_batch():
+    from persephone.batch_sizing import split_batch
+    from persephone.exceptions import PersephoneException
+    assert split_batch([1, 2, 3]) == ([1], [2, 3])
+    assert split_batch([1, 2]) == ([1], [2])
+    with pytest.raises(PersephoneException):
+        split_batch([1])
+
+def test_slice_sparse():
+    """Test that slicing rows of sparse targets matches building them from
+    the sliced target lists"""
+    from persephone.batch_sizing import _slice_sparse
+    from persephone.utils import target_list_to_sparse_tensor
+    targets = [[1, 2, 3], [4], [5, 6], [7, 8, 9, 10]]
+    sparse = target_list_to_sparse_tensor(targets)
+    for start, end in [(0, 2), (2, 4), (1, 3), (3, 4)]:
+        expected = target_list_to_sparse_tensor(targets[start:end])
+        for got, want in zip(_slice_sparse(sparse, start, end), expected):
+            np.testing.assert_array_equal(got, want)
+
+def test_compute_gradients_split(create_test_corpus):
+    """Test that gradients combined over halves of a batch match the
+    gradients of the whole batch"""
+    import tensorflow as tf
+    from persephone.batch_sizing import compute_gradients_split, probe_max_batch_size
+    from persephone.corpus_reader import CorpusReader
+    from persephone.rnn_ctc import Model
+    corpus = create_test_corpus()
+    corpus_r = CorpusReader(
+        corpus,
+        batch_size=2
+    )
+    model = Model(corpus.tgt_dir, corpus_r, num_layers=1, hidden_size=10)
+    fn_batch = corpus_r.train_fn_batches()[0]
+
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        whole_grads, whole_ler = compute_gradients_split(model, sess, fn_batch)
+        split_grads, split_ler = compute_gradients_split(
+            model, sess, fn_batch, split=True)
+    assert whole_ler == pytest.approx(split_ler)
+    for whole_grad, split_grad in zip(whole_grads, split_grads):
+        np.testing.assert_allclose(whole_grad, split_grad, rtol=1e-4, atol=1e-6)
+
+    assert 1 <= probe_max_batch_size(model, max_batch_size=4) <= 4
@@ -0,0 +1,74 @@
+"""Tests for training within a time or frame budget."""
+
+import pytest
+
+def test_budget_needs_a_limit():
+    from persephone.budget import TrainingBudget
+    from persephone.exceptions import PersephoneException
+    with pytest.raises(PersephoneException):
+        TrainingBudget()
+
+def test_frame_budget():
+    from persephone.budget import TrainingBudget
+    budget = TrainingBudget(frame_budget=250)
+    budget.start(frames_per_epoch=100)
+    assert budget.can_train_epoch()
+    budget.epoch_done(1.0)
+    assert budget.can_train_epoch()
+    assert budget.remaining_epochs() == 1
+    budget.epoch_done(1.0)
+    assert not budget.can_train_epoch()
+    # The last epoch that fits is always validated.
+    budget.validation_done(1, 0.1)
+    assert budget.should_validate(2)
+
+def test_validation_interval():
+    """Test that validation is spaced out to keep it to the configured
+    fraction of training time"""
+    from persephone.budget import TrainingBudget
+    budget = TrainingBudget(frame_budget=10**6, max_validation_fraction=0.25)
+    budget.start(frames_per_epoch=100)
+    assert budget.should_validate(1)
+    budget.epoch_done(10.0)
+    budget.validation_done(1, 5.0)
+    # Validation takes half as long as an epoch, so every second epoch
+    # validated would be 25% of training time.
+    assert budget.validation_interval == 2
+    budget.epoch_done(10.0)
+    assert not budget.should_validate(2)
+    budget.epoch_done(10.0)
+    assert budget.should_validate(3)
+
+def test_time_budget(monkeypatch):
+    from persephone import budget as budget_module
+    clock = [1000.0]
+    monkeypatch.setattr(budget_module.time, "monotonic", lambda: clock[0])
+    budget = budget_module.TrainingBudget(time_budget=100.0)
+    budget.start(frames_per_epoch=100)
+    # Nothing is known about the cost of an epoch before the first.
+    assert budget.can_train_epoch()
+    clock[0] += 30.0
+    budget.epoch_done(30.0)
+    budget.validation_done(1, 5.0)
+    clock[0] += 5.0
+    # 35s used; another epoch, its validation and the test set evaluation
+    # take 40s.
+    assert budget.can_train_epoch()
+    assert budget.remaining_epochs() == 1
+    clock[0] += 30.0
+    budget.epoch_done(30.0)
+    assert not budget.can_train_epoch()
+    assert "projected to stop by epoch 2" in budget.projection(2, 100)
+
+def test_budget_state_round_trip():
+    from persephone.budget import TrainingBudget
+    budget = TrainingBudget(frame_budget=1000)
+    budget.start(frames_per_epoch=100)
+    budget.epoch_done(2.0)
+    budget.validation_done(1, 1.0)
+    resumed = TrainingBudget(frame_budget=1000)
+    resumed.set_state(budget.get_state())
+    resumed.start(frames_per_epoch=100)
+    assert resumed.frames_used == 100
+    assert resumed.remaining_epochs() == 9
+    assert resumed.last_validated_epoch == 1
@@ -0,0 +1,41 @@
+"""Tests for writing checkpoints off the training loop"""
+
+def test_async_checkpoint_writer_backpressure(tmp_path):
+    """Test that a writer whose background thread is stalled, as by slow
+    storage, doesn't queue more than MAX_QUEUED_JOBS snapshots"""
+    import threading
+    import tensorflow as tf
+    from persephone import checkpointing
+
+    tf.reset_default_graph()
+    tf.Variable(tf.zeros([1000]))
+    saver = tf.train.Saver()
+    release = threading.Event()
+    num_saves = 2 * checkpointing.MAX_QUEUED_JOBS + 1
+    saved = []
+
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        with checkpointing.AsyncCheckpointWriter(saver) as writer:
+            writer.submit(release.wait)
+
+            def save_all():
+                for i in range(num_saves):
+                    writer.save(sess, str(tmp_path / ("model%d.ckpt" % i)))
+                    saved.append(i)
+
+            saving = threading.Thread(target=save_all, daemon=True)
+            saving.start()
+            saving.join(timeout=2)
+            # save() blocks once the queue is full.
+            assert saving.is_alive()
+            assert len(saved) <= checkpointing.MAX_QUEUED_JOBS
+
+            release.set()
+            saving.join(timeout=30)
+            assert not saving.is_alive()
+            writer.flush()
+
+    assert saved == list(range(num_saves))
+    for i in range(num_saves):
+        assert (tmp_path / ("model%d.ckpt.index" % i)).exists()
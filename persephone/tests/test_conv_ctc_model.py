@@ -0,0 +1,66 @@
+"""Test that we can create a convolutional CTC model"""
+
+def test_model_creation(create_test_corpus):
+    """Test that we can create a model"""
+    from persephone.corpus_reader import CorpusReader
+    from persephone.conv_ctc import Model
+    corpus = create_test_corpus()
+    corpus_r = CorpusReader(
+        corpus,
+        num_train=1,
+        batch_size=1
+    )
+    assert corpus_r
+
+    model = Model(
+        corpus.tgt_dir,
+        corpus_r,
+    )
+    assert model
+
+def test_model_train_and_decode(tmpdir, create_sine, make_wav, create_test_corpus):
+    """Test that we can train the model then decode with the same
+    conventions as the LSTM/CTC model"""
+    import json
+    from pathlib import Path
+    from persephone.corpus_reader import CorpusReader
+    from persephone.conv_ctc import Model
+    from persephone.model import decode
+    corpus = create_test_corpus()
+    base_directory = corpus.tgt_dir
+
+    corpus_r = CorpusReader(
+        corpus,
+        batch_size=1
+    )
+
+    test_model = Model(
+        base_directory,
+        corpus_r,
+        num_conv_layers=2,
+        num_filters=8,
+        num_layers=1,
+        hidden_size=50
+    )
+
+    test_model.train(
+        early_stopping_steps=1,
+        min_epochs=1,
+        max_epochs=3
+    )
+
+    with (base_directory / "model_description.json").open() as desc_f:
+        topology = json.load(desc_f)["topology"]
+
+    wav_to_decode_path = str(tmpdir.join("wav").join("to_decode.wav"))
+    make_wav(create_sine(note="C"), wav_to_decode_path)
+
+    decode(
+        base_directory / "model" / "model_best.ckpt",
+        [Path(wav_to_decode_path)],
+        label_set = {"A", "B", "C"},
+        feature_type = "fbank",
+        batch_x_name = topology["batch_x_name"],
+        batch_x_lens_name = topology["batch_x_lens_name"],
+        output_name = topology["dense_decoded_name"]
+    )
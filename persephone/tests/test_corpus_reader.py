@@ -11,4 +11,21 @@ def test_corpus_reader(create_test_corpus):
         num_train=2,
         batch_size=1
     )
-    assert corpus_r
\ No newline at end of file
+    assert corpus_r
+
+
+def test_load_batch_timings(create_test_corpus):
+    """Test that loading a batch reports how long reading and padding took"""
+    from persephone.corpus_reader import CorpusReader
+    corpus = create_test_corpus()
+    corpus_r = CorpusReader(
+        corpus,
+        num_train=2,
+        batch_size=1
+    )
+    timings = {}
+    batch_x, batch_x_lens, _ = corpus_r.load_batch(
+        corpus_r.train_fn_batches()[0], timings)
+    assert batch_x.shape[0] == len(batch_x_lens) == 1
+    assert timings["data_load"] >= 0
+    assert timings["feed_prep"] >= 0
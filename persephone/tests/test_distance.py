@@ -4,6 +4,7 @@ import string
 import pytest
 from nltk.metrics import distance
 
+from persephone.distance import batch_align, batch_edit_distance
 from persephone.distance import min_edit_distance, min_edit_distance_align
 from persephone.distance import cluster_alignment_errors, word_error_rate
 from persephone.exceptions import EmptyReferenceException
@@ -48,6 +49,28 @@ def test_med(seq_cases):
         else:
             word_error_rate(s1, s2)
 
+def test_batch_edit_distance(seq_cases):
+    # Tests the batched edit distance against the same NLTK distances.
+    for sub_cost in range(4):
+        cases = [(s1, s2, dist) for s1, s2, case_sub_cost, dist in seq_cases
+                 if case_sub_cost == sub_cost]
+        distances = batch_edit_distance([s1 for s1, _, _ in cases],
+                                        [s2 for _, s2, _ in cases],
+                                        sub_cost=sub_cost)
+        assert list(distances) == [dist for _, _, dist in cases]
+
+def test_batch_edit_distance_costs():
+    # Two deletions cost less than two substitutions.
+    assert list(batch_edit_distance(["ab"], ["ba"], ins_cost=1, del_cost=2,
+                                    sub_cost=5)) == [3]
+    assert list(batch_edit_distance([], [])) == []
+    with pytest.raises(ValueError):
+        batch_edit_distance(["a"], [])
+
+def test_med_long_sequences():
+    # Distances beyond the range of 16 bit integers.
+    assert min_edit_distance("a" * 40000, "b") == 40000
+
 def test_med_align(seq_cases):
     for ref, hyp, sub_cost, dist in seq_cases:
         if not isinstance(ref, str):
@@ -75,5 +98,35 @@ def test_med_align(seq_cases):
             recreated_hyp.extend(cluster_arrow[1])
         assert "".join(recreated_hyp) == hyp
 
+def test_batch_align(seq_cases):
+    # The vectorized alignments must break ties exactly as the general
+    # implementation does.
+    refs = [ref for ref, _, _, _ in seq_cases]
+    hyps = [hyp for _, hyp, _, _ in seq_cases]
+    levenshtein = lambda x, y: 0 if x == y else 1
+    expected = [min_edit_distance_align(ref, hyp, sub_cost=levenshtein)
+                for ref, hyp in zip(refs, hyps)]
+    assert batch_align(refs, hyps) == expected
+    assert [min_edit_distance_align(ref, hyp)
+            for ref, hyp in zip(refs, hyps)] == expected
+    assert batch_align(["ab", "abc", ""], ["ba", "c", "ab"]) == [
+        [("a", "b"), ("b", "a")],
+        [("a", ""), ("b", ""), ("c", "c")],
+        [("", "a"), ("", "b")]]
+    assert batch_align([], []) == []
+
+def test_batch_align_band(seq_cases):
+    for band in [0, 2]:
+        for (ref, hyp, _, _), alignment in zip(
+                seq_cases, batch_align([case[0] for case in seq_cases],
+                                       [case[1] for case in seq_cases],
+                                       band=band)):
+            assert [arrow[0] for arrow in alignment if arrow[0] != ""] == list(ref)
+            assert [arrow[1] for arrow in alignment if arrow[1] != ""] == list(hyp)
+    # A wide enough band changes nothing.
+    assert batch_align(["abcd"], ["bcde"], band=4) == batch_align(["abcd"], ["bcde"])
+    with pytest.raises(ValueError):
+        min_edit_distance_align("ab", "ba", sub_cost=lambda x, y: 2, band=1)
+
 # TODO Test the ins_cost and del_cost arguments of min_edit_distance and
 # min_edit_distance_align
@@ -0,0 +1,38 @@
+"""Tests for distilling a trained model into a smaller one"""
+
+import json
+
+def test_distill(tmpdir, create_test_corpus):
+    """Test that a student is trained on a teacher's cached posteriors"""
+    from persephone.corpus_reader import CorpusReader
+    from persephone.distill import distill
+    from persephone.rnn_ctc import Model
+    corpus = create_test_corpus()
+    corpus_r = CorpusReader(corpus, batch_size=1)
+    exp_dir = tmpdir.mkdir("exp")
+    teacher = Model(str(exp_dir.join("teacher")), corpus_r,
+                    num_layers=2, hidden_size=20)
+    teacher.train(early_stopping_steps=1, min_epochs=1, max_epochs=2)
+
+    report = distill(
+        teacher, teacher.saved_model_path,
+        lambda: Model(str(exp_dir.join("student")), corpus_r,
+                      num_layers=1, hidden_size=5),
+        early_stopping_steps=1, min_epochs=1, max_epochs=2)
+
+    for prefix in corpus_r.train_prefixes:
+        assert exp_dir.join("teacher", "posteriors", "%s.posteriors.npy" % prefix).check()
+    assert report["student"]["num_parameters"] < report["teacher"]["num_parameters"]
+    assert report["speedup"] > 0
+    saved = json.loads(exp_dir.join("student", "distillation_report.json").read())
+    assert saved["ler_increase"] == report["ler_increase"]
+    assert exp_dir.join("student", "test", "test_per").check()
+
+def test_pool_posteriors():
+    """Test that posteriors are averaged over strided output frames"""
+    import numpy as np
+    from persephone.distill import pool_posteriors
+    log_posteriors = np.log(np.array([[0.5, 0.5], [0.9, 0.1], [0.2, 0.8]]))
+    pooled = pool_posteriors(log_posteriors, 2)
+    assert pooled.shape == (2, 2)
+    assert np.allclose(np.exp(pooled), [[0.7, 0.3], [0.2, 0.8]])
@@ -0,0 +1,12 @@
+"""Tests for experiment directory management."""
+
+def test_prep_sub_exp_dir_concurrent(tmpdir):
+    """Test that experiment directories started at the same time get
+    different numbers"""
+    from concurrent.futures import ThreadPoolExecutor
+    from persephone.experiment import prep_sub_exp_dir
+    parent_dir = str(tmpdir.join("exp"))
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        exp_dirs = list(executor.map(lambda _: prep_sub_exp_dir(parent_dir), range(32)))
+    assert len(set(exp_dirs)) == 32
+    assert sorted(int(exp_dir.split("/")[-1]) for exp_dir in exp_dirs) == list(range(32))
@@ -0,0 +1,37 @@
+"""Tests for updating a trained model with newly transcribed utterances."""
+
+import pytest
+
+def test_new_train_prefixes(tmpdir):
+    from types import SimpleNamespace
+    from persephone.incremental import new_train_prefixes
+    from persephone.exceptions import PersephoneException
+    corpus = SimpleNamespace(train_prefixes=["utt1", "utt2", "utt3", "utt4"])
+    exp_dir = tmpdir.mkdir("exp")
+    with pytest.raises(PersephoneException):
+        new_train_prefixes(corpus, str(exp_dir))
+    exp_dir.join("train_prefixes.txt").write("utt1\nutt3\n")
+    assert new_train_prefixes(corpus, str(exp_dir)) == ["utt2", "utt4"]
+
+def test_fine_tune(tmpdir, create_test_corpus):
+    """Test that a model is updated on the utterances it hasn't seen"""
+    from persephone.corpus_reader import CorpusReader
+    from persephone.incremental import fine_tune, read_train_prefixes
+    from persephone.rnn_ctc import Model
+    corpus = create_test_corpus()
+    prev_exp_dir = tmpdir.mkdir("exp").mkdir("0")
+
+    # Train as though only the first training utterance had been transcribed.
+    first_prefix = corpus.train_prefixes[0]
+    corpus_r = CorpusReader(corpus, batch_size=1, train_prefixes=[first_prefix])
+    model = Model(str(prev_exp_dir), corpus_r, num_layers=1, hidden_size=10)
+    model.train(early_stopping_steps=1, min_epochs=1, max_epochs=2)
+    assert read_train_prefixes(str(prev_exp_dir)) == [first_prefix]
+
+    fine_tuned = fine_tune(corpus, str(prev_exp_dir), min_epochs=1, max_epochs=2)
+
+    assert fine_tuned.exp_dir != str(prev_exp_dir)
+    assert sorted(fine_tuned.corpus_reader.train_prefixes) == sorted(corpus.train_prefixes)
+    assert fine_tuned.hidden_size == 10
+    assert read_train_prefixes(fine_tuned.exp_dir) == sorted(corpus.train_prefixes)
+    assert fine_tuned.saved_model_path
@@ -0,0 +1,53 @@
+"""Tests for the multi-task model that predicts several label types"""
+
+def create_tones_corpus(corpus):
+    """ Adds a tone tier to the labels of the test corpus and returns a
+    corpus for it. """
+    from persephone.corpus import Corpus
+    tones = {"test1": "H L", "test2": "L", "train1": "L L",
+             "train2": "H L L", "valid": "L"}
+    for prefix, label in tones.items():
+        (corpus.label_dir / ("%s.tones" % prefix)).write_text(label)
+    return Corpus(feat_type="fbank", label_type="tones",
+                  tgt_dir=corpus.tgt_dir, labels={"H", "L"})
+
+def test_multitask_batches(create_test_corpus):
+    """Test that batches have targets for each label type"""
+    from persephone.multitask import MultiTaskCorpusReader
+    corpus = create_test_corpus()
+    tones_corpus = create_tones_corpus(corpus)
+    corpus_r = MultiTaskCorpusReader([corpus, tones_corpus], batch_size=2)
+    assert corpus_r.label_types == ["phonemes", "tones"]
+
+    _, batch_x_lens, (phoneme_y, tone_y) = corpus_r.load_batch(corpus_r.train_fns)
+    assert len(batch_x_lens) == 2
+    assert phoneme_y[2][0] == 2
+    assert tone_y[2][0] == 2
+    assert set(tone_y[1]) <= set(tones_corpus.labels_to_indices(["H", "L"]))
+
+def test_multitask_train_and_decode(tmpdir, create_sine, make_wav, create_test_corpus):
+    """Test that a multi-task model trains and transcribes every tier"""
+    from pathlib import Path
+    from persephone import multitask
+    corpus = create_test_corpus()
+    tones_corpus = create_tones_corpus(corpus)
+    corpus_r = multitask.MultiTaskCorpusReader([corpus, tones_corpus], batch_size=1)
+    exp_dir = tmpdir.mkdir("exp")
+    test_model = multitask.Model(str(exp_dir), corpus_r, num_layers=2,
+                                 hidden_size=20, task_weights=[1.0, 0.5])
+    test_model.train(early_stopping_steps=1, min_epochs=1, max_epochs=3)
+
+    test_dir = exp_dir.join("test")
+    assert test_dir.join("hyps.phonemes").check()
+    assert sorted(test_dir.join("refs.tones").read().split()) == ["H", "L", "L"]
+    assert "tones LER" in test_dir.join("test_per").read()
+
+    wav_to_decode_path = str(tmpdir.join("wav").join("to_decode.wav"))
+    make_wav(create_sine(note="C"), wav_to_decode_path)
+    transcripts = multitask.decode(
+        Path(test_model.saved_model_path), [Path(wav_to_decode_path)],
+        label_sets={"phonemes": {"A", "B", "C"}, "tones": {"H", "L"}},
+        feature_type="fbank")
+    assert set(transcripts) == {"phonemes", "tones"}
+    assert len(transcripts["tones"]) == 1
+    assert set(transcripts["tones"][0]) <= {"H", "L"}
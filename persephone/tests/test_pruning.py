@@ -0,0 +1,95 @@
+"""Tests for pruning the LSTM units of a trained model"""
+
+import numpy as np
+
+def sigmoid(x):
+    return 1 / (1 + np.exp(-x))
+
+def lstm(values, scope, inputs):
+    """ Runs an LSTM cell with peepholes over a [time, features] array as
+    tf.contrib.rnn.LSTMCell does. """
+    kernel = values[scope + "/kernel"]
+    hidden_size = kernel.shape[1] // 4
+    c = np.zeros(hidden_size)
+    m = np.zeros(hidden_size)
+    outputs = []
+    for x in inputs:
+        i, j, f, o = np.split(np.concatenate([x, m]) @ kernel + values[scope + "/bias"], 4)
+        c = (sigmoid(f + 1.0 + values[scope + "/w_f_diag"] * c) * c
+             + sigmoid(i + values[scope + "/w_i_diag"] * c) * np.tanh(j))
+        m = sigmoid(o + values[scope + "/w_o_diag"] * c) * np.tanh(c)
+        outputs.append(m)
+    return np.array(outputs)
+
+def forward(values, num_layers, inputs):
+    """ The logits of a bidirectional LSTM/CTC model for one utterance. """
+    for layer in range(num_layers):
+        scope = "layer_%d/bidirectional_rnn/%s/lstm_cell"
+        out_fw = lstm(values, scope % (layer, "fw"), inputs)
+        out_bw = lstm(values, scope % (layer, "bw"), inputs[::-1])[::-1]
+        inputs = np.concatenate([out_fw, out_bw], axis=1)
+    return inputs @ values["Variable"] + values["Variable_1"]
+
+def random_values(num_layers, num_feats, hidden_size, vocab_size, rng):
+    values = {}
+    for layer in range(num_layers):
+        input_size = num_feats if layer == 0 else 2 * hidden_size
+        for direction in ("fw", "bw"):
+            scope = "layer_%d/bidirectional_rnn/%s/lstm_cell/" % (layer, direction)
+            values[scope + "kernel"] = rng.normal(size=(input_size + hidden_size, 4 * hidden_size))
+            values[scope + "bias"] = rng.normal(size=4 * hidden_size)
+            for peephole in ("w_i_diag", "w_f_diag", "w_o_diag"):
+                values[scope + peephole] = rng.normal(size=hidden_size)
+    values["Variable"] = rng.normal(size=(2 * hidden_size, vocab_size))
+    values["Variable_1"] = rng.normal(size=vocab_size)
+    return values
+
+def test_prune_values_removes_dead_units():
+    """Test that removing units whose outputs are unused leaves the model's
+    output unchanged"""
+    from persephone.pruning import prune_values, select_units, unit_scores
+    rng = np.random.RandomState(0)
+    num_layers, hidden_size = 2, 6
+    values = random_values(num_layers, 5, hidden_size, 4, rng)
+    dead = [1, 4]
+    for layer in range(num_layers):
+        for direction_i, direction in enumerate(("fw", "bw")):
+            kernel = values["layer_%d/bidirectional_rnn/%s/lstm_cell/kernel" % (layer, direction)]
+            input_size = kernel.shape[0] - hidden_size
+            kernel[input_size + np.array(dead)] = 0
+            if layer + 1 < num_layers:
+                for next_direction in ("fw", "bw"):
+                    next_kernel = values["layer_%d/bidirectional_rnn/%s/lstm_cell/kernel" % (
+                        layer + 1, next_direction)]
+                    next_kernel[direction_i * hidden_size + np.array(dead)] = 0
+            else:
+                values["Variable"][direction_i * hidden_size + np.array(dead)] = 0
+
+    keep = select_units(unit_scores(values, num_layers, hidden_size), hidden_size - len(dead))
+    for units in keep.values():
+        assert not set(units) & set(dead)
+    pruned = prune_values(values, num_layers, hidden_size, keep)
+    assert pruned["Variable"].shape == (2 * (hidden_size - len(dead)), 4)
+
+    inputs = rng.normal(size=(7, 5))
+    assert np.allclose(forward(values, num_layers, inputs),
+                       forward(pruned, num_layers, inputs))
+
+def test_prune(tmpdir, create_test_corpus):
+    """Test that a trained model is pruned, fine-tuned and compared"""
+    from persephone.corpus_reader import CorpusReader
+    from persephone.pruning import prune
+    from persephone.rnn_ctc import Model
+    corpus = create_test_corpus()
+    corpus_r = CorpusReader(corpus, batch_size=1)
+    exp_dir = tmpdir.mkdir("exp")
+    model = Model(str(exp_dir.join("0")), corpus_r, num_layers=2, hidden_size=20)
+    model.train(early_stopping_steps=1, min_epochs=1, max_epochs=2)
+
+    pruned, report = prune(model, model.saved_model_path, str(exp_dir.join("1")),
+                           keep_fraction=0.5, max_epochs=2)
+    assert pruned.hidden_size == 10
+    assert report["hidden_size"] == [20, 10]
+    assert report["after"]["num_parameters"] < report["before"]["num_parameters"]
+    assert '"hidden_size": 10' in exp_dir.join("1", "model_description.json").read()
+    assert exp_dir.join("1", "pruning_report.json").check()
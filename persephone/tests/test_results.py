@@ -7,6 +7,7 @@ from persephone import results
 from persephone import utils
 from persephone.corpus import Corpus
 from persephone.corpus_reader import CorpusReader
+from persephone.exceptions import PersephoneException
 
 #@pytest.fixture
 #def bkw_exp_dir():
@@ -93,12 +94,97 @@ def test_speaker_results(prepared_data):
                      )
          )
 
+    alignment_set = results.AlignmentSet(hyps, refs)
     print(results.fmt_confusion_matrix(hyps, refs,
                                        label_set=set(corp.labels),
-                                       max_width=25))
-    print(results.fmt_error_types(hyps, refs))
+                                       max_width=25,
+                                       alignment_set=alignment_set))
+    print(results.fmt_error_types(hyps, refs, alignment_set=alignment_set))
     results.fmt_latex_output(hyps, refs,
                              eval_prefixes,
-                             Path("./hyps_refs.txt"))
+                             Path("./hyps_refs.txt"),
+                             alignment_set=alignment_set)
 
     return
+
+def test_alignment_set(tmp_path, monkeypatch):
+    hyps = [["a", "b", "c"], ["a", "c"], []]
+    refs = [["a", "b", "d"], ["a", "b", "c"], ["b"]]
+    hyps_path = tmp_path / "hyps"
+    refs_path = tmp_path / "refs"
+    hyps_path.write_text("".join(" ".join(hyp) + "\n" for hyp in hyps))
+    refs_path.write_text("".join(" ".join(ref) + "\n" for ref in refs))
+
+    alignment_set = results.AlignmentSet.from_files(hyps_path, refs_path)
+    assert len(alignment_set) == 3
+    assert alignment_set.alignments[1] == [("a", "a"), ("b", ""), ("c", "c")]
+    assert results.AlignmentSet.cache_path(hyps_path).is_file()
+    assert (results.fmt_error_types(hyps, refs, alignment_set=alignment_set)
+            == results.fmt_error_types(hyps, refs))
+    assert (results.fmt_confusion_matrix(hyps, refs, label_set={"a", "b", "c", "d"},
+                                         alignment_set=alignment_set)
+            == results.fmt_confusion_matrix(hyps, refs, label_set={"a", "b", "c", "d"}))
+
+    # The saved alignments are reused while the transcriptions are unchanged.
+    def fail_to_align(*args, **kwargs):
+        raise AssertionError("Aligned again")
+    monkeypatch.setattr(results, "batch_align", fail_to_align)
+    cached = results.AlignmentSet.from_files(hyps_path, refs_path)
+    assert cached.alignments == alignment_set.alignments
+    hyps_path.write_text("a b d\na b c\nb\n")
+    with pytest.raises(AssertionError):
+        results.AlignmentSet.from_files(hyps_path, refs_path)
+
+def test_filtered_error_rates(tmp_path):
+    hyps_path = tmp_path / "hyps"
+    refs_path = tmp_path / "refs"
+    hyps_path.write_text("a ˧ b ˥\nb ˧\n")
+    refs_path.write_text("a ˧ c ˧\nb ˩ a ˧\n")
+    label_sets = {"phonemes": {"a", "b", "c"}, "tones": {"˧", "˥", "˩"}, "all": None}
+
+    error_rates = results.filtered_error_rates(hyps_path, refs_path, label_sets)
+    assert error_rates == {"phonemes": 0.5, "tones": 0.5, "all": 0.5}
+    for name, labels in label_sets.items():
+        assert results.filtered_error_rate(hyps_path, refs_path, labels) == error_rates[name]
+
+    hyps_path.write_text("")
+    assert results.filtered_error_rates(hyps_path, refs_path, label_sets) == {
+        "phonemes": -1, "tones": -1, "all": -1}
+
+def test_error_stats(tmp_path):
+    hyps = [["a", "b", "d"], ["a"], ["c", "a"]]
+    refs = [["a", "b", "c"], ["a", "b"], ["a"]]
+    alignments = results.AlignmentSet(hyps, refs).alignments
+    stats = results.ErrorStats.from_alignments(alignments)
+    assert stats.labels == ["a", "b", "c", "d"]
+    assert stats.num_correct == 4
+    assert stats.num_substitutions == 1
+    assert stats.num_deletions == 1
+    assert stats.num_insertions == 1
+    assert stats.deletions() == [("b", 1)]
+    assert stats.counts[stats.label_to_index["c"], stats.label_to_index["d"]] == 1
+    assert results.fmt_error_types(hyps, refs) == stats.fmt_error_types()
+    assert "\\toprule" in stats.fmt_latex_confusion_matrix()
+
+    # Statistics over different shards and labels merge.
+    shard = results.ErrorStats.from_alignments(alignments[:1], labels={"a", "b", "c", "d"})
+    rest = results.ErrorStats.from_alignments(alignments[1:])
+    merged = shard + rest
+    assert merged.labels == stats.labels
+    assert (merged.counts == stats.counts).all()
+
+    stats.save(tmp_path / "stats.json")
+    loaded = results.ErrorStats.load(tmp_path / "stats.json")
+    assert (loaded.counts == stats.counts).all()
+    assert loaded.frequent_labels(2) == stats.frequent_labels(2)
+    stats.write_csv(tmp_path / "stats.csv")
+    assert (tmp_path / "stats.csv").read_text().splitlines()[0] == "ref/hyp,<none>,a,b,c,d"
+
+    # Labels with equal counts come in the order they were first seen.
+    ties = results.ErrorStats.from_alignments([[("c", ""), ("a", "")], [("b", "")]])
+    assert ties.deletions() == [("c", 1), ("a", 1), ("b", 1)]
+    assert ties.frequent_labels(2) == ["c", "a"]
+    assert (ties + stats).deletions() == [("b", 2), ("c", 1), ("a", 1)]
+
+    with pytest.raises(PersephoneException):
+        results.ErrorStats(["a"]).add([[("a", "b")]])
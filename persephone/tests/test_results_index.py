@@ -0,0 +1,74 @@
+"""Tests for indexing the results of many experiments"""
+
+import json
+import os
+
+def write_exp_dir(exp_dir, feat_type, test_ler, valid_ler=0.3):
+    (exp_dir / "test").mkdir(parents=True)
+    (exp_dir / "best_scores.txt").write_text(
+        "Epoch 7. Training LER: 0.100000, validation LER: %f\n" % valid_ler)
+    (exp_dir / "test" / "test_per").write_text("LER: %f\n" % test_ler)
+    (exp_dir / "train_description.txt").write_text(
+        "self=<persephone.rnn_ctc.Model object>\nearly_stopping_steps=10\n"
+        "max_valid_ler=1.0\nrestore_model_path=None\nbatch_size=16\n"
+        "feat_type=%s\nlabel_type=phonemes\n" % feat_type)
+    # Model.write_desc() records the exp_dir the model was built with, which
+    # can be relative or differ from where the index finds it.
+    (exp_dir / "model_description.json").write_text(json.dumps({
+        "topology": {"batch_x_name": "Placeholder:0"},
+        "exp_dir": os.path.join("exp", exp_dir.name),
+        "model_type": "<class 'persephone.rnn_ctc.Model'>",
+        "num_layers": 3, "hidden_size": 250}))
+
+def test_parse_exp_dir(tmp_path):
+    from persephone import results_index
+
+    write_exp_dir(tmp_path / "0", "fbank", 0.25)
+    (tmp_path / "0" / "test" / "test_per").write_text("LER: 0.250000\ntones LER: 0.125000\n")
+    row = results_index.parse_exp_dir(str(tmp_path / "0"))
+    assert row["best_epoch"] == 7
+    assert row["best_train_ler"] == 0.1
+    assert row["best_valid_ler"] == 0.3
+    assert row["test_ler"] == 0.25
+    assert row["test_ler_tones"] == 0.125
+    assert row["feat_type"] == "fbank"
+    assert row["early_stopping_steps"] == 10
+    assert row["max_valid_ler"] == 1.0
+    assert row["restore_model_path"] is None
+    assert row["num_layers"] == 3
+    assert row["model_type"] == "<class 'persephone.rnn_ctc.Model'>"
+    assert row["exp_dir"] == str(tmp_path / "0")
+    assert "topology" not in row
+
+def test_results_index(tmp_path):
+    from persephone import results_index
+
+    root = tmp_path / "exp"
+    write_exp_dir(root / "0", "fbank", 0.3)
+    write_exp_dir(root / "1", "fbank_and_pitch", 0.2)
+    write_exp_dir(root / "1" / "0", "fbank", 0.25)
+    (root / "2").mkdir()
+
+    index = results_index.ResultsIndex(root)
+    assert index.refresh() == 3
+    assert len(index) == 3
+    assert len(index.columns["test_ler"]) == 3
+    best = index.best("test_ler", by="feat_type")
+    assert best["fbank"]["exp_dir"] == str(root / "1" / "0")
+    assert best["fbank_and_pitch"]["test_ler"] == 0.2
+    assert index.best()[None]["test_ler"] == 0.2
+    assert [row["exp_dir"] for row in index.rows(feat_type="fbank")] == [
+        str(root / "0"), str(root / "1" / "0")]
+
+    # A new index is loaded from the cache and only reads what changed.
+    write_exp_dir(root / "2" / "0", "fbank", 0.1)
+    test_per = root / "0" / "test" / "test_per"
+    test_per.write_text("LER: 0.050000\n")
+    mtime = os.stat(str(test_per)).st_mtime
+    os.utime(str(test_per), (mtime + 10, mtime + 10))
+    index = results_index.ResultsIndex(root)
+    assert len(index) == 3
+    assert index.refresh() == 2
+    assert index.refresh() == 0
+    assert index.best("test_ler", by="feat_type")["fbank"]["exp_dir"] == str(root / "0")
+    assert len(index) == 4
@@ -1,5 +1,7 @@
 """Test that we can create an RNN CTC model"""
 
+import pytest
+
 def test_model_creation(create_test_corpus):
     """Test that we can create a model"""
     from persephone.corpus_reader import CorpusReader
@@ -109,3 +111,407 @@ def test_model_train_callback(tmpdir, create_sine, make_wav, create_test_corpus)
     )
 
     assert mock_callback.call_count == 10
+
+@pytest.mark.slow
+def test_cell_type_step_time(create_test_corpus):
+    """Benchmark the CPU time of a training step for each LSTM cell
+    implementation in our typical 3 layer, 250 hidden unit configuration.
+    Run with --log-cli-level=INFO to see the table of step times."""
+    import logging
+    import time
+    import numpy as np
+    import tensorflow as tf
+    from persephone.corpus_reader import CorpusReader
+    from persephone.rnn_ctc import CELL_TYPES, Model
+    from persephone.utils import target_list_to_sparse_tensor
+    corpus = create_test_corpus()
+    corpus_r = CorpusReader(
+        corpus,
+        batch_size=1
+    )
+
+    batch_size = 16
+    num_frames = 500
+    rng = np.random.RandomState(0)
+    batch_x = rng.randn(batch_size, num_frames, corpus.num_feats)
+    batch_x_lens = np.array([num_frames]*batch_size)
+    batch_y = target_list_to_sparse_tensor(
+        [rng.randint(1, corpus.vocab_size+1, size=50) for _ in range(batch_size)])
+
+    num_steps = 5
+    step_times = {}
+    for cell_type in CELL_TYPES:
+        test_model = Model(
+            corpus.tgt_dir,
+            corpus_r,
+            num_layers=3,
+            hidden_size=250,
+            cell_type=cell_type
+        )
+        feed_dict = {test_model.batch_x: batch_x,
+                     test_model.batch_x_lens: batch_x_lens,
+                     test_model.batch_y: batch_y}
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            # Warm up before timing.
+            sess.run(test_model.optimizer, feed_dict=feed_dict)
+            start = time.perf_counter()
+            for _ in range(num_steps):
+                sess.run(test_model.optimizer, feed_dict=feed_dict)
+            step_times[cell_type] = (time.perf_counter() - start) / num_steps
+
+    table = ["{:20}{:>10}{:>10}".format("cell_type", "step (s)", "speedup")]
+    for cell_type in CELL_TYPES:
+        table.append("{:20}{:>10.3f}{:>10.2f}".format(
+            cell_type, step_times[cell_type],
+            step_times["lstm"] / step_times[cell_type]))
+    logging.getLogger(__name__).info("Training step times:\n%s", "\n".join(table))
+
+def test_cell_type_checkpoint_compatibility(tmpdir, create_test_corpus):
+    """Test that a checkpoint saved with one LSTM cell implementation can be
+    restored into a model using the other, and that both compute the same
+    logits from it, peepholes included."""
+    import numpy as np
+    import tensorflow as tf
+    from persephone.corpus_reader import CorpusReader
+    from persephone.rnn_ctc import Model
+    corpus = create_test_corpus()
+    corpus_r = CorpusReader(
+        corpus,
+        batch_size=1
+    )
+
+    # Utterances of different lengths, so that the reversal of the backward
+    # direction within each utterance's length is exercised.
+    rng = np.random.RandomState(0)
+    batch_x_lens = np.array([20, 13, 7])
+    batch_x = rng.randn(len(batch_x_lens), max(batch_x_lens), corpus.num_feats)
+
+    checkpoint_path = str(tmpdir.join("model.ckpt"))
+    logits = {}
+    for cell_type in ["lstm", "lstm_block_fused"]:
+        test_model = Model(corpus.tgt_dir, corpus_r, num_layers=2,
+                           hidden_size=10, cell_type=cell_type)
+        feed_dict = {test_model.batch_x: batch_x,
+                     test_model.batch_x_lens: batch_x_lens}
+        with tf.Session() as sess:
+            if cell_type == "lstm":
+                sess.run(tf.global_variables_initializer())
+                # Non-zero peephole weights, so that they affect the logits.
+                for var in tf.global_variables():
+                    if "_diag" in var.op.name:
+                        var.load(rng.randn(*var.shape.as_list()), sess)
+                tf.train.Saver().save(sess, checkpoint_path)
+            else:
+                tf.train.Saver().restore(sess, checkpoint_path)
+            logits[cell_type] = sess.run(test_model.logits, feed_dict=feed_dict)
+
+    # Logits are time major. Frames past an utterance's length are padding.
+    for utterance, length in enumerate(batch_x_lens):
+        np.testing.assert_allclose(
+            logits["lstm_block_fused"][:length, utterance],
+            logits["lstm"][:length, utterance], rtol=1e-4, atol=1e-5)
+
+def test_model_train_data_parallel(create_test_corpus):
+    """Test that training with gradients averaged across worker processes
+    produces a checkpoint"""
+    import functools
+    from persephone.corpus_reader import CorpusReader
+    from persephone.rnn_ctc import Model
+    corpus = create_test_corpus()
+    base_directory = corpus.tgt_dir
+
+    corpus_r = CorpusReader(
+        corpus,
+        batch_size=1
+    )
+
+    model_factory = functools.partial(
+        Model, base_directory, corpus_r, num_layers=1, hidden_size=10)
+    test_model = model_factory()
+    desc_mtime = (base_directory / "model_description.json").stat().st_mtime
+
+    test_model.train(
+        early_stopping_steps=1,
+        min_epochs=1,
+        max_epochs=2,
+        num_workers=2,
+        model_factory=model_factory
+    )
+
+    assert (base_directory / "model" / "model_best.ckpt.index").exists()
+    # The workers' copies of the model leave its description alone.
+    assert (base_directory / "model_description.json").stat().st_mtime == desc_mtime
+
+def test_model_train_async_checkpoint(tmpdir, create_sine, make_wav, create_test_corpus):
+    """Test that checkpoints written in the background can be decoded from"""
+    from pathlib import Path
+    from persephone.corpus_reader import CorpusReader
+    from persephone.model import decode
+    from persephone.rnn_ctc import Model
+    corpus = create_test_corpus()
+    base_directory = corpus.tgt_dir
+
+    corpus_r = CorpusReader(
+        corpus,
+        batch_size=1
+    )
+
+    test_model = Model(
+        base_directory,
+        corpus_r,
+        num_layers=1,
+        hidden_size=10
+    )
+
+    test_model.train(
+        early_stopping_steps=1,
+        min_epochs=1,
+        max_epochs=3,
+        async_checkpoint=True
+    )
+
+    assert (base_directory / "decoded" / "best_hyps").exists()
+    assert (base_directory / "test" / "hyps").exists()
+
+    wav_to_decode_path = str(tmpdir.join("wav").join("to_decode.wav"))
+    make_wav(create_sine(note="C"), wav_to_decode_path)
+    decode(
+        base_directory / "model" / "model_best.ckpt",
+        [Path(wav_to_decode_path)],
+        label_set = {"A", "B", "C"},
+        feature_type = "fbank",
+        batch_x_name = test_model.batch_x.name,
+        batch_x_lens_name = test_model.batch_x_lens.name,
+        output_name = test_model.dense_decoded.name
+    )
+
+def test_model_train_async_validation(create_test_corpus):
+    """Test that validating in an evaluator process records every epoch and
+    keeps only the best checkpoint"""
+    import functools
+    from persephone.corpus_reader import CorpusReader
+    from persephone.rnn_ctc import Model
+    corpus = create_test_corpus()
+    base_directory = corpus.tgt_dir
+
+    corpus_r = CorpusReader(
+        corpus,
+        batch_size=1
+    )
+
+    model_factory = functools.partial(
+        Model, base_directory, corpus_r, num_layers=1, hidden_size=10)
+    test_model = model_factory()
+
+    epochs = []
+    test_model.train(
+        early_stopping_steps=10,
+        min_epochs=1,
+        max_epochs=3,
+        model_factory=model_factory,
+        async_validation=True,
+        max_validation_lag=1,
+        epoch_callback=lambda result: epochs.append(result["epoch"])
+    )
+
+    # Every epoch is validated, in order.
+    assert epochs == list(range(1, len(epochs) + 1))
+    assert len(epochs) >= 3
+    assert (base_directory / "model" / "model_best.ckpt.index").exists()
+    assert (base_directory / "model" / "model_best.ckpt.meta").exists()
+    assert not list((base_directory / "model").glob("epoch*"))
+    assert (base_directory / "test" / "hyps").exists()
+
+def test_model_train_telemetry(create_test_corpus):
+    """Test that training writes step, epoch and validation telemetry"""
+    import json
+    from persephone.corpus_reader import CorpusReader
+    from persephone.rnn_ctc import Model
+    corpus = create_test_corpus()
+    base_directory = corpus.tgt_dir
+
+    corpus_r = CorpusReader(
+        corpus,
+        batch_size=1
+    )
+
+    test_model = Model(
+        base_directory,
+        corpus_r,
+        num_layers=1,
+        hidden_size=10
+    )
+
+    callback_records = []
+    test_model.train(
+        early_stopping_steps=1,
+        min_epochs=1,
+        max_epochs=2,
+        telemetry_callback=callback_records.append
+    )
+
+    with (base_directory / "telemetry.jsonl").open() as telemetry_f:
+        records = [json.loads(line) for line in telemetry_f]
+    assert records == callback_records
+    events = {record["event"] for record in records}
+    assert events == {"step", "epoch", "validation"}
+    for record in records:
+        if record["event"] == "step":
+            assert record["frames"] > 0
+            assert 0.0 <= record["padded_ratio"] < 1.0
+            assert record["data_load"] >= 0
+            assert record["loss"] is not None
+            assert record["rss"] > 0
+
+def test_model_train_profile(create_test_corpus):
+    """Test that sampled training, validation and test steps are traced"""
+    from persephone.corpus_reader import CorpusReader
+    from persephone.rnn_ctc import Model
+    corpus = create_test_corpus()
+    base_directory = corpus.tgt_dir
+
+    corpus_r = CorpusReader(
+        corpus,
+        batch_size=1
+    )
+
+    test_model = Model(
+        base_directory,
+        corpus_r,
+        num_layers=1,
+        hidden_size=10
+    )
+
+    test_model.train(
+        early_stopping_steps=1,
+        min_epochs=1,
+        max_epochs=2,
+        profile_every=2
+    )
+
+    profile_dir = base_directory / "profile"
+    assert (profile_dir / "train_step0.timeline.json").exists()
+    assert not (profile_dir / "train_step1.timeline.json").exists()
+    assert (profile_dir / "valid_step0.timeline.json").exists()
+    assert (profile_dir / "eval_step0.timeline.json").exists()
+    with (profile_dir / "train_ops.tsv").open() as ops_f:
+        op_types = [line.split("\t")[0] for line in ops_f][1:]
+    assert "CTCLoss" in op_types
+
+def test_model_train_resume(create_test_corpus):
+    """Test that interrupted training carries on from the last finished
+    epoch"""
+    import json
+    from persephone.corpus_reader import CorpusReader
+    from persephone.rnn_ctc import Model
+    corpus = create_test_corpus()
+    base_directory = corpus.tgt_dir
+
+    class Interrupted(Exception):
+        pass
+
+    def interrupt(epoch_info):
+        if epoch_info["epoch"] == 3:
+            raise Interrupted()
+
+    corpus_r = CorpusReader(
+        corpus,
+        batch_size=1
+    )
+    test_model = Model(base_directory, corpus_r, num_layers=1, hidden_size=10)
+    with pytest.raises(Interrupted):
+        test_model.train(
+            early_stopping_steps=10,
+            min_epochs=1,
+            max_epochs=4,
+            epoch_callback=interrupt
+        )
+    # The state names the checkpoint of the same epoch, the only one kept.
+    with (base_directory / "model" / "train_state.json").open() as state_f:
+        train_state = json.load(state_f)
+    assert train_state["epoch"] == 2
+    assert train_state["latest_path"].endswith("model_latest_epoch2.ckpt")
+    assert [path.name for path in (base_directory / "model").glob(
+        "model_latest_epoch*.index")] == ["model_latest_epoch2.ckpt.index"]
+
+    resumed_epochs = []
+    test_model = Model(base_directory, corpus_r, num_layers=1, hidden_size=10)
+    test_model.train(
+        early_stopping_steps=10,
+        min_epochs=1,
+        max_epochs=4,
+        epoch_callback=lambda epoch_info: resumed_epochs.append(epoch_info["epoch"]),
+        resume=True
+    )
+
+    assert resumed_epochs[0] == 3
+    with (base_directory / "train_log.txt").open() as log_f:
+        epoch_lines = [line for line in log_f if line.startswith("Epoch ")]
+    # Epoch 3 was logged before the interruption and again when redone.
+    assert [line.split(".")[0] for line in epoch_lines[:4]] == [
+        "Epoch 1", "Epoch 2", "Epoch 3", "Epoch 3"]
+    assert (base_directory / "test" / "hyps").exists()
+
+def test_model_train_frame_budget(create_test_corpus):
+    """Test that training stops when the frame budget is used up"""
+    from persephone.budget import count_frames
+    from persephone.corpus_reader import CorpusReader
+    from persephone.rnn_ctc import Model
+    corpus = create_test_corpus()
+    base_directory = corpus.tgt_dir
+
+    corpus_r = CorpusReader(
+        corpus,
+        batch_size=1
+    )
+    test_model = Model(base_directory, corpus_r, num_layers=1, hidden_size=10)
+
+    epochs = []
+    test_model.train(
+        early_stopping_steps=10,
+        min_epochs=1,
+        max_epochs=10,
+        frame_budget=2 * count_frames(corpus_r.train_fns),
+        epoch_callback=lambda epoch_info: epochs.append(epoch_info["epoch"])
+    )
+
+    # Both epochs are validated: the first always is, and the second is the
+    # last that fits.
+    assert epochs == [1, 2]
+    assert (base_directory / "model" / "model_best.ckpt.index").exists()
+
+def test_model_train_accumulate_steps(create_test_corpus):
+    """Test that gradients are accumulated over batches before each update"""
+    import json
+    from persephone.corpus_reader import CorpusReader
+    from persephone.rnn_ctc import Model
+    corpus = create_test_corpus()
+    base_directory = corpus.tgt_dir
+
+    corpus_r = CorpusReader(
+        corpus,
+        batch_size=1
+    )
+
+    test_model = Model(
+        base_directory,
+        corpus_r,
+        num_layers=1,
+        hidden_size=10
+    )
+
+    test_model.train(
+        early_stopping_steps=1,
+        min_epochs=1,
+        max_epochs=2,
+        accumulate_steps=2
+    )
+
+    assert test_model.saved_model_path
+    with (base_directory / "telemetry.jsonl").open() as telemetry_f:
+        steps = [json.loads(line) for line in telemetry_f
+                 if json.loads(line)["event"] == "step"]
+    # The two training batches make one update per epoch.
+    assert len(steps) == 2
+    assert all(step["num_batches"] == 2 for step in steps)
@@ -0,0 +1,36 @@
+"""Tests for running grids of configurations with successive halving."""
+
+def test_expand_grid():
+    from persephone.scheduler import expand_grid
+    configs = expand_grid({"num_layers": [2, 3], "hidden_size": [100],
+                           "feat_type": ["fbank", "fbank_and_pitch"]})
+    assert len(configs) == 4
+    assert {"num_layers": 3, "hidden_size": 100, "feat_type": "fbank"} in configs
+
+def test_successive_halving_rungs():
+    from persephone.scheduler import SuccessiveHalving
+    halving = SuccessiveHalving(min_epochs=2, reduction_factor=3)
+    assert [epoch for epoch in range(1, 20) if halving.is_rung(epoch)] == [2, 6, 18]
+
+def test_successive_halving_stops_worse_trials():
+    """Test that only the best third of trials continue past a rung, and
+    that trials are judged on their best LER so far"""
+    from persephone.scheduler import SuccessiveHalving
+    halving = SuccessiveHalving(min_epochs=2, reduction_factor=3)
+    # Epochs between rungs never stop a trial.
+    assert halving.report(0, 1, 0.9)
+    # The first trial to reach a rung has nothing to be compared with.
+    assert halving.report(0, 2, 0.5)
+    assert not halving.report(1, 2, 0.6)
+    assert not halving.report(2, 2, 0.7)
+    assert halving.report(3, 1, 0.3)
+    # Trial 3 got worse at its rung epoch, but its best LER is the best yet.
+    assert halving.report(3, 2, 0.8)
+
+def test_core_slots():
+    import os
+    from persephone.scheduler import _core_slots
+    slots = _core_slots(1, None)
+    assert all(len(slot) == 1 for slot in slots)
+    assert len({core for slot in slots for core in slot}) == len(slots)
+    assert len(_core_slots(None, 1)) == 1
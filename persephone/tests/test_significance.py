@@ -0,0 +1,68 @@
+"""Tests for bootstrap confidence intervals and significance tests"""
+
+import random
+
+import pytest
+
+def write_test_transcriptions(exp_dir, hyps, refs):
+    test_dir = exp_dir / "test"
+    test_dir.mkdir(parents=True)
+    (test_dir / "hyps").write_text("".join(" ".join(hyp) + "\n" for hyp in hyps))
+    (test_dir / "refs").write_text("".join(" ".join(ref) + "\n" for ref in refs))
+
+def test_utterance_error_rates():
+    from persephone import significance, utils
+    from persephone.exceptions import EmptyReferenceException
+
+    hyps = [["a", "b"], ["a", "c", "d"], []]
+    refs = [["a", "b"], ["a", "b"], ["c", "a", "b"]]
+    error_rates = significance.utterance_error_rates(hyps, refs)
+    assert list(error_rates) == [0.0, 1.0, 1.0]
+    assert error_rates.mean() == pytest.approx(utils.batch_per(hyps, refs))
+    with pytest.raises(EmptyReferenceException):
+        significance.utterance_error_rates([["a"]], [[]])
+
+def test_bootstrap_ci():
+    import numpy as np
+    from persephone import significance
+
+    error_rates = np.random.RandomState(0).uniform(size=200)
+    per, low, high = significance.bootstrap_ci(error_rates, num_samples=2000)
+    assert per == pytest.approx(error_rates.mean())
+    assert low < per < high
+    assert high - low < 0.2
+    assert significance.bootstrap_ci(error_rates, num_samples=2000) == (per, low, high)
+    narrower = significance.bootstrap_ci(error_rates, num_samples=2000, confidence=0.5)
+    assert low < narrower[1] < narrower[2] < high
+
+def test_compare_experiments(tmp_path):
+    from persephone import significance
+    from persephone.exceptions import PersephoneException
+
+    rand = random.Random(0)
+    labels = list("abcdef")
+    refs = [[rand.choice(labels) for _ in range(rand.randint(5, 20))]
+            for _ in range(300)]
+    good = [[label if rand.random() < 0.9 else rand.choice(labels) for label in ref]
+            for ref in refs]
+    bad = [[label if rand.random() < 0.6 else rand.choice(labels) for label in ref]
+           for ref in refs]
+    write_test_transcriptions(tmp_path / "good", good, refs)
+    write_test_transcriptions(tmp_path / "bad", bad, refs)
+    write_test_transcriptions(tmp_path / "good_again", good, refs)
+
+    comparison = significance.compare_experiments(tmp_path / "good", tmp_path / "bad")
+    assert comparison["difference"] > 0
+    assert comparison["difference_ci"][0] > 0
+    assert comparison["p_value"] < 0.01
+    assert comparison["per_a"][0] < comparison["per_b"][0]
+
+    same = significance.compare_experiments(tmp_path / "good", tmp_path / "good_again")
+    assert same["difference"] == 0
+    assert same["p_value"] == 1.0
+
+    write_test_transcriptions(tmp_path / "other", good[1:], refs[1:])
+    with pytest.raises(PersephoneException):
+        significance.compare_experiments(tmp_path / "good", tmp_path / "other")
+    with pytest.raises(PersephoneException):
+        significance.compare_experiments(tmp_path / "good", tmp_path / "missing")
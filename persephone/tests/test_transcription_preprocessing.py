@@ -39,6 +39,30 @@ def test_segment_into_tokens():
     assert segment_into_tokens(input_2, token_inv) == output_2
     assert segment_into_tokens(input_3, token_inv) == output_3
 
+def test_tokenizer():
+    from persephone.preprocess.labels import Tokenizer, segment_into_tokens
+    from persephone.datasets.na import PHONEMES
+    from persephone.datasets.na import TONES
+    from persephone.datasets.na import SYMBOLS_TO_PREDICT
+
+    tokenizer = Tokenizer(PHONEMES.union(TONES).union(SYMBOLS_TO_PREDICT))
+    utterances = ["ə˧ʝi˧-ʂɯ˥ʝi˩ | -dʑo˩ … | ə˩-gi˩!",
+                  "   ʈʂʰɯ˧ne˧ ʝi˥-kv̩˩-tsɯ˩ | -mv̩˩.\r\n"]
+    assert tokenizer.segment_all(utterances) == [
+        "ə ˧ ʝ i ˧ ʂ ɯ ˥ ʝ i ˩ | dʑ o ˩ | ə ˩ g i ˩",
+        "ʈʂʰ ɯ ˧ n e ˧ ʝ i ˥ k v̩ ˩ ts ɯ ˩ | m v̩ ˩"]
+    # Enough utterances to be divided between a pool of processes.
+    many_utterances = utterances * 8
+    assert tokenizer.segment_all(many_utterances, num_processes=2) == [
+        tokenizer.segment(utterance) for utterance in many_utterances]
+
+    # The longest token is taken, backing off to shorter prefixes of it,
+    # and characters that start no token are skipped.
+    tokenizer = Tokenizer(["a", "ab", "abcd", "c"])
+    assert tokenizer("abcabcdxab") == "ab c abcd ab"
+    assert tokenizer.tokens("") == []
+    assert segment_into_tokens("abcabcdxab", {"a", "ab", "abcd", "c"}) == "ab c abcd ab"
+
 def test_unicode_segmentation():
     """Test that unicode whitespace characters are correctly handled in segmentation"""
     from persephone.preprocess.labels import segment_into_chars
@@ -60,4 +84,71 @@ def test_unicode_segmentation():
     ]
 
     for space_character in unicode_spaces:
-        assert segment_into_chars("hello"+space_character+"world") ==  "h e l l o w o r l d"
\ No newline at end of file
+        assert segment_into_chars("hello"+space_character+"world") ==  "h e l l o w o r l d"
+
+
+def test_na_tokenizer():
+    import pytest
+    from persephone.datasets import na
+
+    cases = [
+        ("ə˧ʝi˧-ʂɯ˥ʝi˩ | -dʑo˩ … | ə˩-gi˩!", "phonemes_and_tones",
+         "ə ˧ ʝ i ˧ ʂ ɯ ˥ ʝ i ˩ | dʑ o ˩ | ə ˩ g i ˩"),
+        ("ə˧ʝi˧-ʂɯ˥ʝi˩ | -dʑo˩ … | ə˩-gi˩!", "phonemes",
+         "ə ʝ i ʂ ɯ ʝ i dʑ o ə g i"),
+        ("ə˧ʝi˧-ʂɯ˥ʝi˩ | -dʑo˩ … | ə˩-gi˩!", "tones_notgm",
+         "˧ ˧ ˥ ˩ ˩ ˩ ˩"),
+        ("m… ʈʂʰɯ˧ne˧ [bruit] ʝi˥-kv̩˩-tsɯ˩ ◊ -mv̩˩.", "phonemes_and_tones",
+         "mmm… ʈʂʰ ɯ ˧ n e ˧ ʝ i ˥ k v̩ ˩ ts ɯ ˩ | m v̩ ˩"),
+        ("m… ʈʂʰɯ˧ne˧ [bruit] ʝi˥-kv̩˩-tsɯ˩ ◊ -mv̩˩.", "phonemes",
+         "mmm… ʈʂʰ ɯ n e ʝ i k v̩ ts ɯ m v̩"),
+        ("m… ʈʂʰɯ˧ne˧ [bruit] ʝi˥-kv̩˩-tsɯ˩ ◊ -mv̩˩.", "tones_notgm",
+         "˧ ˧ ˥ ˩ ˩ ˩"),
+        ("wæ̃˧˥ ə… ˧̩", "phonemes_and_tones",
+         "w̃æ ˧˥ əəə… ˧"),
+        ("wæ̃˧˥ ə… ˧̩", "phonemes",
+         "w̃æ əəə… ˧"),
+        ("wæ̃˧˥ ə… ˧̩", "tones_notgm",
+         "˧˥ ˧"),
+    ]
+    for sent, label_type, tokens in cases:
+        assert na.preprocess_na(sent, label_type) == tokens
+        assert na.na_tokenizer(label_type)(sent) == tokens
+    assert na.na_tokenizer("phonemes") is na.na_tokenizer("phonemes")
+    assert na.preprocess_na("ʝi˥ BEGAIEMENT", "phonemes") == ""
+    # An unclosed bracket hides the rest of the sentence.
+    assert na.preprocess_na("ʝi˥ [bruit", "phonemes_and_tones") == "ʝ i ˥"
+    with pytest.raises(ValueError):
+        na.preprocess_na("ʝi˥", "syllables")
+    with pytest.raises(ValueError):
+        na.preprocess_na("ʝi˥ X", "phonemes")
+
+def test_na_prepare_labels(tmp_path):
+    from persephone.datasets import na
+
+    xml_dir = tmp_path / "xml"
+    xml_dir.mkdir()
+    for name in ["story1", "story2", "story3"]:
+        (xml_dir / (name + ".xml")).write_text(
+            '<TEXT><S><FORM>ʝi˥-kv̩˩ | -mv̩˩.</FORM><AUDIO start="0.0" end="1.0"/></S>'
+            '<S><FORM>[bruit]</FORM><AUDIO start="1.0" end="2.0"/></S>'
+            '<S><FORM>ə˧ʝi˧</FORM><AUDIO start="2.0" end="3.0"/></S></TEXT>',
+            encoding="utf-8")
+    na.prepare_labels("phonemes_and_tones", org_xml_dir=str(xml_dir),
+                      label_dir=str(tmp_path / "serial"))
+    na.prepare_labels("phonemes_and_tones", org_xml_dir=str(xml_dir),
+                      label_dir=str(tmp_path / "parallel"), num_processes=2)
+    serial = sorted(path.name for path in (tmp_path / "serial" / "TEXT").iterdir())
+    assert serial == ["story%d.%d.phonemes_and_tones" % (story, i)
+                      for story in [1, 2, 3] for i in [0, 2]]
+    for name in serial:
+        assert ((tmp_path / "serial" / "TEXT" / name).read_text(encoding="utf-8")
+                == (tmp_path / "parallel" / "TEXT" / name).read_text(encoding="utf-8"))
+    assert ((tmp_path / "serial" / "TEXT" / "story1.0.phonemes_and_tones").read_text(
+        encoding="utf-8") == "ʝ i ˥ k v̩ ˩ | m v̩ ˩\n")
+
+def test_remove_content_in_brackets():
+    from persephone.preprocess import pangloss
+
+    assert pangloss.remove_content_in_brackets("a [b [c] d] e] f") == "a  e] f"
+    assert pangloss.remove_content_in_brackets("a (b) c", "()") == "a  c"
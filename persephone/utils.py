@@ -8,9 +8,9 @@ from subprocess import PIPE
 from typing import List, Sequence, Tuple, TypeVar
 
 import numpy as np # type: ignore
-from nltk.metrics import distance
 
 from . import config
+from .distance import batch_edit_distance
 
 logger = logging.getLogger(__name__) # type: ignore
 
@@ -68,10 +68,24 @@ def load_batch_x(path_batch,
     """ Loads a batch of input features given a list of paths to numpy
     arrays in that batch."""
 
-    utterances = [np.load(str(path)) for path in path_batch]
+    return pad_batch(load_utterances(path_batch), flatten=flatten,
+                     time_major=time_major)
+
+def load_utterances(path_batch) -> List[np.ndarray]:
+    """ Loads the input features of each utterance in a batch, without
+    padding them. """
+
+    return [np.load(str(path)) for path in path_batch]
+
+def pad_batch(utterances: Sequence[np.ndarray],
+              flatten: bool = False,
+              time_major: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+    """ Zero pads the input features of a batch of utterances to the length
+    of the longest, returning the padded batch and the utterance lengths. """
+
     utter_lens = [utterance.shape[0] for utterance in utterances]
     max_len = max(utter_lens)
-    batch_size = len(path_batch)
+    batch_size = len(utterances)
     shape = (batch_size, max_len) + tuple(utterances[0].shape[1:])
     batch = np.zeros(shape)
     for i, utt in enumerate(utterances):
@@ -84,11 +98,12 @@ def batch_per(hyps: Sequence[Sequence[T]],
               refs: Sequence[Sequence[T]]) -> float:
     """ Calculates the phoneme error rate of a batch."""
 
+    refs = [[phn_i for phn_i in ref if phn_i != 0] for ref in refs[:len(hyps)]]
+    hyps = [[phn_i for phn_i in hyp if phn_i != 0] for hyp in hyps]
+    distances = batch_edit_distance(refs, hyps)
     macro_per = 0.0
-    for i in range(len(hyps)):
-        ref = [phn_i for phn_i in refs[i] if phn_i != 0]
-        hyp = [phn_i for phn_i in hyps[i] if phn_i != 0]
-        macro_per += distance.edit_distance(ref, hyp)/len(ref)
+    for dist, ref in zip(distances, refs):
+        macro_per += int(dist)/len(ref)
     return macro_per/len(hyps)
 
 def get_prefixes(dirname: str, extension: str) -> List[str]:
@@ -0,0 +1,149 @@
+""" Validating checkpoints in a separate process while training continues.
+
+Decoding the validation set with beam search takes a substantial fraction of
+each epoch for small models. With `Model.train(async_validation=True)` the
+training process instead saves a lightweight checkpoint (variables only, no
+meta graph) at the end of each epoch and hands its path to an evaluator
+process, which restores it into its own copy of the model, decodes the
+validation set and sends back the label error rate and hypotheses. The
+training process keeps going in the meantime and makes its early stopping
+decisions as results arrive, at most `max_validation_lag` epochs behind.
+"""
+
+import logging
+import multiprocessing
+import os
+import queue
+import traceback
+from typing import Any, Callable, List, Optional, Tuple
+
+import tensorflow as tf
+
+from . import data_parallel
+from .exceptions import PersephoneException
+
+logger = logging.getLogger(__name__) # type: ignore
+
+# A validation result: the epoch, the validation LER and the human readable
+# hypotheses and references.
+ValidationResult = Tuple[int, float, List[List[str]], List[List[str]]]
+
+def _evaluator_main(model_factory: Callable[[], Any], jobs: Any, results: Any,
+                    num_threads: int) -> None:
+    """ The loop run by the evaluator process. Builds its own copy of the
+    model and validates each checkpoint it is sent until it receives None. """
+
+    model = data_parallel.build_copy(model_factory)
+    saver = tf.train.Saver()
+    valid_x, valid_x_lens, valid_y = model.corpus_reader.valid_batch()
+    feed_dict = model.make_feed_dict(valid_x, valid_x_lens, valid_y)
+    config = tf.ConfigProto(intra_op_parallelism_threads=num_threads,
+                            inter_op_parallelism_threads=num_threads)
+    with tf.Session(config=config) as sess:
+        while True:
+            job = jobs.get()
+            if job is None:
+                break
+            epoch, checkpoint_path = job
+            try:
+                saver.restore(sess, checkpoint_path)
+                valid_ler, dense_decoded, dense_ref = sess.run(
+                    [model.ler, model.dense_decoded, model.dense_ref],
+                    feed_dict=feed_dict)
+                hyps, refs = model.corpus_reader.human_readable_hyp_ref(
+                    dense_decoded, dense_ref)
+                results.put(("result", (epoch, float(valid_ler), hyps, refs)))
+            except Exception: # pylint: disable=broad-except
+                results.put(("error", traceback.format_exc()))
+
+class ValidationEvaluator:
+    """ An evaluator process that computes the validation LER of checkpoints
+    saved by the training process.
+
+    Args:
+        model_factory: A picklable callable that takes no arguments and
+                       returns a model with the same variables as the one
+                       being trained, as for `data_parallel.WorkerPool`.
+        num_threads: The number of threads the evaluator's Tensorflow session
+                     uses. Defaults to a quarter of the CPU cores, leaving the
+                     rest to training.
+
+    Checkpoints are validated in the order they are submitted, so results
+    are returned in epoch order. The process is started with the "spawn"
+    method, so scripts that use it need an `if __name__ == "__main__":`
+    guard.
+    """
+
+    def __init__(self, model_factory: Callable[[], Any],
+                 num_threads: int = None) -> None:
+        if not num_threads:
+            num_threads = max(1, (os.cpu_count() or 1) // 4)
+        context = multiprocessing.get_context("spawn")
+        self._jobs = context.Queue() # type: Any
+        self._results = context.Queue() # type: Any
+        self.num_pending = 0
+        self.process = context.Process(
+            target=_evaluator_main,
+            args=(model_factory, self._jobs, self._results, num_threads),
+            daemon=True) # type: Optional[Any]
+        self.process.start()
+        logger.info("Started validation evaluator process")
+
+    def submit(self, epoch: int, checkpoint_path: str) -> None:
+        """ Queues the checkpoint at checkpoint_path, saved at the end of
+        epoch, for validation. """
+
+        self._jobs.put((epoch, checkpoint_path))
+        self.num_pending += 1
+
+    def _get(self, block: bool) -> ValidationResult:
+        while True:
+            try:
+                message, payload = self._results.get(block=block, timeout=1.0 if block else None)
+            except queue.Empty:
+                if not block:
+                    raise
+                if self.process is not None and not self.process.is_alive():
+                    raise PersephoneException(
+                        "The validation evaluator process exited unexpectedly.")
+                continue
+            self.num_pending -= 1
+            if message == "error":
+                raise PersephoneException(
+                    "The validation evaluator failed:\n%s" % payload)
+            return payload
+
+    def results(self, max_pending: int = 0) -> List[ValidationResult]:
+        """ Returns the results that are ready, in epoch order, first waiting
+        until no more than max_pending checkpoints are still being validated.
+
+        Returns:
+            A list of (epoch, validation LER, hypotheses, references) tuples.
+        """
+
+        ready = [] # type: List[ValidationResult]
+        while self.num_pending > max_pending:
+            ready.append(self._get(block=True))
+        while self.num_pending > 0:
+            try:
+                ready.append(self._get(block=False))
+            except queue.Empty:
+                break
+        return ready
+
+    def close(self) -> None:
+        """ Stops the evaluator process, abandoning any pending checkpoints. """
+
+        if self.process is None:
+            return
+        self._jobs.put(None)
+        self.process.join(timeout=10)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process = None
+
+    def __enter__(self) -> "ValidationEvaluator":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()